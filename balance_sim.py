@@ -0,0 +1,194 @@
+# balance_sim.py
+# Монте-Карло симулятор баланса: арена, исследования и данжи на тех же формулах, что и бот.
+# Питомцы генерируются как при вылуплении (roll_pet_from_egg_type + generate_stats_for_class),
+# «полоса редкости» — тип яйца. Прогоны раскидываются по ядрам через multiprocessing.
+#
+# Пример:
+#   python balance_sim.py --modes arena dungeon explore --runs 20000 --out sim_results
+#
+# Результаты — CSV в длинном формате (одна строка на ячейку матрицы), их удобно
+# грузить в pandas / таблицы и сравнивать между правками констант.
+import argparse
+import csv
+import os
+import random
+from multiprocessing import Pool
+
+from bot.utils.pet_generator import (
+    EGG_TYPES, PETS_BY_RARITY, RARITY_STATS_RANGE, RARITY_TOTAL_STAT_MULTIPLIER,
+    roll_pet_from_egg_type, generate_stats_for_class
+)
+from bot.utils.battle_system import simulate_battle_dungeon, simulate_battle_explore, scale_dungeon_monster
+from bot.utils.arena_engine import simulate_arena_battle, generate_bot_team
+from bot.data.dungeons import MONSTERS, DUNGEONS
+
+BOT_BAND = "бот"
+CHUNK_SIZE = 2000 # Прогонов в одной задаче пула
+
+
+def roll_pet(egg_type: str) -> dict:
+    pet = roll_pet_from_egg_type(egg_type, PETS_BY_RARITY, EGG_TYPES)
+    pet["stats"] = generate_stats_for_class(pet["class"], pet["rarity"], RARITY_STATS_RANGE, RARITY_TOTAL_STAT_MULTIPLIER)
+    pet["current_hp"] = pet["stats"]["hp"]
+    return pet
+
+def roll_team(egg_type: str, size: int) -> list[dict]:
+    return [roll_pet(egg_type) for _ in range(size)]
+
+def team_power(team: list[dict]) -> int:
+    return sum(p["stats"]["atk"] + p["stats"]["def"] + p["stats"]["hp"] for p in team)
+
+
+# --- Одна задача пула: chunk прогонов одной ячейки, возвращает суммы ---
+
+def run_arena_chunk(band1: str, band2: str, team_size: int, runs: int, seed: int) -> dict:
+    random.seed(seed)
+    rng = random.Random(seed)
+    totals = {"battles": 0, "wins": 0, "draws": 0, "losses": 0, "power1": 0, "power2": 0}
+    for _ in range(runs):
+        team1 = roll_team(band1, team_size)
+        power1 = team_power(team1)
+        team2 = generate_bot_team(power1, team_size) if band2 == BOT_BAND else roll_team(band2, team_size)
+        outcome = simulate_arena_battle(team1, team2, rng).outcome1
+        totals["battles"] += 1
+        totals[{"win": "wins", "draw": "draws", "loss": "losses"}[outcome]] += 1
+        totals["power1"] += power1
+        totals["power2"] += team_power(team2)
+    return totals
+
+def run_dungeon_chunk(dungeon_key: str, egg_type: str, team_size: int, runs: int, seed: int) -> dict:
+    random.seed(seed)
+    dungeon_info = DUNGEONS[dungeon_key]
+    size = max(team_size, dungeon_info["min_pets_required"])
+    num_encounters = dungeon_info["num_encounters"] + (1 if dungeon_info["boss_monster"] else 0)
+    totals = {"runs": 0, "clears": 0, "encounters_cleared": 0, "xp": 0, "coins": 0}
+
+    for _ in range(runs):
+        pets_data = roll_team(egg_type, size)
+        cleared = 0
+        for i in range(num_encounters):
+            is_boss = i >= dungeon_info["num_encounters"]
+            monster_key = dungeon_info["boss_monster"] if is_boss else random.choice(dungeon_info["monster_pool"])
+            monster = scale_dungeon_monster(MONSTERS[monster_key], dungeon_info["difficulty_level"], is_boss)
+            result = simulate_battle_dungeon(pets_data, monster)
+            if not result["victory"]:
+                break
+            cleared += 1
+            totals["xp"] += result["xp_gained"]
+            totals["coins"] += result["coins_gained"]
+            pets_data = result["updated_pets_data"]
+        totals["runs"] += 1
+        totals["encounters_cleared"] += cleared
+        totals["clears"] += 1 if cleared == num_encounters else 0
+    return totals
+
+def run_explore_chunk(egg_type: str, monster_key: str, difficulty: int, runs: int, seed: int) -> dict:
+    random.seed(seed)
+    monster = scale_dungeon_monster(MONSTERS[monster_key], difficulty)
+    totals = {"battles": 0, "wins": 0, "turns": 0}
+    for _ in range(runs):
+        result = simulate_battle_explore(roll_pet(egg_type)["stats"], monster)
+        totals["battles"] += 1
+        totals["wins"] += 1 if result["outcome"] == "win" else 0
+        totals["turns"] += result["turns"][-1]["turn"] if result["turns"] else 0
+    return totals
+
+CHUNK_RUNNERS = {
+    "arena": run_arena_chunk,
+    "dungeon": run_dungeon_chunk,
+    "explore": run_explore_chunk,
+}
+
+def run_task(task):
+    mode, cell, runs, seed = task
+    return mode, cell, CHUNK_RUNNERS[mode](*cell, runs, seed)
+
+
+# --- Построение ячеек и сбор результатов ---
+
+def build_cells(modes: list[str], team_size: int, explore_difficulty: int) -> list[tuple[str, tuple]]:
+    eggs = list(EGG_TYPES)
+    cells = []
+    if "arena" in modes:
+        cells += [("arena", (b1, b2, team_size)) for b1 in eggs for b2 in eggs + [BOT_BAND]]
+    if "dungeon" in modes:
+        cells += [("dungeon", (d, egg, team_size)) for d in DUNGEONS for egg in eggs]
+    if "explore" in modes:
+        cells += [("explore", (egg, m, explore_difficulty)) for egg in eggs for m in MONSTERS]
+    return cells
+
+def build_tasks(cells, runs: int, seed: int):
+    tasks = []
+    for cell_index, (mode, cell) in enumerate(cells):
+        remaining, chunk_index = runs, 0
+        while remaining > 0:
+            chunk = min(CHUNK_SIZE, remaining)
+            # Сид детерминирован по ячейке и номеру чанка: результат не зависит от числа процессов
+            tasks.append((mode, cell, chunk, seed * 1_000_003 + cell_index * 10_007 + chunk_index))
+            remaining -= chunk
+            chunk_index += 1
+    return tasks
+
+def to_row(mode: str, cell: tuple, t: dict) -> dict:
+    if mode == "arena":
+        band1, band2, team_size = cell
+        n = t["battles"]
+        return {
+            "egg_type_1": band1, "egg_type_2": band2, "team_size": team_size, "battles": n,
+            "win_rate": round(t["wins"] / n, 4), "draw_rate": round(t["draws"] / n, 4), "loss_rate": round(t["losses"] / n, 4),
+            "avg_power_1": round(t["power1"] / n, 1), "avg_power_2": round(t["power2"] / n, 1),
+        }
+    if mode == "dungeon":
+        dungeon_key, egg_type, team_size = cell
+        n = t["runs"]
+        return {
+            "dungeon": dungeon_key, "egg_type": egg_type,
+            "team_size": max(team_size, DUNGEONS[dungeon_key]["min_pets_required"]), "runs": n,
+            "clear_rate": round(t["clears"] / n, 4), "avg_encounters_cleared": round(t["encounters_cleared"] / n, 3),
+            "avg_xp": round(t["xp"] / n, 1), "avg_coins": round(t["coins"] / n, 1),
+        }
+    egg_type, monster_key, difficulty = cell
+    n = t["battles"]
+    return {
+        "egg_type": egg_type, "monster": monster_key, "difficulty": difficulty, "battles": n,
+        "win_rate": round(t["wins"] / n, 4), "avg_turns": round(t["turns"] / n, 2),
+    }
+
+def write_csv(path: str, rows: list[dict]):
+    if not rows:
+        return
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Монте-Карло симуляция баланса боёв")
+    parser.add_argument("--modes", nargs="+", choices=list(CHUNK_RUNNERS), default=list(CHUNK_RUNNERS))
+    parser.add_argument("--runs", type=int, default=10000, help="Прогонов на ячейку матрицы")
+    parser.add_argument("--team-size", type=int, default=5)
+    parser.add_argument("--explore-difficulty", type=int, default=0, help="Сложность для монстров в режиме explore")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="sim_results")
+    args = parser.parse_args()
+
+    cells = build_cells(args.modes, args.team_size, args.explore_difficulty)
+    tasks = build_tasks(cells, args.runs, args.seed)
+
+    totals = {}
+    with Pool(processes=args.workers) as pool:
+        for mode, cell, chunk_totals in pool.imap_unordered(run_task, tasks):
+            acc = totals.setdefault((mode, cell), {})
+            for key, value in chunk_totals.items():
+                acc[key] = acc.get(key, 0) + value
+
+    os.makedirs(args.out, exist_ok=True)
+    for mode in args.modes:
+        rows = [to_row(m, cell, totals[(m, cell)]) for m, cell in cells if m == mode]
+        path = os.path.join(args.out, f"{mode}_winrates.csv")
+        write_csv(path, rows)
+        print(f"{mode}: {len(rows)} ячеек -> {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# bot/data/dungeons.py
+
+# --- ОПРЕДЕЛЕНИЯ МОНСТРОВ ---
+MONSTERS = {
+    "лесной_волк": {
+        "name_ru": "Лесной Волк",
+        "base_hp": 30,
+        "base_atk": 10,
+        "base_def": 5,
+        "abilities": ["Быстрая атака"]
+    },
+    "древесный_голем": {
+        "name_ru": "Древесный Голем",
+        "base_hp": 50,
+        "base_atk": 8,
+        "base_def": 15,
+        "abilities": ["Каменная кожа"]
+    },
+    "огненный_элементаль": {
+        "name_ru": "Огненный Элементаль",
+        "base_hp": 40,
+        "base_atk": 18,
+        "base_def": 10,
+        "abilities": ["Горящая аура"]
+    },
+    "лавовый_гоблин": {
+        "name_ru": "Лавовый Гоблин",
+        "base_hp": 35,
+        "base_atk": 15,
+        "base_def": 7,
+        "abilities": ["Взрывной удар"]
+    },
+    "древний_зверь": {
+        "name_ru": "Древний Зверь",
+        "base_hp": 80,
+        "base_atk": 25,
+        "base_def": 15,
+        "abilities": ["Яростный рев"]
+    },
+    "повелитель_огня": {
+        "name_ru": "Повелитель Огня",
+        "base_hp": 100,
+        "base_atk": 30,
+        "base_def": 20,
+        "abilities": ["Метеоритный дождь", "Огненный щит"]
+    },
+    "ледяной_тролль": {
+        "name_ru": "Ледяной Тролль",
+        "base_hp": 70,
+        "base_atk": 20,
+        "base_def": 20,
+        "abilities": ["Ледяная броня"]
+    },
+    "снежная_фурия": {
+        "name_ru": "Снежная Фурия",
+        "base_hp": 60,
+        "base_atk": 25,
+        "base_def": 12,
+        "abilities": ["Заморозка"]
+    },
+    "призрачный_рыцарь": {
+        "name_ru": "Призрачный Рыцарь",
+        "base_hp": 90,
+        "base_atk": 30,
+        "base_def": 25,
+        "abilities": ["Неуловимость"]
+    },
+    "король_скелетов": {
+        "name_ru": "Король Скелетов",
+        "base_hp": 120,
+        "base_atk": 35,
+        "base_def": 30,
+        "abilities": ["Воскрешение"]
+    }
+}
+
+# --- ОПРЕДЕЛЕНИЯ ДАНЖЕЙ ---
+DUNGEONS = {
+    "лесное_подземелье": {
+        "name_ru": "Лесное подземелье",
+        "description": "Сложное подземелье, кишащее опасными существами. Шанс получить Крутое яйцо.",
+        "difficulty_level": 5, # Рекомендуемый уровень питомца/команды
+        "reward_egg_type": "крутое",
+        "entry_cost_energy": 50,
+        "min_pets_required": 1,
+        "duration_min": 5,
+        "duration_max": 10,
+        "monster_pool": ["лесной_волк", "древесный_голем"],
+        "num_encounters": 2,
+        "boss_monster": None
+    },
+    "огненная_пещера": {
+        "name_ru": "Огненная пещера",
+        "description": "Раскаленная пещера с древними духами огня. Шанс получить яйцо всмятку.",
+        "difficulty_level": 10,
+        "reward_egg_type": "всмятку",
+        "entry_cost_energy": 80,
+        "min_pets_required": 2,
+        "duration_min": 10,
+        "duration_max": 20,
+        "monster_pool": ["огненный_элементаль", "лавовый_гоблин"],
+        "num_encounters": 3,
+        "boss_monster": "повелитель_огня"
+    },
+    "ледяные_глубины": {
+        "name_ru": "Ледяные Глубины",
+        "description": "Замерзшие пещеры, где обитают древние ледяные существа. Шанс получить Дореволюционное яйцо.",
+        "difficulty_level": 15,
+        "reward_egg_type": "дореволюционное",
+        "entry_cost_energy": 120,
+        "min_pets_required": 3,
+        "duration_min": 15,
+        "duration_max": 25,
+        "monster_pool": ["ледяной_тролль", "снежная_фурия", "древний_зверь"],
+        "num_encounters": 4,
+        "boss_monster": "ледяной_тролль" # Можно использовать существующего монстра как босса, но с усилением
+    },
+    "забытые_катакомбы": {
+        "name_ru": "Забытые Катакомбы",
+        "description": "Темные катакомбы, полные призраков и нежити. Шанс получить яйцо Фаберже.",
+        "difficulty_level": 20,
+        "reward_egg_type": "фаберже",
+        "entry_cost_energy": 150,
+        "min_pets_required": 4,
+        "duration_min": 20,
+        "duration_max": 30,
+        "monster_pool": ["призрачный_рыцарь", "король_скелетов", "древесный_голем"], # Можно смешивать монстров
+        "num_encounters": 5,
+        "boss_monster": "король_скелетов"
+    }
+}
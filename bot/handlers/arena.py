@@ -1,22 +1,26 @@
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters import Command, CommandObject
-from db.db import fetch_one, fetch_all, execute_query # Assuming these are async functions
+from db.db import fetch_one, fetch_all, execute_query, transaction # Assuming these are async functions
 import json
 import random
 import asyncio
+from bisect import bisect_right
 from aiogram.exceptions import TelegramBadRequest
-from datetime import datetime, timedelta # Import for energy system
+from bot.utils import arena_matchmaking, arena_leaderboard
+from bot.utils.arena_leaderboard import SCORE_COUNTS_UPSERT
+from bot.utils.pet_query import stats_from_row
+from bot.utils.quest_engine import QuestEvent, WIN_ARENA_BATTLES, REACH_PET_LEVEL, emit_quest_events
+from bot.utils.display_names import get_display_name, get_display_names
+from bot.utils.user_snapshot import get_user, invalidate_users
+from bot.utils.energy import ARENA_MAX_ENERGY, ARENA_ENERGY, get_energy, seconds_until, spend_energy, restore_energy
+from bot.utils.arena_engine import simulate_arena_battle, generate_bot_team, ATTACK_MISS, ATTACK_CRIT, ATTACK_HIT
 
 router = Router()
 
-arena_queue = []
 ARENA_JOIN_COST = 20
 
 # --- Constants for Arena ---
-ARENA_MAX_ENERGY = 6
-ENERGY_RECHARGE_TIME_MINUTES = 30 # 1 energy recharges every 30 minutes
-
 BASE_XP_WIN = 90
 BASE_XP_LOSS = 35
 BASE_XP_DRAW = 60
@@ -27,6 +31,8 @@ BASE_COINS_DRAW = 50
 
 MAX_TEAM_PETS = 5
 
+_startup_tasks: set[asyncio.Task] = set() # Разовые задачи при старте матчмейкинга
+
 # --- XP to Level Mapping (Example, adjust as needed) ---
 # This can be a simple linear progression, or more complex.
 # For simplicity, let's say next_level_xp = current_level * 100
@@ -46,80 +52,28 @@ RANKS = [
     (120, "Легенда Дикой Арены")
 ]
 
+RANK_THRESHOLDS = [threshold for threshold, _ in RANKS]
+
 def get_rank(wins):
-    for threshold, title in reversed(RANKS):
-        if wins >= threshold:
-            return title
-    return "Новичок"
+    idx = bisect_right(RANK_THRESHOLDS, wins) - 1 # Бинарный поиск вместо перебора RANKS
+    return RANKS[idx][1] if idx >= 0 else "Новичок"
 
 def calculate_power(team):
-    return sum(p["stats"]["atk"] + p["stats"]["def"] + p["stats"]["hp"] for p in team)
+    # pets.power — генерируемая колонка atk + def + hp, для своих питомцев считается в БД
+    return sum(p["power"] if "power" in p else p["stats"]["atk"] + p["stats"]["def"] + p["stats"]["hp"] for p in team)
 
 # --- NEW: Energy Recharge Logic ---
-async def check_and_recharge_energy(uid: int):
-    user = await fetch_one("SELECT arena_energy, last_arena_energy_recharge FROM users WHERE user_id = $1", {"uid": uid})
-    if not user:
-        return # User not found, should be handled before this
-
-    current_energy = user.get("arena_energy", 0)
-    last_recharge_time = user.get("last_arena_energy_recharge")
-
-    if current_energy >= ARENA_MAX_ENERGY:
-        return current_energy # Already full
-
-    if not last_recharge_time:
-        # If no last recharge time, assume they just started or maxed out
-        # Set it to now if not full, so next recharge is from now.
-        if current_energy < ARENA_MAX_ENERGY:
-             await execute_query("UPDATE users SET last_arena_energy_recharge = NOW() WHERE user_id = $1", {"uid": uid})
-        return current_energy
-
-    # Ensure last_recharge_time is a datetime object
-    if isinstance(last_recharge_time, str):
-        # Assuming format from PostgreSQL 'YYYY-MM-DD HH:MM:SS.microseconds'
-        try:
-            last_recharge_time = datetime.fromisoformat(last_recharge_time)
-        except ValueError:
-            # Fallback for other potential formats or if parsing fails
-            # You might need to adjust this based on how your DB driver returns timestamps
-            print(f"Warning: Could not parse last_recharge_time '{last_recharge_time}'. Assuming now.")
-            last_recharge_time = datetime.now()
-
-
-    now = datetime.now()
-    time_since_last_recharge = now - last_recharge_time
-
-    recharge_intervals = time_since_last_recharge.total_seconds() // (ENERGY_RECHARGE_TIME_MINUTES * 60)
-    
-    if recharge_intervals > 0:
-        new_energy = min(ARENA_MAX_ENERGY, current_energy + int(recharge_intervals))
-        
-        # Calculate new last_recharge_time
-        new_last_recharge_time = last_recharge_time + timedelta(minutes=ENERGY_RECHARGE_TIME_MINUTES * int(recharge_intervals))
-        
-        await execute_query(
-            "UPDATE users SET arena_energy = $1, last_arena_energy_recharge = $2 WHERE user_id = $3",
-            {"arena_energy": new_energy, "last_arena_energy_recharge": new_last_recharge_time, "uid": uid}
-        )
-        return new_energy
-    return current_energy
-
-
 # ——— /team — показ або встановлення команди (No changes needed here unless you want to show energy info)
 @router.message(Command("team"))
 async def team_command_handler(message: Message, command: CommandObject): # Используем CommandObject
     uid = message.from_user.id
     
     # Проверка регистрации пользователя
-    user = await fetch_one("SELECT user_id FROM users WHERE user_id = $1", {"user_id": uid})
+    user = await get_user(uid)
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start.")
         return
 
-    # Получаем все питомцы пользователя один раз для кэширования
-    all_user_pets = await fetch_all("SELECT id, name, rarity, class, level, stats FROM pets WHERE user_id = $1", {"user_id": uid})
-    pet_data_by_id = {p["id"]: p for p in all_user_pets}
-
     # Получаем текущую арена-команду из arena_team
     arena_team_record = await fetch_one("SELECT pet_ids, team_name FROM arena_team WHERE user_id = $1", {"user_id": uid})
     
@@ -175,7 +129,8 @@ async def team_command_handler(message: Message, command: CommandObject): # Ис
             await message.answer("ID питомца должен быть числом.", parse_mode="HTML")
             return
 
-        if pet_to_add_id not in pet_data_by_id:
+        owned_pet = await fetch_one("SELECT id FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_to_add_id, "user_id": uid})
+        if not owned_pet:
             await message.answer("Питомец с таким ID не найден или не принадлежит тебе.")
             return
 
@@ -244,9 +199,12 @@ async def team_command_handler(message: Message, command: CommandObject): # Ис
             return
 
         # Проверка, что все ID принадлежат пользователю и не повторяются
+        owned_rows = await fetch_all("SELECT id FROM pets WHERE user_id = $1 AND id = ANY($2::int[])",
+                                     {"user_id": uid, "ids": new_team_ids})
+        owned_ids = {row["id"] for row in owned_rows}
         valid_team = True
         for pet_id in new_team_ids:
-            if pet_id not in pet_data_by_id:
+            if pet_id not in owned_ids:
                 await message.answer(f"⚠ Питомец с ID <code>{pet_id}</code> не найден или не принадлежит тебе.", parse_mode="HTML")
                 valid_team = False
                 break
@@ -280,22 +238,14 @@ async def team_command_handler(message: Message, command: CommandObject): # Ис
                                  f"Задать название: <code>/team name \"Твое название\"</code>", parse_mode="HTML")
             return
         
-        team_for_display = []
-        for pet_id in current_team_ids:
-            pet_data = pet_data_by_id.get(pet_id) 
-            if pet_data:
-                # Убедимся, что stats это dict, а не строка
-                pet_data_copy = dict(pet_data) 
-                if isinstance(pet_data_copy["stats"], str):
-                    pet_data_copy["stats"] = json.loads(pet_data_copy["stats"])
-                team_for_display.append(pet_data_copy)
+        team_for_display, _ = await fetch_team(uid)
         
         total_team_power = calculate_power(team_for_display)
 
         text = f"🏟️ <b>Твоя арена-команда: {team_name}</b>\n\n"
         text += f"📊 Общая сила команды: <b>{total_team_power}</b> 💪\n\n"
 
-        if not team_for_display: # Если питомцы в team_ids есть, но их не нашли в all_user_pets
+        if not team_for_display: # Если питомцы в team_ids есть, но их уже нет у пользователя
             text += "Один или несколько питомцев в твоей команде не найдены в твоем инвентаре. Возможно, они были удалены."
         else:
             for idx, pet in enumerate(team_for_display, 1): 
@@ -309,179 +259,207 @@ async def team_command_handler(message: Message, command: CommandObject): # Ис
         text += "или <code>/team &lt;id1&gt; &lt;id2&gt; ...</code> для управления командой."
         await message.answer(text, parse_mode="HTML")
 
+# Команда и её питомцы одним запросом: слоты разворачиваются из pet_ids с сохранением порядка
+TEAM_QUERY = """
+    SELECT t.team_name, p.id, p.name, p.rarity, p.class, p.atk, p.def, p.hp, p.power, p.xp, p.level
+    FROM arena_team t
+    LEFT JOIN LATERAL jsonb_array_elements_text(t.pet_ids) WITH ORDINALITY AS slot(pet_id, pos) ON TRUE
+    LEFT JOIN pets p ON p.id = slot.pet_id::int AND p.user_id = t.user_id
+    WHERE t.user_id = $1
+    ORDER BY slot.pos
+"""
+
 async def fetch_team(uid):
-    team_data = await fetch_one("SELECT * FROM arena_team WHERE user_id = $1", {"uid": uid})
-    if not team_data:
-        return None
-    pet_ids = json.loads(team_data["pet_ids"])
+    """Возвращает (pets, team_name). Питомцы идут в порядке слотов, stats собраны из колонок в dict."""
+    rows = await fetch_all(TEAM_QUERY, {"uid": uid})
+    if not rows:
+        return [], "Без названия"
+
+    team_name = rows[0]["team_name"] or "Без названия"
     pets = []
-    for pid in pet_ids:
-        # Fetch pet data including level and xp
-        pet = await fetch_one("SELECT id, name, rarity, class, stats, xp, level FROM pets WHERE id = $1 AND user_id = $2", {"id": pid, "uid": uid})
-        if pet:
-            pet = dict(pet)
-            pet["stats"] = pet["stats"] if isinstance(pet["stats"], dict) else json.loads(pet["stats"])
-            pets.append(pet)
-    return pets
+    for row in rows:
+        if row["id"] is None: # Пустая команда или питомец удалён/продан
+            continue
+        pet = dict(row)
+        pet.pop("team_name")
+        pet["stats"] = stats_from_row(pet)
+        pets.append(pet)
+    return pets, team_name
 
 
 @router.message(Command("join_arena"))
 async def join_arena(message: Message):
     uid = message.from_user.id
 
-    # Check and recharge energy first
-    current_energy = await check_and_recharge_energy(uid)
-    
+    # Energy is computed from the snapshot, nothing is written until it is spent
+    user_data = await get_user(uid)
+    if not user_data:
+        await message.answer("Ты ещё не зарегистрирован. Напиши /pstart!")
+        return
+    current_energy = await get_energy(uid, ARENA_ENERGY)
+
     if current_energy < 1:
-        user_data = await fetch_one("SELECT last_arena_energy_recharge FROM users WHERE user_id = $1", {"uid": uid})
-        # Calculate time until next energy point
-        last_recharge = user_data["last_arena_energy_recharge"]
-        if isinstance(last_recharge, str):
-            try:
-                last_recharge = datetime.fromisoformat(last_recharge)
-            except ValueError:
-                 print(f"Warning: Could not parse last_recharge_time '{last_recharge}'. Assuming now for display.")
-                 last_recharge = datetime.now()
-
-        next_recharge_at = last_recharge + timedelta(minutes=ENERGY_RECHARGE_TIME_MINUTES * (ARENA_MAX_ENERGY - current_energy))
-        time_left = next_recharge_at - datetime.now()
-        
-        minutes_left = int(time_left.total_seconds() // 60)
-        seconds_left = int(time_left.total_seconds() % 60)
+        time_left = seconds_until(user_data, ARENA_ENERGY, 1)
+        minutes_left = time_left // 60
+        seconds_left = time_left % 60
 
         await message.answer(f"⚡ У тебя недостаточно энергии для арены ({current_energy}/{ARENA_MAX_ENERGY}).\n"
                              f"Следующая энергия восстановится через {minutes_left} мин {seconds_left} сек.")
         return
 
-    if uid in arena_queue:
+    if await arena_matchmaking.is_queued(uid):
         await message.answer("⏳ Ты уже в очереди на арену.")
         return
+
+    # Команду проверяем сразу: по её силе подбирается соперник
+    team, _ = await fetch_team(uid)
+    if not team:
+        await message.answer("У тебя нет активной команды для арены. Выбери команду с помощью /team.")
+        return
     
-    user_data_for_coins = await fetch_one("SELECT coins FROM users WHERE user_id = $1", {"uid": uid})
-    if user_data_for_coins.get("coins", 0) < ARENA_JOIN_COST:
+    if user_data.get("coins", 0) < ARENA_JOIN_COST:
         await message.answer(f"💰 У тебя недостаточно петкойнов, чтобы вступить на арену. Необходимо {ARENA_JOIN_COST} петкойнов.")
         return
-    
-    # Deduct energy
-    new_energy = current_energy - 1
-    await execute_query("UPDATE users SET arena_energy = $1, last_arena_energy_recharge = NOW() WHERE user_id = $2",
-                        {"arena_energy": new_energy, "uid": uid})
-
-    arena_queue.append(uid)
-    await message.answer(f"✅ Ты записался в очередь на арену! Ожидай начала битвы...\n⚡ Энергия: {new_energy}/{ARENA_MAX_ENERGY}\n💰 Списано {ARENA_JOIN_COST} петкойнов.")
 
-    # Start the matching process only if this is the first player to join the queue
-    # This prevents multiple `asyncio.sleep` calls and battle loops
-    if len(arena_queue) == 1:
-        await asyncio.sleep(30) # Wait for 30 seconds for more players
-        
-        # After waiting, check if there are still players in the queue
-        if not arena_queue:
-            return # Queue became empty, no battles to run
-
-        # Take all current players from the queue
-        players_in_session = arena_queue.copy()
-        arena_queue.clear() # Clear the queue for the next batch
+    # Энергия списывается до постановки в очередь: две параллельные /join_arena не потратят одну единицу
+    new_energy = await spend_energy(uid, ARENA_ENERGY, 1)
+    if new_energy is None:
+        await message.answer(f"⚡ У тебя недостаточно энергии для арены (0/{ARENA_MAX_ENERGY}).")
+        return
 
-        random.shuffle(players_in_session)
-        pairs = []
+    if not await arena_matchmaking.enqueue(uid, calculate_power(team)):
+        await restore_energy(uid, ARENA_ENERGY, 1) # В очередь не попали — энергию возвращаем
+        await message.answer("⏳ Ты уже в очереди на арену.")
+        return
 
-        while len(players_in_session) >= 2:
-            a, b = players_in_session.pop(), players_in_session.pop()
-            pairs.append((a, b))
-        
-        if players_in_session:
-            # If there's an odd number, the last player fights a bot
-            pairs.append((players_in_session[0], None))
-
-        for p1, p2 in pairs:
-            # Check if player has enough team selected before starting battle
-            team1 = await fetch_team(p1)
-            if not team1:
-                await message.bot.send_message(p1, "У тебя нет активной команды для арены. Выбери команду с помощью /team.")
-                continue # Skip this player if they don't have a team
-
-            if p2: # If opponent is another player
-                team2 = await fetch_team(p2)
-                if not team2:
-                    await message.bot.send_message(p2, "У тебя нет активной команды для арены. Выбери команду с помощью /team.")
-                    # If opponent doesn't have a team, the first player (p1) fights a bot
-                    await run_battle(message, p1, None)
-                    continue
-            
-            # Run the battle
-            await run_battle(message, p1, p2)
-            await asyncio.sleep(1) # Small delay between battles
-
-# --- NEW: Pet Level Up Logic ---
-async def check_and_level_up_pet(bot_instance, uid: int, pet_id: int): # Add bot_instance here
-    pet = await fetch_one("SELECT xp, level, stats, name FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "uid": uid})
-    if not pet:
-        return False
-
-    current_xp = pet["xp"]
-    current_level = pet["level"]
-    pet_stats = pet["stats"] if isinstance(pet["stats"], dict) else json.loads(pet["stats"])
+    # Подбор соперника и сам бой проводит фоновая задача матчмейкинга, хендлер сразу освобождается
+    await message.answer(f"✅ Ты записался в очередь на арену! Ожидай начала битвы...\n⚡ Энергия: {new_energy}/{ARENA_MAX_ENERGY}\n💰 Списано {ARENA_JOIN_COST} петкойнов.")
 
+def start_arena_matchmaking(bot):
+    """Запускает фоновый матчмейкинг. Вызывается один раз из main.py, возвращённую задачу main.py хранит и отменяет."""
+    # Счётчики рейтинга сверяются с arena_team. Ссылка на задачу держится до её завершения:
+    # цикл событий хранит задачи слабо, и без ссылки сверку может собрать сборщик мусора
+    task = asyncio.create_task(arena_leaderboard.rebuild_score_counts())
+    _startup_tasks.add(task)
+    task.add_done_callback(_startup_tasks.discard)
+    return asyncio.create_task(arena_matchmaking.matchmaking_loop(bot, run_battle))
+
+# --- Reward settlement ---
+ARENA_REWARDS = {
+    "win": (BASE_XP_WIN, BASE_COINS_WIN),
+    "loss": (BASE_XP_LOSS, BASE_COINS_LOSS),
+    "draw": (BASE_XP_DRAW, BASE_COINS_DRAW),
+}
+ARENA_MAX_PET_LEVEL = 100
+
+def apply_level_ups(xp: int, level: int, stats: dict):
+    """Проводит все повышения уровня для накопленного XP. Возвращает (xp, level, stats, leveled_up)."""
     leveled_up = False
-    # Assuming get_xp_for_next_level is defined elsewhere in this file
-    while current_xp >= get_xp_for_next_level(current_level):
-        xp_needed = get_xp_for_next_level(current_level)
-        current_xp -= xp_needed # Subtract the XP required for the current level
-        current_level += 1
+    while xp >= get_xp_for_next_level(level):
+        xp -= get_xp_for_next_level(level) # Subtract the XP required for the current level
+        level += 1
         leveled_up = True
-            
-            # Apply stat increases upon level up (adjust values as needed)
-        pet_stats['atk'] += random.randint(1, 3)
-        pet_stats['def'] += random.randint(1, 3)
-        pet_stats['hp'] += random.randint(3, 7)
-
-            # IMPORTANT: Update the pet in the DB *inside* the loop if it levels up.
-            # This commits each level-up step and ensures consistency if something goes wrong.
-        await execute_query(
-            "UPDATE pets SET xp = $1, level = $2, stats = $3 WHERE id = $4 AND user_id = $5",
-            {"xp": current_xp, "level": current_level, "stats": json.dumps(pet_stats), "id": pet_id, "user_id": uid}
-        )
-            
-            # Cap max level to prevent infinite loop/overpowering
-        if current_level >= 100: 
-            current_xp = 0 # Ensure XP is reset if max level reached
-            await execute_query( # Update DB one last time if max level reached and XP reset
-                "UPDATE pets SET xp = $1, level = $2 WHERE id = $3 AND user_id = $4",
-                {"xp": current_xp, "level": current_level, "id": pet_id, "user_id": uid}
-            )
+
+        # Apply stat increases upon level up (adjust values as needed)
+        stats['atk'] += random.randint(1, 3)
+        stats['def'] += random.randint(1, 3)
+        stats['hp'] += random.randint(3, 7)
+
+        # Cap max level to prevent infinite loop/overpowering
+        if level >= ARENA_MAX_PET_LEVEL:
+            xp = 0
             break
+    return xp, level, stats, leveled_up
+
+async def settle_battle_rewards(participants: list[tuple[int, list, str]]) -> list[dict]:
+    """Начисляет XP, повышения уровня, монеты и счетчик побед/поражений/ничьих
+    всем реальным участникам боя за постоянное число запросов, независимо от размера команд.
+
+    participants: [(uid, team, outcome)], outcome — "win" / "loss" / "draw".
+    Возвращает список событий повышения уровня для уведомлений (отправлять после вызова)."""
+    outcome_by_uid = {uid: outcome for uid, _, outcome in participants}
+    pet_ids = [pet["id"] for _, team, _ in participants for pet in team]
+
+    level_up_events = []
+    async with transaction() as tx:
+        # 1 запрос: блокируем всех питомцев обеих команд и читаем актуальные xp/level/stats
+        pets = await tx.fetch_all(
+            "SELECT id, user_id, name, xp, level, atk, def, hp FROM pets WHERE id = ANY($1::int[]) FOR UPDATE",
+            {"ids": pet_ids}
+        )
 
-    if leveled_up:
-        user_chat_info = await bot_instance.get_chat(uid)
-        user_name = user_chat_info.first_name if user_chat_info.first_name else user_chat_info.full_name
-            
-        await bot_instance.send_message(
-            uid,
-            f"🎉 Поздравляем, {user_name}!\nТвой питомец <b>{pet['name']}</b> достиг <b>Уровня {current_level}</b>!\n"
-            f"Новые характеристики:\n⚔ Атака: {pet_stats['atk']} | 🛡 Защита: {pet_stats['def']} | ❤️ Здоровье: {pet_stats['hp']}",
-            parse_mode="HTML"
+        upd_ids, upd_xp, upd_levels, upd_atk, upd_def, upd_hp = [], [], [], [], [], []
+        max_level_by_uid = {}
+        for pet in pets:
+            outcome = outcome_by_uid.get(pet["user_id"])
+            if outcome is None:
+                continue # Питомец сменил владельца во время боя — награда не положена
+            xp_gain, _ = ARENA_REWARDS[outcome]
+            stats = stats_from_row(pet)
+            xp, level, stats, leveled_up = apply_level_ups(pet["xp"] + xp_gain, pet["level"], stats)
+
+            upd_ids.append(pet["id"])
+            upd_xp.append(xp)
+            upd_levels.append(level)
+            upd_atk.append(stats["atk"])
+            upd_def.append(stats["def"])
+            upd_hp.append(stats["hp"])
+            max_level_by_uid[pet["user_id"]] = max(level, max_level_by_uid.get(pet["user_id"], 0))
+            if leveled_up:
+                level_up_events.append({"user_id": pet["user_id"], "pet_id": pet["id"], "name": pet["name"], "level": level, "stats": stats})
+
+        uids = [uid for uid, _, _ in participants]
+        # 1 запрос: питомцы, монеты, статистика арены и счётчики таблицы лидеров обновляются одним стейтментом
+        await tx.execute_query(
+            """
+            WITH pet_upd AS (
+                UPDATE pets p SET xp = u.xp, level = u.level, atk = u.atk, def = u.def, hp = u.hp
+                FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::int[], $6::int[]) AS u(id, xp, level, atk, def, hp)
+                WHERE p.id = u.id
+            ), user_upd AS (
+                UPDATE users us SET coins = us.coins + u.coins,
+                                    highest_pet_level = GREATEST(COALESCE(us.highest_pet_level, 0), u.max_level)
+                FROM unnest($7::bigint[], $8::int[], $9::int[]) AS u(user_id, coins, max_level)
+                WHERE us.user_id = u.user_id
+            ), arena_upd AS (
+                UPDATE arena_team a SET wins = a.wins + u.wins, losses = a.losses + u.losses, draws = a.draws + u.draws
+                FROM unnest($7::bigint[], $10::int[], $11::int[], $12::int[]) AS u(user_id, wins, losses, draws)
+                WHERE a.user_id = u.user_id
+                RETURNING a.wins, a.draws, a.losses, u.wins AS d_wins, u.draws AS d_draws, u.losses AS d_losses
+            )
+            """ + SCORE_COUNTS_UPSERT,
+            {
+                "ids": upd_ids,
+                "xp": upd_xp,
+                "levels": upd_levels,
+                "atk": upd_atk,
+                "def": upd_def,
+                "hp": upd_hp,
+                "uids": uids,
+                "coins": [ARENA_REWARDS[outcome_by_uid[uid]][1] for uid in uids],
+                "max_levels": [max_level_by_uid.get(uid, 0) for uid in uids],
+                "wins": [int(outcome_by_uid[uid] == "win") for uid in uids],
+                "losses": [int(outcome_by_uid[uid] == "loss") for uid in uids],
+                "draws": [int(outcome_by_uid[uid] == "draw") for uid in uids],
+            }
         )
-    return leveled_up
+    invalidate_users(uids) # Монеты и highest_pet_level участников изменились
+    return level_up_events
 
-async def fetch_team(uid):
-    team_data = await fetch_one("SELECT * FROM arena_team WHERE user_id = $1", {"uid": uid})
-    if not team_data:
-        return None, "Без названия" # Return default name if no team data
-    
-    pet_ids = json.loads(team_data.get("pet_ids", "[]")) # Ensure pet_ids defaults to empty list
-    team_name = team_data.get("team_name", "Без названия") # Fetch team name
-    
-    pets = []
-    for pid in pet_ids:
-        pet = await fetch_one("SELECT id, name, rarity, class, stats, xp, level FROM pets WHERE id = $1 AND user_id = $2", {"id": pid, "uid": uid})
-        if pet:
-            # Convert to dict and parse stats JSON if necessary
-            pet_dict = dict(pet)
-            if 'stats' in pet_dict and isinstance(pet_dict['stats'], str):
-                pet_dict['stats'] = json.loads(pet_dict['stats'])
-            pets.append(pet_dict)
-    return pets, team_name
+async def notify_arena_level_ups(bot_instance, level_up_events: list[dict]):
+    names = await get_display_names([event["user_id"] for event in level_up_events])
+    for event in level_up_events:
+        try:
+            user_name = names[event["user_id"]]
+            stats = event["stats"]
+            await bot_instance.send_message(
+                event["user_id"],
+                f"🎉 Поздравляем, {user_name}!\nТвой питомец <b>{event['name']}</b> достиг <b>Уровня {event['level']}</b>!\n"
+                f"Новые характеристики:\n⚔ Атака: {stats['atk']} | 🛡 Защита: {stats['def']} | ❤️ Здоровье: {stats['hp']}",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            print(f"Failed to send level up notification to {event['user_id']}: {e}")
 
 # NEW: List of funny bot team names
 BOT_TEAM_NAMES = [
@@ -561,18 +539,22 @@ BOT_TEAM_NAMES = [
     "Токсичные Леди"
 ]
 
-async def run_battle(message: Message, uid1, uid2):
+def render_attack(attack: str, attacker_name: str, attacker_pet: str, defender_name: str, defender_pet: str) -> str:
+    if attack == ATTACK_MISS:
+        return f"❌ {attacker_name}'s {attacker_pet} промахнулся по {defender_pet}!\n"
+    if attack == ATTACK_CRIT:
+        return f"💥 {attacker_name}'s {attacker_pet} наносит критический удар по {defender_pet}!\n"
+    if attack == ATTACK_HIT:
+        return f"✅ {attacker_name}'s {attacker_pet} пробивает защиту {defender_pet}!\n"
+    return f"🛡 {defender_name}'s {defender_pet} отбивает атаку {attacker_pet}!\n"
+
+async def run_battle(bot, uid1, uid2):
     team1, team_name1 = await fetch_team(uid1)
     if not team1:
-        await message.bot.send_message(uid1, "У тебя нет активной команды для арены. Выбери команду с помощью /team.")
+        await bot.send_message(uid1, "У тебя нет активной команды для арены. Выбери команду с помощью /team.")
         return
 
-    user1 = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid1})
-    try:
-        chat = await message.bot.get_chat(uid1)
-        name1 = chat.first_name if chat.first_name else chat.full_name
-    except Exception:
-        name1 = f"Игрок {uid1}"
+    name1 = await get_display_name(uid1)
 
     power1 = calculate_power(team1)
 
@@ -601,114 +583,37 @@ async def run_battle(message: Message, uid1, uid2):
             is_bot = True 
             name2 = random.choice(fake_names)
             team_name2 = random.choice(BOT_TEAM_NAMES)
-            TARGET_BOT_POWER_RATIO_MIN = 0.8 # Бот будет иметь минимум 80% силы игрока
-            TARGET_BOT_POWER_RATIO_MAX = 1.0 # Бот будет иметь максимум 100% силы игрока
-            target_bot_power = int(power1 * random.uniform(TARGET_BOT_POWER_RATIO_MIN, TARGET_BOT_POWER_RATIO_MAX))
-            num_bot_pets = len(team1) 
-            avg_pet_target_power = target_bot_power / num_bot_pets
-            team2 = []
-            for _ in range(num_bot_pets):
-                base_atk = max(1, int(avg_pet_target_power * random.uniform(0.3, 0.4))) # Например, 30-40% от средней силы
-                base_def = max(1, int(avg_pet_target_power * random.uniform(0.3, 0.4)))
-                base_hp = max(1, int(avg_pet_target_power * random.uniform(0.4, 0.5))) # HP обычно больше
-                team2.append({
-                    "name": random.choice(["Кот", "Пёс", "Лиса", "Бобр", "Дракон", "Волк", "Медведь", "Пантера", "Орел", "Змея"]),
-                    "stats": {
-                        "atk": max(5, int(base_atk * random.uniform(0.9, 1.1))), # +/- 10% от базы
-                        "def": max(5, int(base_def * random.uniform(0.9, 1.1))),
-                        "hp": max(15, int(base_hp * random.uniform(0.9, 1.1)))
-                    }
-                })
+            team2 = generate_bot_team(power1, len(team1))
         else: 
-            user2 = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid2})
-            try:
-                chat = await message.bot.get_chat(uid2)
-                name2 = chat.first_name if chat.first_name else chat.full_name
-            except Exception:
-                name2 = f"Игрок {uid2}"
+            name2 = await get_display_name(uid2)
             power2 = calculate_power(team2)
     else: # Если uid2 == None, это всегда бой с ботом
         is_bot = True
         name2 = random.choice(fake_names)
         team_name2 = random.choice(BOT_TEAM_NAMES)
         
-        # --- ИЗМЕНЕНИЯ ЗДЕСЬ (дублируем логику генерации бота) ---
-        TARGET_BOT_POWER_RATIO_MIN = 0.8
-        TARGET_BOT_POWER_RATIO_MAX = 1.0
-        
-        target_bot_power = int(power1 * random.uniform(TARGET_BOT_POWER_RATIO_MIN, TARGET_BOT_POWER_RATIO_MAX))
-        num_bot_pets = len(team1) 
-        avg_pet_target_power = target_bot_power / num_bot_pets
-        
-        team2 = []
-        for _ in range(num_bot_pets):
-            base_atk = max(1, int(avg_pet_target_power * random.uniform(0.3, 0.4)))
-            base_def = max(1, int(avg_pet_target_power * random.uniform(0.3, 0.4)))
-            base_hp = max(1, int(avg_pet_target_power * random.uniform(0.4, 0.5)))
-            team2.append({
-                "name": random.choice(["Кот", "Пёс", "Лиса", "Бобр", "Дракон", "Волк", "Медведь", "Пантера", "Орел", "Змея"]),
-                "stats": {
-                    "atk": max(5, int(base_atk * random.uniform(0.9, 1.1))),
-                    "def": max(5, int(base_def * random.uniform(0.9, 1.1))),
-                    "hp": max(15, int(base_hp * random.uniform(0.9, 1.1)))
-                }
-            })
+        team2 = generate_bot_team(power1, len(team1))
     power2 = calculate_power(team2)
 
-    msg = await send_battle_intro(message, name1, team_name1, power1, name2, team_name2, power2)
+    msg = await send_battle_intro(bot, uid1, name1, team_name1, power1, name2, team_name2, power2)
 
-    wins1, wins2 = 0, 0
-    
-    num_rounds = min(len(team1), len(team2))
+    # Бой считается целиком заранее, дальше только показываем раунды
+    battle = simulate_arena_battle(team1, team2)
 
-    for i in range(num_rounds):
+    for battle_round in battle.rounds:
+        i = battle_round.index - 1
         p1_pet = team1[i]
         p2_pet = team2[i]
         
-        current_round_log = f"<b>Раунд {i+1}:</b>\n🐾 {name1}'s {p1_pet['name']} (ATK: {p1_pet['stats']['atk']}) VS {name2}'s {p2_pet['name']} (DEF: {p2_pet['stats']['def']})\n"
-
-        # Player 1's pet attacks Player 2's pet
-        crit_p1 = random.random() < 0.15
-        miss_p1 = random.random() < 0.1
-
-        if miss_p1:
-            current_round_log += f"❌ {name1}'s {p1_pet['name']} промахнулся по {p2_pet['name']}!\n"
-            winner_round_p1 = False
-        elif p1_pet["stats"]["atk"] > p2_pet["stats"]["def"] or crit_p1:
-            if crit_p1:
-                current_round_log += f"💥 {name1}'s {p1_pet['name']} наносит критический удар по {p2_pet['name']}!\n"
-            else:
-                current_round_log += f"✅ {name1}'s {p1_pet['name']} пробивает защиту {p2_pet['name']}!\n"
-            winner_round_p1 = True
-        else:
-            current_round_log += f"🛡 {name2}'s {p2_pet['name']} отбивает атаку {p1_pet['name']}!\n"
-            winner_round_p1 = False
-
-        # Player 2's pet attacks Player 1's pet (if player 1 didn't miss)
-        crit_p2 = random.random() < 0.15
-        miss_p2 = random.random() < 0.1
-        
-        if miss_p2:
-            current_round_log += f"❌ {name2}'s {p2_pet['name']} промахнулся по {p1_pet['name']}!\n"
-            winner_round_p2 = False
-        elif p2_pet["stats"]["atk"] > p1_pet["stats"]["def"] or crit_p2:
-            if crit_p2:
-                current_round_log += f"💥 {name2}'s {p2_pet['name']} наносит критический удар по {p1_pet['name']}!\n"
-            else:
-                current_round_log += f"✅ {name2}'s {p2_pet['name']} пробивает защиту {p1_pet['name']}!\n"
-            winner_round_p2 = True
-        else:
-            current_round_log += f"🛡 {name1}'s {p1_pet['name']} отбивает атаку {p2_pet['name']}!\n"
-            winner_round_p2 = False
+        current_round_log = f"<b>Раунд {battle_round.index}:</b>\n🐾 {name1}'s {p1_pet['name']} (ATK: {p1_pet['stats']['atk']}) VS {name2}'s {p2_pet['name']} (DEF: {p2_pet['stats']['def']})\n"
+        current_round_log += render_attack(battle_round.attack1, name1, p1_pet['name'], name2, p2_pet['name'])
+        current_round_log += render_attack(battle_round.attack2, name2, p2_pet['name'], name1, p1_pet['name'])
 
-        # Determine round winner based on combined outcomes
-        if winner_round_p1 and not winner_round_p2:
-            wins1 += 1
+        if battle_round.winner == 1:
             current_round_log += f"➡️ {name1}'s {p1_pet['name']} выигрывает раунд!\n"
-        elif winner_round_p2 and not winner_round_p1:
-            wins2 += 1
+        elif battle_round.winner == 2:
             current_round_log += f"➡️ {name2}'s {p2_pet['name']} выигрывает раунд!\n"
-        elif winner_round_p1 and winner_round_p2:
+        elif battle_round.attack1 in (ATTACK_CRIT, ATTACK_HIT):
             current_round_log += "➡️ Оба питомца нанесли урон! Ничья в раунде.\n"
         else:
             current_round_log += "➡️ Оба питомца не смогли нанести урон! Ничья в раунде.\n"
@@ -720,119 +625,52 @@ async def run_battle(message: Message, uid1, uid2):
                 # Fallback: if message not found for editing, send a new one
                 if "message to edit not found" in str(e).lower(): # Using .lower() for robustness
                     print(f"DEBUG: Message to edit not found in battle log update for {uid1}. Sending new message.")
-                    msg = await message.bot.send_message(uid1, f"{msg.text}\n\n{current_round_log}", parse_mode="HTML") # Update msg reference
+                    msg = await bot.send_message(uid1, f"{msg.text}\n\n{current_round_log}", parse_mode="HTML") # Update msg reference
                 else:
                     raise
         await asyncio.sleep(2.3)
 
-    final_result_text = ""
     # --- XP and Coin Distribution ---
-    if wins1 > wins2:
-        await execute_query("UPDATE arena_team SET wins = wins + 1 WHERE user_id = $1", {"uid": uid1})
+    outcome1, outcome2 = battle.outcome1, battle.outcome2
+    if outcome1 == "win":
         final_result_text = f"🏆 <b>{name1}</b> одерживает победу!"
-        
-        # Player 1 (Winner) rewards
-        coins_gain1 = BASE_COINS_WIN
-        xp_gain1 = BASE_XP_WIN
-        for pet in team1:
-            await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                {"xp_gain": xp_gain1, "id": pet["id"], "user_id": uid1})
-            await check_and_level_up_pet(message.bot, uid1, pet["id"]) # Check for level up after XP
-        await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                            {"coins_gain": coins_gain1, "uid": uid1})
-        final_result_text += f"\n+{xp_gain1} XP каждому питомцу | +{coins_gain1} 💰"
-
-        if not is_bot:
-            # Player 2 (Loser) rewards
-            await execute_query("UPDATE arena_team SET losses = losses + 1 WHERE user_id = $1", {"uid": uid2})
-            coins_gain2 = BASE_COINS_LOSS
-            xp_gain2 = BASE_XP_LOSS
-            for pet in team2:
-                await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                    {"xp_gain": xp_gain2, "id": pet["id"], "user_id": uid2})
-                await check_and_level_up_pet(message.bot, uid2, pet["id"]) # Check for level up after XP
-            await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                                {"coins_gain": coins_gain2, "uid": uid2})
-            # Send message to losing player as well
-            await message.bot.send_message(
-                uid2,
-                f"💀 Ты проиграл битву против {name1}!\n"
-                f"+{xp_gain2} XP каждому питомцу | +{coins_gain2} 💰",
-                parse_mode="HTML"
-            )
-
-    elif wins2 > wins1:
-        await execute_query("UPDATE arena_team SET losses = losses + 1 WHERE user_id = $1", {"uid": uid1})
+    elif outcome1 == "loss":
         final_result_text = f"💀 <b>{name2}</b> одерживает победу!"
-
-        # Player 1 (Loser) rewards
-        coins_gain1 = BASE_COINS_LOSS
-        xp_gain1 = BASE_XP_LOSS
-        for pet in team1:
-            await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                {"xp_gain": xp_gain1, "id": pet["id"], "user_id": uid1})
-            await check_and_level_up_pet(message.bot, uid1, pet["id"]) # Check for level up after XP
-        await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                            {"coins_gain": coins_gain1, "uid": uid1})
-        final_result_text += f"\n+{xp_gain1} XP каждому питомцу | +{coins_gain1} 💰"
-
-        if not is_bot:
-            # Player 2 (Winner) rewards
-            await execute_query("UPDATE arena_team SET wins = wins + 1 WHERE user_id = $1", {"uid": uid2})
-            coins_gain2 = BASE_COINS_WIN
-            xp_gain2 = BASE_XP_WIN
-            for pet in team2:
-                await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                    {"xp_gain": xp_gain2, "id": pet["id"], "user_id": uid2})
-                await check_and_level_up_pet(message.bot, uid2, pet["id"]) # Check for level up after XP
-            await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                                {"coins_gain": coins_gain2, "uid": uid2})
-            # Send message to winning player as well
-            await message.bot.send_message(
-                uid2,
-                f"🏆 Ты выиграл битву против {name1}!\n"
-                f"+{xp_gain2} XP каждому питомцу | +{coins_gain2} 💰",
-                parse_mode="HTML"
-            )
-        else: # Bot wins against player, "bot gains" for flavor
-            final_result_text += f"\n{name2} получает +{BASE_XP_WIN} XP и +{BASE_COINS_WIN} 💰"
-
     else: # Draw
         final_result_text = "🤝 <b>Ничья!</b> Оба игрока показали себя достойно."
-        await execute_query("UPDATE arena_team SET draws = draws + 1 WHERE user_id = $1", {"uid": uid1})
-        
-        # Player 1 (Draw) rewards
-        coins_gain1 = BASE_COINS_DRAW
-        xp_gain1 = BASE_XP_DRAW
-        for pet in team1:
-            await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                {"xp_gain": xp_gain1, "id": pet["id"], "user_id": uid1})
-            await check_and_level_up_pet(message.bot, uid1, pet["id"]) # Check for level up after XP
-        await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                            {"coins_gain": coins_gain1, "uid": uid1})
-        final_result_text += f"\n+{xp_gain1} XP каждому питомцу | +{coins_gain1} 💰"
-
-        if not is_bot:
-            # Player 2 (Draw) rewards
-            await execute_query("UPDATE arena_team SET draws = draws + 1 WHERE user_id = $1", {"uid": uid2})
-            coins_gain2 = BASE_COINS_DRAW
-            xp_gain2 = BASE_XP_DRAW
-            for pet in team2:
-                await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                                    {"xp_gain": xp_gain2, "id": pet["id"], "user_id": uid2})
-                await check_and_level_up_pet(message.bot, uid2, pet["id"]) # Check for level up after XP
-            await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2",
-                                {"coins_gain": coins_gain2, "uid": uid2})
-            # Send message to other player as well
-            await message.bot.send_message(
-                uid2,
-                f"🤝 Ничья в битве против {name1}!\n"
-                f"+{xp_gain2} XP каждому питомцу | +{coins_gain2} 💰",
-                parse_mode="HTML"
-            )
-        else: # Bot draws against player, "bot gains" for flavor
-            final_result_text += f"\nБот {name2} получает +{BASE_XP_DRAW} XP и +{BASE_COINS_DRAW} 💰 (виртуально)"
 
+    participants = [(uid1, team1, outcome1)]
+    if not is_bot:
+        participants.append((uid2, team2, outcome2))
+    level_up_events = await settle_battle_rewards(participants)
+
+    xp_gain1, coins_gain1 = ARENA_REWARDS[outcome1]
+    final_result_text += f"\n+{xp_gain1} XP каждому питомцу | +{coins_gain1} 💰"
+
+    if not is_bot:
+        xp_gain2, coins_gain2 = ARENA_REWARDS[outcome2]
+        opponent_header = {
+            "win": f"🏆 Ты выиграл битву против {name1}!",
+            "loss": f"💀 Ты проиграл битву против {name1}!",
+            "draw": f"🤝 Ничья в битве против {name1}!",
+        }[outcome2]
+        await bot.send_message(
+            uid2,
+            f"{opponent_header}\n"
+            f"+{xp_gain2} XP каждому питомцу | +{coins_gain2} 💰",
+            parse_mode="HTML"
+        )
+    elif outcome2 == "win": # Bot wins against player, "bot gains" for flavor
+        final_result_text += f"\n{name2} получает +{BASE_XP_WIN} XP и +{BASE_COINS_WIN} 💰"
+    elif outcome2 == "draw": # Bot draws against player, "bot gains" for flavor
+        final_result_text += f"\nБот {name2} получает +{BASE_XP_DRAW} XP и +{BASE_COINS_DRAW} 💰 (виртуально)"
+
+    await notify_arena_level_ups(bot, level_up_events)
+    await emit_quest_events(
+        [QuestEvent(uid, WIN_ARENA_BATTLES) for uid, _, outcome in participants if outcome == "win"]
+        + [QuestEvent(event["user_id"], REACH_PET_LEVEL, event["level"]) for event in level_up_events],
+        bot
+    )
 
     await asyncio.sleep(2)
     try:
@@ -842,36 +680,32 @@ async def run_battle(message: Message, uid1, uid2):
             # Fallback for "message to edit not found" for final result
             if "message to edit not found" in str(e).lower():
                 print(f"DEBUG: Message to edit not found for final result for {uid1}. Sending new message.")
-                await message.bot.send_message(uid1, f"{msg.text}\n\n{final_result_text}", parse_mode="HTML")
+                await bot.send_message(uid1, f"{msg.text}\n\n{final_result_text}", parse_mode="HTML")
             else:
                 raise
 
-async def send_battle_intro(message: Message, name1: str, team_name1: str, power1: int, name2: str, team_name2: str, power2: int):
+async def send_battle_intro(bot, chat_id: int, name1: str, team_name1: str, power1: int, name2: str, team_name2: str, power2: int):
     text = (
         f"⚔️ <b>Битва начинается!</b>\n"
         f"👤 {name1} (Команда: <b>{team_name1}</b>) — Сила: {power1}\n"
         f"🆚\n"
         f"👤 {name2} (Команда: <b>{team_name2}</b>) — Сила: {power2}"
     )
-    return await message.answer(text, parse_mode="HTML")
+    return await bot.send_message(chat_id, text, parse_mode="HTML")
 
 @router.message(Command("arena_info"))
 async def arena_info(message: Message):
     uid = message.from_user.id
 
-    # Check and recharge energy before displaying info
-    current_energy = await check_and_recharge_energy(uid)
+    # Energy is computed on the fly, /arena_info writes nothing
+    current_energy = await get_energy(uid, ARENA_ENERGY)
 
     user_arena_stats = await fetch_one("SELECT * FROM arena_team WHERE user_id = $1", {"uid": uid})
     if not user_arena_stats:
         await message.answer("Ты ещё не участвуешь в арене. Напиши /team чтобы собрать команду.")
         return
 
-    try:
-        chat = await message.bot.get_chat(uid)
-        username = chat.username if chat.username else chat.full_name # Prefer username if available
-    except Exception:
-        username = f"user{uid}"
+    username = message.from_user.username or message.from_user.full_name # Prefer username if available
     
     wins = user_arena_stats.get("wins", 0)
     losses = user_arena_stats.get("losses", 0)
@@ -879,32 +713,16 @@ async def arena_info(message: Message):
     team_name = user_arena_stats.get("team_name")
     rank = get_rank(wins)
 
-    top_users = await fetch_all("""
-        SELECT u.user_id, a.wins, a.losses, a.draws FROM arena_team a
-        JOIN users u ON u.user_id = a.user_id
-        WHERE u.user_id != 0
-        ORDER BY a.wins DESC, a.draws DESC, a.losses ASC
-        LIMIT 10
-    """)
-
-    leaderboard = ""
-    for idx, u in enumerate(top_users):
-        try:
-            chat = await message.bot.get_chat(u["user_id"])
-            # Use first_name if username not available, then fallback to user{id}
-            uname = chat.username or chat.first_name or f"user{u['user_id']}"
-        except Exception:
-            uname = f"user{u['user_id']}"
-        leaderboard += f"{idx+1}. {uname} — 🏆 {u['wins']} | 💀 {u['losses']} | 🤝 {u['draws']}\n"
-
-    if not leaderboard:
-        leaderboard = "Пока никого нет..."
+    position, total_ranked = await arena_leaderboard.get_position(wins, draws, losses)
+    position_text = f"{position} из {total_ranked}" if position else "нет боёв"
+    leaderboard = await arena_leaderboard.get_top_block()
 
     text = (
         f"🏟️ <b>Арена: статус игрока</b>\n\n"
         f"⚡ Энергия: <b>{current_energy}/{ARENA_MAX_ENERGY}</b>\n" # Display energy
         f"👤 Игрок: <b>{username}</b> (Команда - {team_name})\n"
         f"🔰 Ранг: <b>{rank}</b>\n"
+        f"📈 Место в рейтинге: <b>{position_text}</b>\n"
         f"🏆 Победы: <b>{wins}</b>\n"
         f"💀 Поражения: <b>{losses}</b>\n"
         f"🤝 Ничьи: <b>{draws}</b>\n\n"
@@ -2,7 +2,6 @@
 
 import asyncio
 import random
-import json
 from datetime import datetime, timedelta, timezone
 
 from aiogram import Router, F
@@ -11,8 +10,13 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 
-from db.db import fetch_one, fetch_all, execute_query
+from db.db import fetch_one, fetch_all, execute_query, transaction
 from bot.utils.pet_generator import EGG_TYPES # Для получения инфо о яйцах
+from bot.utils.display_names import get_display_name, get_user_names
+from bot.utils.pet_query import stats_from_row
+from bot.utils.egg_inventory import add_eggs
+from bot.utils.quest_engine import QuestEvent, COLLECT_EGGS, REACH_PET_LEVEL, emit_quest_events
+from bot.utils.user_snapshot import get_user, update_cached_user, invalidate_user
 
 router = Router()
 
@@ -33,72 +37,94 @@ TOP_PET_NICKNAMES = [
     "Просто Красавчик", "Величайший из Великих"
 ]
 
-current_top_pet = {
-    "pet_id": None,
-    "user_id": None,
-    "nickname": None,
-    "ends_at": None # datetime object
-}
+TOP_PET_RANDOM_PROBES = 8 # Попыток попасть случайным id в существующего питомца
+TOP_PET_CHECK_INTERVAL_SECONDS = 3600 # Фоновая задача просыпается не реже этого
+
+# Текущая строка top_pet. Перечитывается из БД, только когда её срок истёк
+_top_pet_cache = {"row": None}
+
+# Выбор и награда — один стейтмент. Upsert срабатывает, только если срок прежнего питомца истёк:
+# из нескольких воркеров победителя запишет и наградит ровно один, остальные получат пустой результат
+SELECT_TOP_PET_QUERY = """
+    WITH chosen AS (
+        INSERT INTO top_pet (slot, pet_id, user_id, pet_name, rarity, level, nickname, selected_at, ends_at)
+        VALUES (1, $1, $2, $3, $4, $5, $6, NOW(), NOW() + make_interval(hours => $7))
+        ON CONFLICT (slot) DO UPDATE SET
+            pet_id = EXCLUDED.pet_id, user_id = EXCLUDED.user_id, pet_name = EXCLUDED.pet_name,
+            rarity = EXCLUDED.rarity, level = EXCLUDED.level, nickname = EXCLUDED.nickname,
+            selected_at = EXCLUDED.selected_at, ends_at = EXCLUDED.ends_at
+        WHERE top_pet.ends_at <= NOW()
+        RETURNING *
+    ), rewarded AS (
+        UPDATE users u SET coins = u.coins + $8 FROM chosen WHERE u.user_id = chosen.user_id
+    )
+    SELECT * FROM chosen
+"""
 
 def get_xp_for_next_level(level: int) -> int:
     """Возвращает количество XP, необходимое для перехода на следующий уровень."""
     return level * 100 + 50
 
-async def update_pet_stats_and_xp(bot_instance, user_id: int, pet_id: int, xp_gain: int = 0): # Добавили bot_instance и user_id
-    pet_record = await fetch_one("SELECT id, name, stats, xp, level FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
+async def apply_pet_xp(tx, user_id: int, pet_id: int, xp_gain: int = 0):
+    """Начисляет XP и проводит повышения уровня внутри переданной транзакции.
+    Все повышения считаются в Python и записываются одним UPDATE.
+    Возвращает dict с name/level/stats/leveled_up или None, если питомец не найден."""
+    pet_record = await tx.fetch_one("SELECT id, name, atk, def, hp, xp, level FROM pets WHERE id = $1 AND user_id = $2 FOR UPDATE", {"id": pet_id, "user_id": user_id})
     if not pet_record:
-        return False
+        return None
 
-    current_xp = pet_record['xp']
     current_level = pet_record['level']
-    current_stats = json.loads(pet_record['stats']) if isinstance(pet_record['stats'], str) else pet_record['stats']
-    pet_name = pet_record['name']
-
-    new_xp = current_xp + xp_gain
-    
+    current_stats = stats_from_row(pet_record)
+    new_xp = pet_record['xp'] + xp_gain
     leveled_up = False
-    original_hp = current_stats['hp']
 
     # Проверка и повышение уровня
     while new_xp >= get_xp_for_next_level(current_level):
-        xp_needed = get_xp_for_next_level(current_level)
-        new_xp -= xp_needed
+        new_xp -= get_xp_for_next_level(current_level)
         current_level += 1
         leveled_up = True
-            
+
         # Применяем увеличение статов при повышении уровня
         current_stats['atk'] += random.randint(1, 3)
         current_stats['def'] += random.randint(1, 3)
         current_stats['hp'] += random.randint(3, 7)
 
-        # Обновляем питомца в БД после каждого повышения уровня
-        await execute_query(
-            "UPDATE pets SET xp = $1, level = $2, stats = $3 WHERE id = $4 AND user_id = $5",
-            {"xp": new_xp, "level": current_level, "stats": json.dumps(current_stats), "id": pet_id, "user_id": user_id}
-        )
-        
-        await execute_query("UPDATE pets SET current_hp = $1 WHERE id = $2", {"current_hp": current_stats['hp'], "id": pet_id})
-
-        if current_level >= 100: 
-            new_xp = 0 
-            await execute_query(
-                "UPDATE pets SET xp = $1, level = $2 WHERE id = $3 AND user_id = $4",
-                {"xp": new_xp, "level": current_level, "id": pet_id, "user_id": user_id}
-            )
+        if current_level >= 100:
+            new_xp = 0
             break
-    await execute_query("UPDATE pets SET xp = $1 WHERE id = $2 AND user_id = $3", 
-                        {"xp": new_xp, "id": pet_id, "user_id": user_id})
 
     if leveled_up:
-        user_chat_info = await bot_instance.get_chat(user_id)
-        user_name = user_chat_info.first_name if user_chat_info.first_name else user_chat_info.full_name
-        
-        await bot_instance.send_message(
-            user_id,
-            f"🎉 Поздравляем, {user_name}!\nТвой питомец <b>{pet_name}</b> достиг <b>Уровня {current_level}</b>!\n"
-            f"Новые характеристики:\n⚔ Атака: {current_stats['atk']} | 🛡 Защита: {current_stats['def']} | ❤️ Здоровье: {current_stats['hp']}",
-            parse_mode="HTML"
+        await tx.execute_query(
+            "UPDATE pets SET xp = $1, level = $2, atk = $3, def = $4, hp = $5, current_hp = $5 WHERE id = $6 AND user_id = $7",
+            {"xp": new_xp, "level": current_level, "atk": current_stats['atk'], "def": current_stats['def'], "hp": current_stats['hp'], "id": pet_id, "user_id": user_id}
         )
+    else:
+        await tx.execute_query("UPDATE pets SET xp = $1 WHERE id = $2 AND user_id = $3",
+                               {"xp": new_xp, "id": pet_id, "user_id": user_id})
+
+    return {"name": pet_record['name'], "level": current_level, "stats": current_stats, "leveled_up": leveled_up}
+
+async def notify_pet_level_up(bot_instance, user_id: int, pet_info: dict):
+    """Отправляет поздравление с новым уровнем. Вызывать после COMMIT."""
+    user_name = await get_display_name(user_id)
+    stats = pet_info['stats']
+
+    await bot_instance.send_message(
+        user_id,
+        f"🎉 Поздравляем, {user_name}!\nТвой питомец <b>{pet_info['name']}</b> достиг <b>Уровня {pet_info['level']}</b>!\n"
+        f"Новые характеристики:\n⚔ Атака: {stats['atk']} | 🛡 Защита: {stats['def']} | ❤️ Здоровье: {stats['hp']}",
+        parse_mode="HTML"
+    )
+
+async def update_pet_stats_and_xp(bot_instance, user_id: int, pet_id: int, xp_gain: int = 0): # Добавили bot_instance и user_id
+    async with transaction() as tx:
+        pet_info = await apply_pet_xp(tx, user_id, pet_id, xp_gain)
+    if not pet_info:
+        return False
+
+    if pet_info['leveled_up']:
+        await notify_pet_level_up(bot_instance, user_id, pet_info)
+        await emit_quest_events([QuestEvent(user_id, REACH_PET_LEVEL, pet_info['level'])], bot_instance)
     return True
 
 
@@ -106,7 +132,7 @@ async def update_pet_stats_and_xp(bot_instance, user_id: int, pet_id: int, xp_ga
 @router.message(Command("daily"))
 async def daily_reward_cmd(message: Message):
     uid = message.from_user.id
-    user = await fetch_one("SELECT last_daily_claim, coins FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
 
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
@@ -128,6 +154,19 @@ async def daily_reward_cmd(message: Message):
         return
 
     coins_reward = random.randint(DAILY_COIN_RANGE[0], DAILY_COIN_RANGE[1])
+    # Монеты и время получения — до остальных наград. Снимок users мог устареть,
+    # поэтому кулдаун перепроверяется в самом UPDATE: награду не получить дважды
+    claimed = await execute_query(
+        "UPDATE users SET coins = coins + $1, last_daily_claim = $2 WHERE user_id = $3 "
+        "AND (last_daily_claim IS NULL OR last_daily_claim <= $4)",
+        {"coins": coins_reward, "last_daily_claim": now_utc, "uid": uid,
+         "claimed_before": now_utc - timedelta(hours=23, minutes=59)}
+    )
+    invalidate_user(uid)
+    if claimed == "UPDATE 0":
+        await message.answer("Ты уже получал ежедневную награду. Загляни позже.")
+        return
+
     user_pets_records = await fetch_all("SELECT id, name FROM pets WHERE user_id = $1", {"uid": uid})
     
     xp_reward_text = ""
@@ -145,25 +184,11 @@ async def daily_reward_cmd(message: Message):
         egg_type_key = random.choice(DAILY_EGG_TYPES)
         egg_info = EGG_TYPES[egg_type_key]
         
-        user_data_for_eggs = await fetch_one("SELECT eggs FROM users WHERE user_id = $1 FOR UPDATE", {"uid": uid})
-        current_eggs = json.loads(user_data_for_eggs['eggs']) if user_data_for_eggs['eggs'] else []
-
-        new_egg_record = {
-            "type": egg_type_key,
-            "obtained_at": datetime.utcnow().isoformat(),
-            "source": "Ежедневная награда"
-        }
-        current_eggs.append(new_egg_record)
-        await execute_query("UPDATE users SET eggs = $1 WHERE user_id = $2", {"eggs": json.dumps(current_eggs), "uid": uid})
+        await add_eggs(uid, [egg_type_key], source="Ежедневная награда")
+        await emit_quest_events([QuestEvent(uid, COLLECT_EGGS)], message.bot)
         egg_reward_text = f" и {egg_info['name_ru']} яйцо! 🥚"
         egg_obtained = True
 
-    # Обновление монет и времени последнего получения
-    await execute_query(
-        "UPDATE users SET coins = coins + $1, last_daily_claim = $2 WHERE user_id = $3",
-        {"coins": coins_reward, "last_daily_claim": now_utc, "uid": uid}
-    )
-
     await message.answer(
         f"🎁 Ты получил ежедневную награду!\n"
         f"Ты заработал <b>{coins_reward} 💰</b>{xp_reward_text}{egg_reward_text}\n\n"
@@ -179,7 +204,7 @@ async def fav_pet_cmd(message: Message, command: Command):
 
     if not args:
         # Отображение текущего любимца
-        user_data = await fetch_one("SELECT fav_pet_id, fav_pet_nickname FROM users WHERE user_id = $1", {"uid": uid})
+        user_data = await get_user(uid)
         fav_pet_id = user_data['fav_pet_id']
         fav_pet_nickname = user_data['fav_pet_nickname']
 
@@ -193,6 +218,7 @@ async def fav_pet_cmd(message: Message, command: Command):
             else:
                 # Питомец не найден, возможно, был удален. Очищаем fav_pet_id
                 await execute_query("UPDATE users SET fav_pet_id = NULL, fav_pet_nickname = NULL WHERE user_id = $1", {"uid": uid})
+                update_cached_user(uid, fav_pet_id=None, fav_pet_nickname=None)
                 await message.answer("У тебя нет любимого питомца или он был удален. Используй <code>/fav set &lt;ID питомца&gt;</code>, чтобы выбрать нового.", parse_mode="HTML")
         else:
             await message.answer("У тебя нет любимого питомца. Используй <code>/fav set &lt;ID питомца&gt;</code>, чтобы выбрать его.", parse_mode="HTML")
@@ -213,12 +239,14 @@ async def fav_pet_cmd(message: Message, command: Command):
         pet_record = await fetch_one("SELECT id, name FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": uid})
         if pet_record:
             await execute_query("UPDATE users SET fav_pet_id = $1, fav_pet_nickname = NULL WHERE user_id = $2", {"fav_pet_id": pet_id, "uid": uid})
+            update_cached_user(uid, fav_pet_id=pet_id, fav_pet_nickname=None)
             await message.answer(f"❤️ Питомец <b>{pet_record['name']}</b> теперь твой любимчик! Он получит небольшой бонус к статам в бою.", parse_mode="HTML")
         else:
             await message.answer("Питомец с таким ID не найден или не принадлежит тебе.", parse_mode="HTML")
 
     elif subcommand == "del":
         await execute_query("UPDATE users SET fav_pet_id = NULL, fav_pet_nickname = NULL WHERE user_id = $1", {"uid": uid})
+        update_cached_user(uid, fav_pet_id=None, fav_pet_nickname=None)
         await message.answer("💔 Любимый питомец удален. Теперь у тебя нет любимчика.", parse_mode="HTML")
 
     elif subcommand == "name":
@@ -231,9 +259,10 @@ async def fav_pet_cmd(message: Message, command: Command):
             await message.answer("Имя любимчика не может быть длиннее 20 символов.")
             return
 
-        user_data = await fetch_one("SELECT fav_pet_id FROM users WHERE user_id = $1", {"uid": uid})
+        user_data = await get_user(uid)
         if user_data['fav_pet_id']:
             await execute_query("UPDATE users SET fav_pet_nickname = $1 WHERE user_id = $2", {"fav_pet_nickname": new_nickname, "uid": uid})
+            update_cached_user(uid, fav_pet_nickname=new_nickname)
             await message.answer(f"Имя любимого питомца изменено на <b>{new_nickname}</b>!", parse_mode="HTML")
         else:
             await message.answer("У тебя нет выбранного любимого питомца, чтобы дать ему имя. Сначала используй <code>/fav set &lt;ID питомца&gt;</code>.", parse_mode="HTML")
@@ -242,66 +271,112 @@ async def fav_pet_cmd(message: Message, command: Command):
 
 
 # --- Питомец дня (/top_pet) ---
+async def sample_random_pet():
+    """Случайный питомец без чтения всей таблицы: MIN/MAX id берутся из индекса,
+    дальше — поиск по случайному id. Если id сильно разрежены и все попытки мимо,
+    берём ближайшего питомца с id не меньше случайного."""
+    bounds = await fetch_one("SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM pets")
+    if not bounds or bounds["min_id"] is None:
+        return None
+    for _ in range(TOP_PET_RANDOM_PROBES):
+        pet = await fetch_one("SELECT id, name, user_id, rarity, level FROM pets WHERE id = $1",
+                              {"id": random.randint(bounds["min_id"], bounds["max_id"])})
+        if pet:
+            return pet
+    return await fetch_one("SELECT id, name, user_id, rarity, level FROM pets WHERE id >= $1 ORDER BY id LIMIT 1",
+                           {"id": random.randint(bounds["min_id"], bounds["max_id"])})
+
+def top_pet_announcement(top_pet, owner_display_name: str) -> str:
+    owner_ping = f"<a href='tg://user?id={top_pet['user_id']}'>{owner_display_name}</a>"
+    return (
+        f"🌟 ВНИМАНИЕ! Выбран новый <b>Питомец Дня</b>!\n"
+        f"Почетный титул \"{top_pet['nickname']}\" получает питомец "
+        f"<b>{top_pet['pet_name']}</b> ({top_pet['rarity']}, Ур. {top_pet['level']}) "
+        f"принадлежащий пользователю {owner_ping}!\n\n"
+        f"Владелец получает {TOP_PET_COIN_REWARD} 💰, а {top_pet['pet_name']} получает {TOP_PET_XP_REWARD} XP!"
+    )
+
+async def get_top_pet(bot_instance):
+    """Текущий Питомец Дня: (строка top_pet или None, выбран ли он только что).
+    Если срок истёк — выбирает нового, начисляет награду и сообщает владельцу."""
+    now_utc = datetime.now(timezone.utc)
+    top_pet = _top_pet_cache["row"]
+    if top_pet and now_utc < top_pet["ends_at"]:
+        return top_pet, False
+
+    top_pet = await fetch_one("SELECT * FROM top_pet WHERE slot = 1")
+    if top_pet and now_utc < top_pet["ends_at"]:
+        _top_pet_cache["row"] = top_pet
+        return top_pet, False
+
+    pet = await sample_random_pet()
+    if not pet:
+        return None, False
+    chosen = await fetch_one(SELECT_TOP_PET_QUERY, {
+        "pet_id": pet["id"], "user_id": pet["user_id"], "pet_name": pet["name"], "rarity": pet["rarity"],
+        "level": pet["level"], "nickname": random.choice(TOP_PET_NICKNAMES),
+        "hours": TOP_PET_DURATION_HOURS, "coins": TOP_PET_COIN_REWARD,
+    })
+    if not chosen:
+        # Другой воркер успел выбрать раньше — берём его результат
+        top_pet = await fetch_one("SELECT * FROM top_pet WHERE slot = 1")
+        _top_pet_cache["row"] = top_pet
+        return top_pet, False
+
+    _top_pet_cache["row"] = chosen
+    invalidate_user(chosen["user_id"])
+    await update_pet_stats_and_xp(bot_instance, chosen["user_id"], chosen["pet_id"], xp_gain=TOP_PET_XP_REWARD) # Бонус XP — питомцу владельца
+    try:
+        await bot_instance.send_message(chosen["user_id"], top_pet_announcement(chosen, await get_display_name(chosen["user_id"])), parse_mode="HTML")
+    except Exception as e:
+        print(f"Не удалось сообщить {chosen['user_id']} о Питомце Дня: {e}")
+    return chosen, True
+
+async def top_pet_loop(bot):
+    """Выбирает Питомца Дня, как только истекает срок прежнего, даже если /top_pet никто не вызывает."""
+    while True:
+        delay = TOP_PET_CHECK_INTERVAL_SECONDS
+        try:
+            top_pet, _ = await get_top_pet(bot)
+            if top_pet:
+                seconds_left = (top_pet["ends_at"] - datetime.now(timezone.utc)).total_seconds()
+                delay = min(delay, max(1, seconds_left))
+        except Exception as e:
+            print(f"Ошибка при выборе Питомца Дня: {e}")
+        await asyncio.sleep(delay)
+
+def start_top_pet_job(bot):
+    """Запускает ежедневный выбор Питомца Дня. Вызывается один раз из main.py."""
+    return asyncio.create_task(top_pet_loop(bot))
+
 @router.message(Command("top_pet"))
 async def top_pet_cmd(message: Message):
     uid = message.from_user.id
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
 
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
         return
-    now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
 
-    if current_top_pet["pet_id"] and current_top_pet["ends_at"] and now_utc < current_top_pet["ends_at"]:
-        # Питомец дня уже выбран и срок не истек
-        top_pet_owner_name_record = await fetch_one("SELECT username FROM users WHERE user_id = $1", {"uid": current_top_pet['user_id']})
-        owner_name = top_pet_owner_name_record['username'] if top_pet_owner_name_record else "Неизвестный"
-        
-        await message.answer(
-            f"🌟 Питомец Дня: <b>{current_top_pet['nickname']}</b>!\n"
-            f"Этот почетный титул принадлежит питомцу пользователя @{owner_name}.\n"
-            f"Следующий Питомец Дня будет выбран через "
-            f"{int((current_top_pet['ends_at'] - now_utc).total_seconds() / 3600)} ч. "
-            f"{int(((current_top_pet['ends_at'] - now_utc).total_seconds() % 3600) / 60)} мин."
-            , parse_mode="HTML"
-        )
+    top_pet, is_new = await get_top_pet(message.bot)
+    if not top_pet:
+        await message.answer("Пока нет питомцев в системе, чтобы выбрать 'Питомца Дня'.")
         return
 
-    all_pets = await fetch_all("SELECT id, name, user_id, rarity, level FROM pets")
-    
-    if not all_pets:
-        await message.answer("Пока нет питомцев в системе, чтобы выбрать 'Питомца Дня'.")
+    if is_new:
+        await message.answer(top_pet_announcement(top_pet, await get_display_name(top_pet['user_id'])), parse_mode="HTML")
         return
-    
-    selected_pet = random.choice(all_pets)
-    selected_owner_id = selected_pet['user_id']
-    selected_pet_nickname = random.choice(TOP_PET_NICKNAMES)
-    
-    # Обновляем глобальную переменную (для простоты)
-    current_top_pet["pet_id"] = selected_pet['id']
-    current_top_pet["user_id"] = selected_owner_id
-    current_top_pet["nickname"] = selected_pet_nickname
-    current_top_pet["ends_at"] = now_utc + timedelta(hours=TOP_PET_DURATION_HOURS)
-
-    # Выдаем награду владельцу
-    await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2", {"coins": TOP_PET_COIN_REWARD, "uid": selected_owner_id})
-    await update_pet_stats_and_xp(message.bot, uid, selected_pet['id'], xp_gain=TOP_PET_XP_REWARD) # Бонус XP для питомца
-    
-    selected_owner_info = await message.bot.get_chat(selected_owner_id)
-    
-    # Определяем отображаемое имя для пинга
-    owner_display_name = selected_owner_info.first_name if selected_owner_info.first_name else selected_owner_info.full_name
-    
-    # Формируем пинг
-    owner_ping = f"<a href='tg://user?id={selected_owner_id}'>{owner_display_name}</a>"
 
+    # Питомец дня уже выбран и срок не истек
+    owner_display_name, owner_username = (await get_user_names([top_pet['user_id']]))[top_pet['user_id']]
+    owner_name = f"@{owner_username}" if owner_username else owner_display_name
+    time_left = (top_pet['ends_at'] - datetime.now(timezone.utc)).total_seconds()
 
-    announcement_text = (
-        f"🌟 ВНИМАНИЕ! Выбран новый <b>Питомец Дня</b>!\n"
-        f"Почетный титул \"{selected_pet_nickname}\" получает питомец "
-        f"<b>{selected_pet['name']}</b> ({selected_pet['rarity']}, Ур. {selected_pet['level']}) "
-        f"принадлежащий пользователю {owner_ping}!\n\n" # <-- Изменено здесь
-        f"Владелец получает {TOP_PET_COIN_REWARD} 💰, а {selected_pet['name']} получает {TOP_PET_XP_REWARD} XP!"
+    await message.answer(
+        f"🌟 Питомец Дня: <b>{top_pet['nickname']}</b>!\n"
+        f"Этот почетный титул принадлежит питомцу пользователя {owner_name}.\n"
+        f"Следующий Питомец Дня будет выбран через "
+        f"{int(time_left / 3600)} ч. "
+        f"{int((time_left % 3600) / 60)} мин."
+        , parse_mode="HTML"
     )
-    
-    await message.answer(announcement_text, parse_mode="HTML")
@@ -2,6 +2,8 @@ from aiogram import Router
 from aiogram.types import Message
 from aiogram.filters import Command
 from db.db import execute_query, fetch_one
+from bot.utils.arena_matchmaking import get_queue_metrics
+from bot.utils.user_snapshot import invalidate_user
 
 router = Router()
 
@@ -24,6 +26,7 @@ async def dev_coins(message: Message):
 
     amount = int(args[1])
     await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2", {"coins": amount, "uid": uid})
+    invalidate_user(uid)
     await message.answer(f"💰 Начислено {amount} петкойнов.")
 
 @router.message(Command("dev_xp"))
@@ -47,4 +50,20 @@ async def dev_xp(message: Message):
         return
 
     await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2", {"xp": xp_add, "id": pet_id})
-    await message.answer(f"🌟 Начислено {xp_add} XP питомцу #{pet_id}.")
\ No newline at end of file
+    await message.answer(f"🌟 Начислено {xp_add} XP питомцу #{pet_id}.")
+
+
+@router.message(Command("dev_arena_queue"))
+async def dev_arena_queue(message: Message):
+    if not is_dev(message.from_user.id):
+        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        return
+
+    m = get_queue_metrics()
+    await message.answer(
+        f"🏟️ Очередь арены: {m['depth']} игроков в {m['buckets']} корзинах\n"
+        f"⏳ Дольше всех ждёт: {m['oldest_wait']:.0f} сек\n"
+        f"📈 Среднее ожидание (последние матчи): {m['avg_recent_wait']:.1f} сек\n"
+        f"⚔ Матчей: {m['matches_total']} (с ботом: {m['bot_matches_total']})\n"
+        f"🔥 Боёв идёт сейчас: {m['running_battles']}"
+    )
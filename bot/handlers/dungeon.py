@@ -1,9 +1,8 @@
 # bot/handlers/dungeon.py
 
-import asyncio
 import random
 import json
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta, timezone
 
 from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
@@ -14,154 +13,22 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.exceptions import TelegramBadRequest # Импортируем для обработки ошибок
 
 from bot.utils.pet_generator import EGG_TYPES
-from db.db import fetch_one, fetch_all, execute_query
+from db.db import fetch_one, transaction
 from bot.handlers.eggs import create_pet_and_save # Импортируем функцию для создания питомца
-from bot.handlers.explore import MAX_ENERGY, recalculate_energy, update_user_energy_db # Импортируем функции для энергии
-from bot.utils.battle_system import simulate_battle_dungeon # <--- ИМПОРТ НОВОЙ ФУНКЦИИ
+from bot.utils.energy import MAX_ENERGY, EXPLORE_ENERGY, get_energy, spend_energy, restore_energy # Энергия общая с исследованиями
+from bot.utils.battle_system import simulate_battle_dungeon, scale_dungeon_monster # <--- ИМПОРТ НОВОЙ ФУНКЦИИ
+from bot.data.dungeons import MONSTERS, DUNGEONS
+from bot.utils.replay_streamer import start_replay
+from bot.utils.pet_query import fetch_pet_page, stats_from_row
+from bot.utils.egg_inventory import add_eggs
+from bot.utils.user_snapshot import get_user, invalidate_user
+from bot.utils.quest_engine import QuestEvent, COLLECT_EGGS, emit_quest_events
 
 router = Router()
 
-# --- КОНСТАНТЫ ДЛЯ БАЛАНСА ---
-BASE_MONSTER_HP_PER_DIFFICULTY = 10 # Базовое HP за единицу сложности
-BASE_MONSTER_ATK_PER_DIFFICULTY = 3 # Базовая Атака за единицу сложности
-BASE_MONSTER_DEF_PER_DIFFICULTY = 2 # Базовая Защита за единицу сложности
-BASE_MONSTER_XP_PER_DIFFICULTY = 5 # Базовый XP за единицу сложности
-BASE_MONSTER_COINS_PER_DIFFICULTY = 7 # Базовые Монеты за единицу сложности
-
-BOSS_MULTIPLIER_HP = 2.0 # Босс имеет в X раз больше HP
-BOSS_MULTIPLIER_ATK = 1.5 # Босс имеет в X раз больше ATK
-BOSS_MULTIPLIER_DEF = 1.5 # Босс имеет в X раз больше DEF
-BOSS_MULTIPLIER_REWARD = 2.0 # Босс дает в X раз больше наград
-
-# --- ОПРЕДЕЛЕНИЯ МОНСТРОВ ---
-MONSTERS = {
-    "лесной_волк": {
-        "name_ru": "Лесной Волк",
-        "base_hp": 30,
-        "base_atk": 10,
-        "base_def": 5,
-        "abilities": ["Быстрая атака"]
-    },
-    "древесный_голем": {
-        "name_ru": "Древесный Голем",
-        "base_hp": 50,
-        "base_atk": 8,
-        "base_def": 15,
-        "abilities": ["Каменная кожа"]
-    },
-    "огненный_элементаль": {
-        "name_ru": "Огненный Элементаль",
-        "base_hp": 40,
-        "base_atk": 18,
-        "base_def": 10,
-        "abilities": ["Горящая аура"]
-    },
-    "лавовый_гоблин": {
-        "name_ru": "Лавовый Гоблин",
-        "base_hp": 35,
-        "base_atk": 15,
-        "base_def": 7,
-        "abilities": ["Взрывной удар"]
-    },
-    "древний_зверь": {
-        "name_ru": "Древний Зверь",
-        "base_hp": 80,
-        "base_atk": 25,
-        "base_def": 15,
-        "abilities": ["Яростный рев"]
-    },
-    "повелитель_огня": {
-        "name_ru": "Повелитель Огня",
-        "base_hp": 100,
-        "base_atk": 30,
-        "base_def": 20,
-        "abilities": ["Метеоритный дождь", "Огненный щит"]
-    },
-    "ледяной_тролль": {
-        "name_ru": "Ледяной Тролль",
-        "base_hp": 70,
-        "base_atk": 20,
-        "base_def": 20,
-        "abilities": ["Ледяная броня"]
-    },
-    "снежная_фурия": {
-        "name_ru": "Снежная Фурия",
-        "base_hp": 60,
-        "base_atk": 25,
-        "base_def": 12,
-        "abilities": ["Заморозка"]
-    },
-    "призрачный_рыцарь": {
-        "name_ru": "Призрачный Рыцарь",
-        "base_hp": 90,
-        "base_atk": 30,
-        "base_def": 25,
-        "abilities": ["Неуловимость"]
-    },
-    "король_скелетов": {
-        "name_ru": "Король Скелетов",
-        "base_hp": 120,
-        "base_atk": 35,
-        "base_def": 30,
-        "abilities": ["Воскрешение"]
-    }
-}
-
-# --- ОПРЕДЕЛЕНИЯ ДАНЖЕЙ ---
-DUNGEONS = {
-    "лесное_подземелье": {
-        "name_ru": "Лесное подземелье",
-        "description": "Сложное подземелье, кишащее опасными существами. Шанс получить Крутое яйцо.",
-        "difficulty_level": 5, # Рекомендуемый уровень питомца/команды
-        "reward_egg_type": "крутое",
-        "entry_cost_energy": 50,
-        "min_pets_required": 1,
-        "duration_min": 5,
-        "duration_max": 10,
-        "monster_pool": ["лесной_волк", "древесный_голем"],
-        "num_encounters": 2,
-        "boss_monster": None
-    },
-    "огненная_пещера": {
-        "name_ru": "Огненная пещера",
-        "description": "Раскаленная пещера с древними духами огня. Шанс получить яйцо всмятку.",
-        "difficulty_level": 10,
-        "reward_egg_type": "всмятку",
-        "entry_cost_energy": 80,
-        "min_pets_required": 2,
-        "duration_min": 10,
-        "duration_max": 20,
-        "monster_pool": ["огненный_элементаль", "лавовый_гоблин"],
-        "num_encounters": 3,
-        "boss_monster": "повелитель_огня"
-    },
-    "ледяные_глубины": {
-        "name_ru": "Ледяные Глубины",
-        "description": "Замерзшие пещеры, где обитают древние ледяные существа. Шанс получить Дореволюционное яйцо.",
-        "difficulty_level": 15,
-        "reward_egg_type": "дореволюционное",
-        "entry_cost_energy": 120,
-        "min_pets_required": 3,
-        "duration_min": 15,
-        "duration_max": 25,
-        "monster_pool": ["ледяной_тролль", "снежная_фурия", "древний_зверь"],
-        "num_encounters": 4,
-        "boss_monster": "ледяной_тролль" # Можно использовать существующего монстра как босса, но с усилением
-    },
-    "забытые_катакомбы": {
-        "name_ru": "Забытые Катакомбы",
-        "description": "Темные катакомбы, полные призраков и нежити. Шанс получить яйцо Фаберже.",
-        "difficulty_level": 20,
-        "reward_egg_type": "фаберже",
-        "entry_cost_energy": 150,
-        "min_pets_required": 4,
-        "duration_min": 20,
-        "duration_max": 30,
-        "monster_pool": ["призрачный_рыцарь", "король_скелетов", "древесный_голем"], # Можно смешивать монстров
-        "num_encounters": 5,
-        "boss_monster": "король_скелетов"
-    }
-}
+# Выбор питомцев для похода: самые сильные по уровню, страница берётся из БД по индексу
+DUNGEON_PICKER_SIZE = 20
+DUNGEON_PICKER_COLUMNS = "id, name, level, rarity, atk, def, hp, current_hp"
 
 # --- FSM States ---
 class DungeonState(StatesGroup):
@@ -174,7 +41,7 @@ class DungeonState(StatesGroup):
 @router.message(Command("dungeon"))
 async def dungeon_start_cmd(message: Message, state: FSMContext):
     uid = message.from_user.id
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
 
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
@@ -219,8 +86,8 @@ async def select_dungeon_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    # Проверка энергии (перенесена на этот этап)
-    current_energy = await recalculate_energy(uid)
+    # Проверка энергии (перенесена на этот этап). Только чтение, списание — при входе в данж
+    current_energy = await get_energy(uid, EXPLORE_ENERGY)
     if current_energy < dungeon_info['entry_cost_energy']:
         if menu_message_id:
             await callback.bot.edit_message_text(
@@ -242,7 +109,7 @@ async def select_dungeon_callback(callback: CallbackQuery, state: FSMContext):
     # Сохраняем выбранный данж в FSM контексте
     await state.update_data(selected_dungeon_key=dungeon_key)
 
-    user_pets_db_records = await fetch_all("SELECT id, name, level, rarity, stats, current_hp FROM pets WHERE user_id = $1 ORDER BY level DESC, rarity DESC", {"uid": uid})
+    user_pets_db_records, _, _ = await fetch_pet_page(uid, "level", limit=DUNGEON_PICKER_SIZE, columns=DUNGEON_PICKER_COLUMNS)
     
     if not user_pets_db_records:
         if menu_message_id:
@@ -256,7 +123,7 @@ async def select_dungeon_callback(callback: CallbackQuery, state: FSMContext):
     user_pets_db = []
     for pet_record in user_pets_db_records:
         pet = dict(pet_record)
-        pet['stats'] = json.loads(pet['stats']) # Десериализуем stats
+        pet['stats'] = stats_from_row(pet)
         if pet['current_hp'] is None: 
             pet['current_hp'] = pet['stats']['hp']
         user_pets_db.append(pet)
@@ -324,12 +191,12 @@ async def toggle_pet_selection_callback(callback: CallbackQuery, state: FSMConte
     selected_dungeon_key = data.get('selected_dungeon_key')
     dungeon_info = DUNGEONS.get(selected_dungeon_key)
 
-    user_pets_db_records = await fetch_all("SELECT id, name, level, rarity, stats, current_hp FROM pets WHERE user_id = $1 ORDER BY level DESC, rarity DESC", {"uid": callback.from_user.id})
+    user_pets_db_records, _, _ = await fetch_pet_page(callback.from_user.id, "level", limit=DUNGEON_PICKER_SIZE, columns=DUNGEON_PICKER_COLUMNS)
     
     user_pets_db = []
     for pet_record in user_pets_db_records:
         pet = dict(pet_record)
-        pet['stats'] = json.loads(pet['stats']) # Десериализуем stats
+        pet['stats'] = stats_from_row(pet)
         if pet['current_hp'] is None: 
             pet['current_hp'] = pet['stats']['hp']
         user_pets_db.append(pet)
@@ -419,11 +286,11 @@ async def start_dungeon_callback(callback: CallbackQuery, state: FSMContext):
 
     selected_pets_data = []
     for pet_id in selected_pets_ids:
-        pet_record = await fetch_one("SELECT id, name, level, stats, class, rarity, current_hp FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": uid})
+        pet_record = await fetch_one("SELECT id, name, level, atk, def, hp, class, rarity, current_hp FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": uid})
         
         if pet_record:
             pet = dict(pet_record)
-            pet['stats'] = json.loads(pet['stats'])
+            pet['stats'] = stats_from_row(pet)
             if pet['current_hp'] is None:
                 pet['current_hp'] = pet['stats']['hp']
             
@@ -447,8 +314,10 @@ async def start_dungeon_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    current_energy = await recalculate_energy(uid)
-    if current_energy < dungeon_info['entry_cost_energy']:
+    # Проверка и списание — один UPDATE: два параллельных входа не потратят одну и ту же энергию
+    remaining_energy = await spend_energy(uid, EXPLORE_ENERGY, dungeon_info['entry_cost_energy'])
+    if remaining_energy is None:
+        current_energy = await get_energy(uid, EXPLORE_ENERGY)
         if menu_message_id:
             await callback.bot.edit_message_text(
                 chat_id=callback.message.chat.id, message_id=menu_message_id,
@@ -465,8 +334,7 @@ async def start_dungeon_callback(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.answer()
         return
-    
-    await update_user_energy_db(uid, current_energy - dungeon_info['entry_cost_energy'])
+
 
     # Сохраняем ID сообщения, которое будем обновлять в процессе данжа
     # Если menu_message_id существует, используем его, иначе отправляем новое
@@ -488,21 +356,27 @@ async def start_dungeon_callback(callback: CallbackQuery, state: FSMContext):
                 dungeon_status_message_id = sent_message.message_id
 
 
-    await state.update_data(
-        current_dungeon_key=selected_dungeon_key,
-        current_pets_data=selected_pets_data,
-        current_encounter_index=0,
-        dungeon_total_xp = 0,
-        dungeon_total_coins = 0,
-        dungeon_status_message_id=dungeon_status_message_id # Сохраняем ID сообщения для обновления
-    )
-    await state.set_state(DungeonState.in_dungeon_progress)
-
     await callback.answer()
-    await asyncio.sleep(random.uniform(1.0, 2.0)) # Задержка перед началом симуляции
 
-    # Передаем message_id в функцию симуляции
-    await simulate_dungeon_progress(callback.message, uid, state, dungeon_status_message_id)
+    # Весь поход считается сразу и записывается одной транзакцией, дальше — только реплей
+    run = compute_dungeon_run(dungeon_info, selected_pets_data)
+    try:
+        await persist_dungeon_run(uid, selected_dungeon_key, dungeon_info, run)
+    except Exception as e:
+        print(f"Ошибка при сохранении похода в данж для {uid}: {e}")
+        await restore_energy(uid, EXPLORE_ENERGY, dungeon_info['entry_cost_energy']) # Поход не состоялся
+        await callback.message.answer("❌ Произошла ошибка при походе в подземелье. Попробуй еще раз позже.")
+        await state.clear()
+        return
+    await state.clear()
+    if run['completed']:
+        await emit_quest_events([QuestEvent(uid, COLLECT_EGGS)], callback.bot)
+
+    frames = run['frames']
+    if run['completed']:
+        frames.append((run['summary'] + f"\nТекущая энергия: {remaining_energy}/{MAX_ENERGY}", 0))
+    start_replay(callback.bot, callback.message.chat.id, dungeon_status_message_id, frames,
+                 delay=random.uniform(1.0, 2.0)) # Задержка перед началом реплея
 
 
 @router.callback_query(F.data == "cancel_dungeon", StateFilter(DungeonState.choosing_pets))
@@ -524,191 +398,117 @@ async def cancel_dungeon_callback(callback: CallbackQuery, state: FSMContext):
 
 # --- Dungeon Simulation Logic ---
 
-# Добавляем dungeon_status_message_id как аргумент
-async def simulate_dungeon_progress(message: Message, user_id: int, state: FSMContext, dungeon_status_message_id: int):
-    data = await state.get_data()
-    dungeon_key = data['current_dungeon_key']
-    dungeon_info = DUNGEONS[dungeon_key]
-    pets_data = data['current_pets_data']
-    encounter_index = data['current_encounter_index']
-    dungeon_total_xp = data['dungeon_total_xp']
-    dungeon_total_coins = data['dungeon_total_coins']
-
+def compute_dungeon_run(dungeon_info: dict, pets_data: list) -> dict:
+    """Проводит весь поход без I/O. Возвращает кадры для реплея (текст, пауза) и итог:
+    completed, total_xp, total_coins, final_hp {pet_id: hp} и summary для успешного прохождения."""
     num_encounters_to_do = dungeon_info['num_encounters']
     if dungeon_info['boss_monster']:
         num_encounters_to_do += 1
 
-    current_output_text = "" # Буфер для текущего вывода
+    frames = []
+    dungeon_total_xp = 0
+    dungeon_total_coins = 0
+    completed = False
 
-    for i in range(encounter_index, num_encounters_to_do):
+    for i in range(num_encounters_to_do):
         if not any(pet['current_hp'] > 0 for pet in pets_data):
-            current_output_text += (
+            previous_text = frames[-1][0] if frames else ""
+            frames.append((
+                previous_text +
                 f"\n\n💀 Все ваши питомцы потеряли сознание. Поход окончен!\n"
                 f"Вы заработали: {dungeon_total_xp} XP, {dungeon_total_coins} 💰.\n"
-                f"<b>Ваши питомцы нуждаются в лечении!</b> Используйте команду <code>/heal</code>."
-            )
-            try:
-                await message.bot.edit_message_text(
-                    chat_id=message.chat.id, message_id=dungeon_status_message_id,
-                    text=current_output_text, parse_mode="HTML"
-                )
-            except TelegramBadRequest as e:
-                if "message is not modified" not in str(e):
-                    await message.answer(current_output_text, parse_mode="HTML") # Fallback
-            
-            for pet_with_damage in pets_data:
-                await execute_query(
-                    "UPDATE pets SET current_hp = $1 WHERE id = $2", 
-                    {"current_hp": max(0, pet_with_damage['current_hp']), "pet_id": pet_with_damage['id']}
-                )
-            await state.clear()
-            await asyncio.sleep(random.uniform(1.0, 2.0))
-            return
+                f"<b>Ваши питомцы нуждаются в лечении!</b> Используйте команду <code>/heal</code>.",
+                0
+            ))
+            break
 
-        monster_key = None
-        is_boss_encounter = False
         if i < dungeon_info['num_encounters']:
             monster_key = random.choice(dungeon_info['monster_pool'])
             encounter_type = "Монстр"
+            is_boss_encounter = False
         else:
             monster_key = dungeon_info['boss_monster']
             encounter_type = "БОСС"
             is_boss_encounter = True
 
-        monster_base_info = MONSTERS[monster_key]
-        
         # --- Масштабирование характеристик монстра по сложности данжа ---
-        scaled_monster_info = {
-            "name_ru": monster_base_info['name_ru'],
-            "hp": int(monster_base_info['base_hp'] + (dungeon_info['difficulty_level'] * BASE_MONSTER_HP_PER_DIFFICULTY)),
-            "atk": int(monster_base_info['base_atk'] + (dungeon_info['difficulty_level'] * BASE_MONSTER_ATK_PER_DIFFICULTY)),
-            "def": int(monster_base_info['base_def'] + (dungeon_info['difficulty_level'] * BASE_MONSTER_DEF_PER_DIFFICULTY)),
-            "xp_reward": int(monster_base_info['base_hp'] * 0.5 + (dungeon_info['difficulty_level'] * BASE_MONSTER_XP_PER_DIFFICULTY)), # XP зависит от HP и сложности
-            "coin_reward": int(monster_base_info['base_hp'] * 0.3 + (dungeon_info['difficulty_level'] * BASE_MONSTER_COINS_PER_DIFFICULTY)), # Монеты зависят от HP и сложности
-            "abilities": monster_base_info.get('abilities', [])
-        }
-
-        if is_boss_encounter:
-            scaled_monster_info['hp'] = int(scaled_monster_info['hp'] * BOSS_MULTIPLIER_HP)
-            scaled_monster_info['atk'] = int(scaled_monster_info['atk'] * BOSS_MULTIPLIER_ATK)
-            scaled_monster_info['def'] = int(scaled_monster_info['def'] * BOSS_MULTIPLIER_DEF)
-            scaled_monster_info['xp_reward'] = int(scaled_monster_info['xp_reward'] * BOSS_MULTIPLIER_REWARD)
-            scaled_monster_info['coin_reward'] = int(scaled_monster_info['coin_reward'] * BOSS_MULTIPLIER_REWARD)
-            
+        scaled_monster_info = scale_dungeon_monster(MONSTERS[monster_key], dungeon_info['difficulty_level'], is_boss_encounter)
         current_monster_name = scaled_monster_info['name_ru']
 
-        # Начинаем формировать вывод для текущей стычки
         current_output_text = f"⚡️ Ваша команда столкнулась с <b>{current_monster_name}</b> ({encounter_type})!\n"
         current_output_text += "Началась битва!\n"
 
-        # Симулируем бой, передавая масштабированные данные монстра
         battle_result = simulate_battle_dungeon(pets_data, scaled_monster_info)
-        
         if battle_result.get('battle_log'):
             # Объединяем весь лог боя в одну строку
             current_output_text += "\n".join(battle_result['battle_log']) + "\n"
+        pets_data = battle_result['updated_pets_data']
 
-        if battle_result['victory']:
-            dungeon_total_xp += battle_result['xp_gained']
-            dungeon_total_coins += battle_result['coins_gained']
-            current_output_text += (
-                f"\n🏆 Победа над <b>{current_monster_name}</b>!\n"
-                f"Получено: {battle_result['xp_gained']} XP, {battle_result['coins_gained']} 💰"
-                f"\n\nПрогресс данжа: {i + 1}/{num_encounters_to_do} стычек."
-                f"\nОбщий заработок в данже: {dungeon_total_xp} XP, {dungeon_total_coins} 💰"
-            )
-            
-            pets_data = battle_result['updated_pets_data']
-            for pet_update in pets_data:
-                await execute_query("UPDATE pets SET xp = xp + $1, current_hp = $2 WHERE id = $3", 
-                                    {"xp_gained": battle_result['xp_gained'], "current_hp": max(0, pet_update['current_hp']), "pet_id": pet_update['id']})
-                # Здесь можно добавить вызов check_and_level_up_pet, если он у вас есть
-                # await check_and_level_up_pet(message.bot, user_id, pet_update["id"])
-            
-            await state.update_data(
-                current_encounter_index=i + 1,
-                dungeon_total_xp=dungeon_total_xp,
-                dungeon_total_coins=dungeon_total_coins,
-                current_pets_data=pets_data
-            )
-
-        else:
+        if not battle_result['victory']:
             current_output_text += (
                 f"\n💀 Ваша команда потерпела поражение от <b>{current_monster_name}</b>. Поход окончен!\n"
                 f"Вы заработали: {dungeon_total_xp} XP, {dungeon_total_coins} 💰 (до поражения).\n"
                 f"<b>Ваши питомцы нуждаются в лечении!</b> Используйте команду <code>/heal</code>."
             )
-            
-            pets_data_after_loss = battle_result['updated_pets_data']
-            for pet_with_damage in pets_data_after_loss:
-                await execute_query(
-                    "UPDATE pets SET current_hp = $1 WHERE id = $2", 
-                    {"current_hp": max(0, pet_with_damage['current_hp']), "pet_id": pet_with_damage['id']}
-                )
-            await state.clear()
-            
-            try:
-                await message.bot.edit_message_text(
-                    chat_id=message.chat.id, message_id=dungeon_status_message_id,
-                    text=current_output_text, parse_mode="HTML"
-                )
-            except TelegramBadRequest as e:
-                if "message is not modified" not in str(e):
-                    await message.answer(current_output_text, parse_mode="HTML") # Fallback
-            await asyncio.sleep(random.uniform(1.0, 2.0))
-            return
-
-        # Обновляем сообщение с текущим статусом данжа
-        try:
-            await message.bot.edit_message_text(
-                chat_id=message.chat.id, message_id=dungeon_status_message_id,
-                text=current_output_text, parse_mode="HTML"
-            )
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                await message.answer(current_output_text, parse_mode="HTML") # Fallback, если редактирование не удалось
-        
-        await asyncio.sleep(random.uniform(2.0, 4.0)) # Задержка между стычками
-
-    # --- Данж успешно завершен ---
-    reward_egg_type_key = dungeon_info['reward_egg_type']
-    reward_egg_info = EGG_TYPES.get(reward_egg_type_key)
-
-    user_data_for_eggs = await fetch_one("SELECT eggs FROM users WHERE user_id = $1 FOR UPDATE", {"uid": user_id})
-    current_eggs = json.loads(user_data_for_eggs['eggs']) if user_data_for_eggs['eggs'] else []
+            frames.append((current_output_text, 0))
+            break
+
+        dungeon_total_xp += battle_result['xp_gained']
+        dungeon_total_coins += battle_result['coins_gained']
+        current_output_text += (
+            f"\n🏆 Победа над <b>{current_monster_name}</b>!\n"
+            f"Получено: {battle_result['xp_gained']} XP, {battle_result['coins_gained']} 💰"
+            f"\n\nПрогресс данжа: {i + 1}/{num_encounters_to_do} стычек."
+            f"\nОбщий заработок в данже: {dungeon_total_xp} XP, {dungeon_total_coins} 💰"
+        )
+        frames.append((current_output_text, random.uniform(2.0, 4.0))) # Задержка между стычками
+    else:
+        completed = True
 
-    new_egg_record = {
-        "type": reward_egg_type_key,
-        "obtained_at": datetime.utcnow().isoformat(),
-        "source": dungeon_info['name_ru']
+    if completed:
+        # Успешное прохождение полностью лечит команду
+        final_hp = {pet['id']: pet['stats']['hp'] for pet in pets_data}
+    else:
+        final_hp = {pet['id']: max(0, pet['current_hp']) for pet in pets_data}
+
+    reward_egg_info = EGG_TYPES.get(dungeon_info['reward_egg_type'])
+    return {
+        "frames": frames,
+        "completed": completed,
+        "total_xp": dungeon_total_xp,
+        "total_coins": dungeon_total_coins,
+        "final_hp": final_hp,
+        "summary": (
+            f"🎉 <b>Команда успешно прошла {dungeon_info['name_ru']}</b>!\n"
+            f"Общий заработок: <b>{dungeon_total_xp} XP</b> и <b>{dungeon_total_coins} 💰</b>.\n"
+            f"В награду ты получил <b>{reward_egg_info['name_ru']}</b>!\n"
+            f"Напиши /hatch, чтобы вылупить его!\n"
+        ),
     }
-    current_eggs.append(new_egg_record)
 
-    await execute_query("UPDATE users SET eggs = $1, coins = coins + $2 WHERE user_id = $3", 
-                        {"eggs": json.dumps(current_eggs), "coins": dungeon_total_coins, "uid": user_id})
-    
-    for pet_with_damage in pets_data:
-        await execute_query(
-            "UPDATE pets SET current_hp = $1 WHERE id = $2", 
-            {"current_hp": pet_with_damage['stats']['hp'], "pet_id": pet_with_damage['id']}
+async def persist_dungeon_run(user_id: int, dungeon_key: str, dungeon_info: dict, run: dict):
+    """Записывает итог похода одной транзакцией: XP и HP всех питомцев, награда за прохождение и запись в dungeon_runs."""
+    pet_ids = list(run['final_hp'])
+    async with transaction() as tx:
+        # Каждая выигранная стычка давала XP всем питомцам команды
+        await tx.execute_query(
+            "UPDATE pets SET xp = pets.xp + $1, current_hp = u.hp "
+            "FROM unnest($2::int[], $3::int[]) AS u(id, hp) "
+            "WHERE pets.id = u.id AND pets.user_id = $4",
+            {"xp": run['total_xp'], "ids": pet_ids, "hps": [run['final_hp'][pid] for pid in pet_ids], "uid": user_id}
         )
-    
-    final_summary_text = (
-        f"🎉 <b>Команда успешно прошла {dungeon_info['name_ru']}</b>!\n"
-        f"Общий заработок: <b>{dungeon_total_xp} XP</b> и <b>{dungeon_total_coins} 💰</b>.\n"
-        f"В награду ты получил <b>{reward_egg_info['name_ru']}</b>!\n"
-        f"Напиши /hatch, чтобы вылупить его!\n"
-        f"\nТекущая энергия: {await recalculate_energy(user_id)}/{MAX_ENERGY}"
-    )
-    
-    try:
-        await message.bot.edit_message_text(
-            chat_id=message.chat.id, message_id=dungeon_status_message_id,
-            text=final_summary_text, parse_mode="HTML"
+
+        if run['completed']:
+            await tx.execute_query(
+                "UPDATE users SET coins = coins + $1 WHERE user_id = $2",
+                {"coins": run['total_coins'], "uid": user_id}
+            )
+            await add_eggs(user_id, [dungeon_info['reward_egg_type']], source=dungeon_info['name_ru'], tx=tx)
+
+        await tx.execute_query(
+            "INSERT INTO dungeon_runs (user_id, dungeon_key, pet_ids, completed, total_xp, total_coins) VALUES ($1, $2, $3, $4, $5, $6)",
+            {"uid": user_id, "dungeon_key": dungeon_key, "pet_ids": json.dumps(pet_ids), "completed": run['completed'],
+             "total_xp": run['total_xp'], "total_coins": run['total_coins']}
         )
-    except TelegramBadRequest as e:
-        if "message is not modified" not in str(e):
-            await message.answer(final_summary_text, parse_mode="HTML") # Fallback
-            
-    await state.clear()
-    await asyncio.sleep(random.uniform(1.0, 2.0))
\ No newline at end of file
+    if run['completed']:
+        invalidate_user(user_id) # Снимок сбрасываем после коммита, иначе его успеют перечитать старым
@@ -1,88 +1,68 @@
-import json
 import random
-from datetime import datetime, timedelta, timezone
 from aiogram import Router, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
-from bot.handlers.start import get_zone_buff
-from db.db import fetch_one, execute_query, fetch_all
+from db.db import fetch_one, execute_query
+from bot.utils.pet_query import stats_from_row
+from bot.utils.quest_engine import QuestEvent, COLLECT_COINS, REACH_PET_LEVEL, emit_quest_events
+from bot.utils.user_snapshot import get_user, invalidate_user
 
 router = Router()
 
 COLLECT_COOLDOWN_MINUTES = 60
 
+# Весь сбор дохода — один стейтмент: бафф зоны, отбор питомцев после кулдауна,
+# сдвиг их last_collected, сумма дохода и начисление монет игроку.
+# Доход каждого питомца округляется вниз отдельно, как и раньше: FLOOR(coin_rate * бафф).
+ACCRUE_INCOME_QUERY = """
+    WITH buff AS (
+        SELECT CASE WHEN z.buff_type = 'coin_rate' THEN 1 + COALESCE(z.buff_value, 0) / 100.0 ELSE 1 END AS mult
+        FROM users u LEFT JOIN zones z ON z.name = u.active_zone
+        WHERE u.user_id = $1
+    ), due AS (
+        UPDATE pets SET last_collected = NOW()
+        WHERE user_id = $1 AND (last_collected IS NULL OR last_collected <= NOW() - make_interval(mins => $2))
+        RETURNING coin_rate
+    ), total AS (
+        SELECT COALESCE(SUM(FLOOR(COALESCE(coin_rate, 0) * COALESCE((SELECT mult FROM buff), 1))), 0)::int AS coins,
+               COUNT(*) AS pets
+        FROM due
+    ), user_upd AS (
+        UPDATE users SET coins = users.coins + total.coins, total_coins_collected = users.total_coins_collected + total.coins
+        FROM total
+        WHERE user_id = $1 AND total.pets > 0
+    )
+    SELECT coins, pets FROM total
+"""
+
+async def accrue_idle_income(uid: int):
+    """Собирает доход со всех питомцев игрока, у которых прошёл кулдаун. Возвращает (монеты, число питомцев)."""
+    row = await fetch_one(ACCRUE_INCOME_QUERY, {"uid": uid, "cooldown_minutes": COLLECT_COOLDOWN_MINUTES})
+    if row["pets"]:
+        invalidate_user(uid)
+    return row["coins"], row["pets"]
+
 @router.message(Command("collect"))
 async def collect_cmd(message: Message):
     uid = message.from_user.id
 
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
         return
 
-    pets = await fetch_all("SELECT * FROM pets WHERE user_id = $1", {"uid": uid})
-    if not pets:
-        await message.answer("У тебя пока нет питомцев 😿\nКупи яйцо через /buy_egg и выведи кого-то!")
-        return
-    
-    # buff_mult теперь будет словарем типа {'type': 'coin_rate', 'value': 5}
-    # или None, если баффа нет
-    buff_mult_data = await get_zone_buff(uid)
-    
-    now = datetime.now(timezone.utc)
-    total_collected = 0
-    updated_pets = []
-
-    for pet in pets:
-        last = pet["last_collected"]
-        if last:
-            # Ваша логика преобразования last в datetime object
-            if isinstance(last, str):
-                try:
-                    # Попытка разобрать с миллисекундами и зоной
-                    last = datetime.strptime(last, "%Y-%m-%dT%H:%M:%S.%f%z")
-                except ValueError:
-                    # Если без миллисекунд или другой формат, попробуйте другой
-                    last = datetime.fromisoformat(last)
-                last = last.astimezone(timezone.utc)
-            elif isinstance(last, datetime):
-                last = last.astimezone(timezone.utc) if last.tzinfo is None else last
-            else:
-                last = None # Если тип не строка и не datetime
-        
-        # Если last_collected не установлен или прошло достаточно времени
-        if not last or (now - last) >= timedelta(minutes=COLLECT_COOLDOWN_MINUTES):
-            # --- ИСПРАВЛЕННАЯ ЛОГИКА ПРИМЕНЕНИЯ БАФФА ---
-            buff_value = 1 # По умолчанию множитель 1 (нет баффа)
-            if buff_mult_data and buff_mult_data.get('type') == 'coin_rate':
-                # Проверяем, что buff_mult_data - это словарь, и тип баффа - 'coin_rate'
-                # и что значение - число
-                if isinstance(buff_mult_data.get('value'), (int, float)):
-                    # buff_mult_data['value'] - это процентное значение (например, 5 для +5%)
-                    buff_value = 1 + (buff_mult_data['value'] / 100) # Преобразуем процент в множитель (например, 5% -> 1.05)
-
-            income = int(pet["coin_rate"] * buff_value)
-            # --- КОНЕЦ ИСПРАВЛЕННОЙ ЛОГИКИ ПРИМЕНЕНИЯ БАФФА ---
-
-            total_collected += income
-            updated_pets.append(pet["id"])
-
-    if not updated_pets:
-        await message.answer("⏳ Ещё рано. Попробуй позже — питомцы ещё не принесли монет!")
-        return
-    
-    await execute_query(
-        "UPDATE users SET coins = coins + $1, total_coins_collected = total_coins_collected + $1 WHERE user_id = $2", # Добавил total_coins_collected
-        {"coins": total_collected, "uid": uid}
-    )
+    total_collected, collected_pets = await accrue_idle_income(uid)
 
-    for pet_id in updated_pets:
-        await execute_query(
-            "UPDATE pets SET last_collected = $1 WHERE id = $2",
-            {"last_collected": now, "id": pet_id}
-        )
+    if not collected_pets:
+        has_pets = await fetch_one("SELECT EXISTS(SELECT 1 FROM pets WHERE user_id = $1) AS has_pets", {"uid": uid})
+        if not has_pets["has_pets"]:
+            await message.answer("У тебя пока нет питомцев 😿\nКупи яйцо через /buy_egg и выведи кого-то!")
+        else:
+            await message.answer("⏳ Ещё рано. Попробуй позже — питомцы ещё не принесли монет!")
+        return
 
     await message.answer(f"💰 Ты собрал <b>{total_collected}</b> петкойнов от своих питомцев!")
+    await emit_quest_events([QuestEvent(uid, COLLECT_COINS, total_collected)], message.bot)
 
 TRAIN_COST_BASE = 50
 TRAIN_COST_PER_LEVEL = 10
@@ -119,8 +99,8 @@ async def train_cmd(message: Message, command: CommandObject):
         return
     
     cost = TRAIN_COST_BASE + pet["level"] * TRAIN_COST_PER_LEVEL
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
-    if user["coins"] < cost:
+    user = await get_user(uid)
+    if not user or user["coins"] < cost:
         await message.answer(f"💸 Для тренировки нужно {cost} петкойнов. У тебя недостаточно.")
         return
     
@@ -149,20 +129,32 @@ async def train_cmd(message: Message, command: CommandObject):
         new_xp_needed = int(pet["xp_needed"] * 1.25)
         leveled_up = True
 
-    stats = json.loads(pet["stats"])
+    stats = stats_from_row(pet)
     stats[stat] += boost
 
     coin_rate = pet["coin_rate"]
     if leveled_up and new_lvl % 2 == 0:
         coin_rate += 1
 
+    # Списываем до записи статов: снимок users мог устареть, баланс перепроверяется в самом UPDATE
+    paid = await execute_query(
+        "UPDATE users SET coins = coins - $1 WHERE user_id = $2 AND coins >= $1",
+        {"coins": cost, "uid": uid}
+    )
+    invalidate_user(uid)
+    if paid == "UPDATE 0":
+        await message.answer(f"💸 Для тренировки нужно {cost} петкойнов. У тебя недостаточно.")
+        return
+
     await execute_query(
         """
-        UPDATE pets SET stats = $1, xp = $2, xp_needed = $3, level = $4, coin_rate = $5
-        WHERE id = $6
+        UPDATE pets SET atk = $1, def = $2, hp = $3, xp = $4, xp_needed = $5, level = $6, coin_rate = $7
+        WHERE id = $8
         """,
         {
-            "stats": json.dumps(stats),
+            "atk": stats["atk"],
+            "def": stats["def"],
+            "hp": stats["hp"],
             "xp": new_xp,
             "xp_needed": new_xp_needed,
             "level": new_lvl,
@@ -171,11 +163,6 @@ async def train_cmd(message: Message, command: CommandObject):
         }
     )
 
-    await execute_query(
-        "UPDATE users SET coins = coins - $1 WHERE user_id = $2",
-        {"coins": cost, "uid": uid}
-    )
-
     msg = (
         f"🏋️‍♂️ Ты потренировал <b>{pet['name']}</b>!\n"
         f"📈 {stat.upper()} вырос на <b>{boost}</b>.\n"
@@ -184,4 +171,6 @@ async def train_cmd(message: Message, command: CommandObject):
     if leveled_up:
         msg += f"🎉 Уровень повышен до <b>{new_lvl}</b>!\n💰 Доход: {coin_rate}/час"
 
-    await message.answer(msg)
\ No newline at end of file
+    await message.answer(msg)
+    if leveled_up:
+        await emit_quest_events([QuestEvent(uid, REACH_PET_LEVEL, new_lvl)], message.bot)
\ No newline at end of file
@@ -4,16 +4,21 @@ from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from bot.handlers.start import check_quest_progress, check_zone_unlocks
-from db.db import fetch_one, execute_query
+from bot.handlers.start import check_zone_unlocks
+from db.db import fetch_one, fetch_all, transaction
 from bot.utils.pet_generator import EGG_TYPES, PETS_BY_RARITY, RARITIES, RARITY_STATS_RANGE, RARITY_TOTAL_STAT_MULTIPLIER, generate_stats_for_class, roll_pet_from_egg_type
-import json
-from datetime import datetime
+from bot.utils.pet_query import invalidate_pet_counts
+from bot.utils.egg_inventory import take_eggs, count_eggs
+from bot.utils.user_snapshot import get_user, invalidate_user
+from bot.utils.quest_engine import QuestEvent, HATCH_PETS, COLLECT_EGGS, emit_quest_events
 
 router = Router()
 
-async def create_pet_and_save(user_id: int, egg_type: str) -> dict:
-    """Создает питомца на основе типа яйца и сохраняет в базу данных."""
+INITIAL_XP_NEEDED = 100 # Можете настроить или сделать зависимым от редкости
+HATCH_BULK_LIMIT = 500 # Яиц за одну команду /hatch all — одна транзакция не должна расти без предела
+
+def roll_new_pet(user_id: int, egg_type: str) -> dict:
+    """Генерирует питомца из яйца: порода, статы и coin_rate. В базу ничего не пишет."""
     
     # 1. Получаем данные для генерации питомца из pet_generator
     pet_data = roll_pet_from_egg_type(egg_type, PETS_BY_RARITY, EGG_TYPES)
@@ -31,46 +36,84 @@ async def create_pet_and_save(user_id: int, egg_type: str) -> dict:
     rarity_info_for_coin_rate = RARITIES[rarity]
     coin_rate = random.randint(rarity_info_for_coin_rate["coin_rate_range"][0], rarity_info_for_coin_rate["coin_rate_range"][1])
 
-    initial_xp_needed = 100 # Можете настроить или сделать зависимым от редкости
-
-    new_pet_data = {
+    return {
         "user_id": user_id,
         "name": pet_data["name"],
         "class": pclass,
         "rarity": rarity,
         "level": 1,
         "xp": 0,
-        "xp_needed": initial_xp_needed,
-        "stats": json.dumps(stats),
+        "xp_needed": INITIAL_XP_NEEDED,
+        "stats": stats,
         "coin_rate": coin_rate,
-        "last_collected": datetime.utcnow() # Добавлено для совместимости с explore
     }
-    
+
+async def create_pets_and_save(user_id: int, egg_types: list[str], tx=None) -> list[dict]:
+    """Вылупляет питомцев из нескольких яиц одним INSERT.
+    Если передан tx (db.transaction()), вставка идет в рамках этой транзакции.
+    Возвращает питомцев в порядке яиц, уже с id; яйца неизвестного типа пропускаются."""
+    new_pets = [pet for pet in (roll_new_pet(user_id, egg_type) for egg_type in egg_types) if pet]
+    if not new_pets:
+        return []
+
     # Save to database
     query = """
-    INSERT INTO pets (user_id, name, class, rarity, level, xp, xp_needed, stats, coin_rate, last_collected)
-    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-    RETURNING id, name, class, rarity, level;
+    INSERT INTO pets (user_id, name, class, rarity, level, xp, xp_needed, atk, def, hp, coin_rate, last_collected)
+    SELECT $1, name, class, rarity, 1, 0, $2, atk, def, hp, coin_rate, NOW()
+    FROM unnest($3::text[], $4::text[], $5::text[], $6::int[], $7::int[], $8::int[], $9::int[])
+         WITH ORDINALITY AS u(name, class, rarity, atk, def, hp, coin_rate, pos)
+    ORDER BY pos
+    RETURNING id;
     """
-    result = await fetch_one(query, new_pet_data)
-    
-    if result:
-        # Assuming result contains the returned columns from RETURNING
-        return {
-            "id": result['id'],
-            "name": result['name'],
-            "class": result['class'],
-            "rarity": result['rarity'],
-            "level": result['level'],
-            "stats": stats, # Возвращаем статы для отображения
-            "coin_rate": coin_rate
-        }
-    return None
+    rows = await (tx.fetch_all if tx else fetch_all)(query, {
+        "user_id": user_id,
+        "xp_needed": INITIAL_XP_NEEDED,
+        "names": [pet["name"] for pet in new_pets],
+        "classes": [pet["class"] for pet in new_pets],
+        "rarities": [pet["rarity"] for pet in new_pets],
+        "atk": [pet["stats"]["atk"] for pet in new_pets],
+        "def": [pet["stats"]["def"] for pet in new_pets],
+        "hp": [pet["stats"]["hp"] for pet in new_pets],
+        "coin_rates": [pet["coin_rate"] for pet in new_pets],
+    })
+
+    # id у SERIAL выдаются в порядке вставки, а вставляем мы в порядке pos
+    for pet, pet_id in zip(new_pets, sorted(row["id"] for row in rows)):
+        pet["id"] = pet_id
+    invalidate_pet_counts(user_id)
+    return new_pets
+
+async def create_pet_and_save(user_id: int, egg_type: str, tx=None) -> dict:
+    """Создает питомца на основе типа яйца и сохраняет в базу данных.
+    Если передан tx (db.transaction()), вставка идет в рамках этой транзакции."""
+    new_pets = await create_pets_and_save(user_id, [egg_type], tx=tx)
+    return new_pets[0] if new_pets else None
+
+async def hatch_eggs(uid: int, limit: int = 1, egg_type: str = None):
+    """Вылупляет до limit самых старых яиц (только типа egg_type, если задан).
+    Одна транзакция: DELETE ... RETURNING яиц, один INSERT питомцев, один UPDATE счётчика.
+    Возвращает вылупившихся питомцев."""
+    async with transaction() as tx:
+        egg_types = await take_eggs(tx, uid, limit, egg_type)
+        if not egg_types:
+            return []
+
+        new_pets = await create_pets_and_save(uid, egg_types, tx=tx)
+        if len(new_pets) != len(egg_types):
+            # Неизвестный тип яйца — откатываем всё, яйца остаются в инвентаре
+            raise ValueError(f"Не удалось вылупить яйца {egg_types} игрока {uid}")
+
+        await tx.execute_query(
+            "UPDATE users SET hatched_count = hatched_count + $1 WHERE user_id = $2",
+            {"hatched": len(new_pets), "uid": uid}
+        )
+    invalidate_user(uid)
+    return new_pets
 
 @router.message(Command("buy_egg"))
 async def buy_egg_cmd(message: Message):
     uid = message.from_user.id
-    user = await fetch_one("SELECT coins FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
     
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
@@ -105,83 +148,132 @@ async def process_buy_egg_callback(callback: CallbackQuery):
 
     cost = egg_info["cost"]
     
-    # Используем FOR UPDATE для обеспечения атомарности при списании монет
-    user = await fetch_one("SELECT coins, eggs, bought_eggs FROM users WHERE user_id = $1 FOR UPDATE", {"uid": uid})
-    if not user:
-        await callback.message.answer("Пользователь не найден. Пожалуйста, попробуйте /start.")
-        await callback.answer()
-        return
-
-    if user['coins'] < cost:
-        await callback.message.answer(f"Недостаточно монет! У тебя {user['coins']} 💰, а нужно {cost} 💰.")
+    # Списание монет и яйцо в инвентарь — один запрос: coins >= cost проверяется в самом UPDATE,
+    # поэтому два быстрых нажатия не уведут баланс в минус
+    purchase = await fetch_one(
+        """
+        WITH paid AS (
+            UPDATE users SET coins = coins - $2, bought_eggs = bought_eggs + 1, eggs_collected = eggs_collected + 1
+            WHERE user_id = $1 AND coins >= $2
+            RETURNING user_id, coins
+        ), egg AS (
+            INSERT INTO user_eggs (user_id, egg_type, source)
+            SELECT user_id, $3, 'Магазин' FROM paid
+        )
+        SELECT coins FROM paid
+        """,
+        {"uid": uid, "cost": cost, "egg_type": egg_type_key}
+    )
+    if purchase:
+        invalidate_user(uid)
+    if not purchase:
+        user = await get_user(uid)
+        if not user:
+            await callback.message.answer("Пользователь не найден. Пожалуйста, попробуйте /start.")
+        else:
+            await callback.message.answer(f"Недостаточно монет! У тебя {user['coins']} 💰, а нужно {cost} 💰.")
         await callback.answer()
         return
 
-    # Вычитаем монеты и добавляем яйцо в инвентарь пользователя
-    current_eggs = json.loads(user['eggs']) if user['eggs'] else []
-    
-    new_egg_record = {
-        "type": egg_type_key, # Сохраняем тип яйца, чтобы знать, что вылуплять
-        "bought_at": datetime.utcnow().isoformat(),
-    }
-    current_eggs.append(new_egg_record)
-
-    await execute_query(
-        "UPDATE users SET coins = coins - $1, eggs = $2, bought_eggs = bought_eggs + 1 WHERE user_id = $3",
-        {"cost": cost, "eggs": json.dumps(current_eggs), "uid": uid}
-    )
-
     await callback.message.answer(
         f"🥚 Ты купил {egg_info['name_ru']} за {cost} 💰!\n"
-        f"У тебя осталось {user['coins'] - cost} 💰.\n"
+        f"У тебя осталось {purchase['coins']} 💰.\n"
         f"Напиши /hatch, чтобы его вылупить.",
         parse_mode="HTML"
     )
     await callback.answer()
+    await emit_quest_events([QuestEvent(uid, COLLECT_EGGS)], callback.bot)
+
+def parse_hatch_args(args: str):
+    """Разбирает аргументы /hatch. Возвращает (тип яйца или None, сколько) или None при ошибке.
+    /hatch — одно яйцо, /hatch all — все (до HATCH_BULK_LIMIT), /hatch <тип> [<n>|all]."""
+    parts = (args or "").lower().split()
+    if not parts:
+        return None, 1
+    egg_type = None
+    if parts[0] in EGG_TYPES:
+        egg_type = parts.pop(0)
+    if not parts:
+        return egg_type, 1
+    if len(parts) != 1:
+        return None
+    if parts[0] == "all":
+        return egg_type, HATCH_BULK_LIMIT
+    if parts[0].isdigit() and int(parts[0]) > 0:
+        return egg_type, min(int(parts[0]), HATCH_BULK_LIMIT)
+    return None
+
+def format_hatch_summary(new_pets: list[dict]) -> str:
+    """Сводка массового вылупления: сколько питомцев каждой редкости и лучший из них."""
+    rarity_order = list(RARITIES)
+    by_rarity: dict[str, int] = {}
+    for pet in new_pets:
+        by_rarity[pet["rarity"]] = by_rarity.get(pet["rarity"], 0) + 1
+    best = max(new_pets, key=lambda pet: (rarity_order.index(pet["rarity"]), sum(pet["stats"].values())))
+
+    lines = [f"🎉 Вылупилось питомцев: <b>{len(new_pets)}</b>\n"]
+    for rarity in sorted(by_rarity, key=rarity_order.index, reverse=True):
+        lines.append(f"🔹 {rarity}: {by_rarity[rarity]}")
+    lines.append(
+        f"\n⭐ Лучший: <b>{best['name']}</b> ({best['rarity']} — {best['class']}), "
+        f"🗡 {best['stats']['atk']} 🛡 {best['stats']['def']} ❤ {best['stats']['hp']}"
+    )
+    lines.append(f"💰 Общий доход: {sum(pet['coin_rate'] for pet in new_pets)} петкойнов/час")
+    return "\n".join(lines)
 
 @router.message(Command("hatch"))
-async def hatch_egg_cmd(message: Message):
+async def hatch_egg_cmd(message: Message, command: CommandObject):
     uid = message.from_user.id
 
-    user = await fetch_one("SELECT coins, eggs, hatched_count FROM users WHERE user_id = $1 FOR UPDATE", {"uid": uid})
-    if not user:
-        await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
+    parsed = parse_hatch_args(command.args)
+    if parsed is None:
+        await message.answer(
+            "Используй: <code>/hatch</code> — одно яйцо, <code>/hatch all</code> — все яйца, "
+            "<code>/hatch &lt;тип&gt; &lt;количество&gt;</code> — яйца одного типа.\n"
+            f"Типы: {', '.join(EGG_TYPES)}",
+            parse_mode="HTML"
+        )
         return
-    
-    current_eggs = json.loads(user['eggs']) if user['eggs'] else []
-    if not current_eggs:
-        await message.answer("У тебя нет яиц для вылупления. Купи яйцо с помощью /buy_egg.")
-        return
-    
-    # Берем первое яйцо из списка (самое старое)
-    egg_to_hatch = current_eggs.pop(0) 
-    egg_type_key = egg_to_hatch.get("type", "базовое") # По умолчанию 'базовое', если тип не указан
+    egg_type, limit = parsed
 
-    # Создаем питомца на основе ТИПА ЯЙЦА
-    new_pet_data = await create_pet_and_save(uid, egg_type_key)
-
-    if not new_pet_data:
+    try:
+        new_pets = await hatch_eggs(uid, limit, egg_type)
+    except Exception as e:
+        print(f"Ошибка при вылуплении яйца у {uid}: {e}")
         await message.answer("Что-то пошло не так при вылуплении питомца. Попробуй позже.")
         return
 
-    # Обновляем список яиц у пользователя
-    await execute_query(
-        "UPDATE users SET eggs = $1, hatched_count = hatched_count + 1 WHERE user_id = $2",
-        {"eggs": json.dumps(current_eggs), "uid": uid}
-    )
+    if not new_pets:
+        user = await get_user(uid)
+        if not user:
+            await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
+        elif egg_type:
+            await message.answer(f"У тебя нет яиц типа «{egg_type}». Купи яйцо с помощью /buy_egg.")
+        else:
+            await message.answer("У тебя нет яиц для вылупления. Купи яйцо с помощью /buy_egg.")
+        return
+
+    if len(new_pets) > 1:
+        text = format_hatch_summary(new_pets)
+        if len(new_pets) == HATCH_BULK_LIMIT:
+            remaining = await count_eggs(uid)
+            if remaining:
+                text += f"\n\n🥚 Осталось яиц: {remaining}. Повтори команду, чтобы вылупить ещё."
+        await message.answer(text, parse_mode="HTML")
+        await emit_quest_events([QuestEvent(uid, HATCH_PETS, len(new_pets))], message.bot)
+        return
 
-    # Проверка квеста (по вашей логике)
-    if user["hatched_count"] == 1: # Это будет 0 + 1 = 1 после вылупления первого яйца
-        await check_quest_progress(uid, message)
+    new_pet_data = new_pets[0]
 
     await message.answer(
         f"🎉 Из яйца вылупился питомец!\n\n"
         f"🔹 <b>{new_pet_data['name']}</b> ({new_pet_data['rarity']} — {new_pet_data['class']})\n"
         f"🏅 Уровень: {new_pet_data['level']} | XP: 0/{new_pet_data.get('xp_needed', 100)}\n" # XP_needed для нового пета
         f"📊 Статы:\n"
-        f"   🗡 Атака: {new_pet_data['stats']['atk']}\n"
-        f"   🛡 Защита: {new_pet_data['stats']['def']}\n"
-        f"   ❤ Здоровье: {new_pet_data['stats']['hp']}\n"
+        f"   🗡 Атака: {new_pet_data['stats']['atk']}\n"
+        f"   🛡 Защита: {new_pet_data['stats']['def']}\n"
+        f"   ❤ Здоровье: {new_pet_data['stats']['hp']}\n"
         f"💰 Доход: {new_pet_data['coin_rate']} петкойнов/час",
         parse_mode="HTML"
-    )
\ No newline at end of file
+    )
+    await emit_quest_events([QuestEvent(uid, HATCH_PETS, len(new_pets))], message.bot)
@@ -10,20 +10,26 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.exceptions import TelegramBadRequest # Import for error handling
 
-from db.db import fetch_one, fetch_all, execute_query
-from bot.handlers.start import check_quest_progress, get_zone_buff # Ensure these are correctly imported
+from db.db import fetch_one, fetch_all, execute_query, transaction
+from bot.utils.quest_engine import QuestEvent, EXPLORE_ZONE, DEFEAT_MONSTERS_ZONE, COLLECT_COINS, REACH_PET_LEVEL, emit_quest_events
+from bot.utils.battle_system import simulate_battle_explore
+from bot.utils import explore_scheduler
+from bot.utils.pet_query import fetch_pet_page, stats_from_row
+from bot.utils.display_names import get_display_name
+from bot.utils.catalog import get_zone, get_zone_monsters
+from bot.utils.user_snapshot import get_user, update_cached_user, invalidate_users
+from bot.utils.energy import MAX_ENERGY, ENERGY_SECONDS_PER_POINT, EXPLORE_ENERGY, current_energy, seconds_until, spend_energy
 
 router = Router()
 
 EXPLORE_COOLDOWN = timedelta(seconds=60)    # 1 minute for testing, increase for production
 EXPLORE_ENERGY_COST = 10                    # Base energy consumed per exploration
-MAX_ENERGY = 200                            # Maximum energy a user can have
-ENERGY_RECOVERY_RATE_PER_MINUTE = 1         # Energy regenerated per minute
 
 # Exploration Outcomes (these are base ranges, actual values might be buffed by zone data)
 EXPLORE_BASE_COIN_RANGE = (50, 150)
 EXPLORE_BASE_XP_RANGE = (10, 30)
 EXPLORE_BASE_ITEM_CHANCE = 0.05 # Base chance to find an item (e.g., 5%)
+EXPLORE_PICKER_SIZE = 20 # Pets listed when choosing who to send into a zone
 
 EXPLORE_FAIL_MESSAGES = [
     "Тебе не хватает энергии для исследования.",
@@ -39,71 +45,15 @@ EXPLORE_SUCCESS_MESSAGES = [
     "На {zone_name_ru} {pet_name} славно потрудился, собрав {coins} 💰, и стал опытнее на {xp} XP!"
 ]
 
-# --- Energy Management Functions ---
-
-async def get_user_energy_data(user_id: int) -> dict:
-    """Fetches raw energy data from the database."""
-    user = await fetch_one("SELECT energy, last_energy_update FROM users WHERE user_id = $1", {"uid": user_id})
-    if user:
-        # Ensure last_energy_update is a datetime object
-        if isinstance(user['last_energy_update'], str):
-            user['last_energy_update'] = datetime.fromisoformat(user['last_energy_update'])
-        # Ensure it's timezone-aware if you are using timezone.utc
-        if user['last_energy_update'] and user['last_energy_update'].tzinfo is None:
-            user['last_energy_update'] = user['last_energy_update'].replace(tzinfo=timezone.utc)
-        return {"energy": user['energy'], "last_energy_update": user['last_energy_update']}
-    # If user not found or no update data, initialize with full energy at current time
-    return {"energy": MAX_ENERGY, "last_energy_update": datetime.now(timezone.utc)} # Use now(timezone.utc)
-
-async def update_user_energy_db(user_id: int, new_energy: int, update_time: datetime = None):
-    """Updates energy and last_energy_update in the database."""
-    if update_time is None:
-        update_time = datetime.now(timezone.utc) # Use now(timezone.utc) for consistency
-    await execute_query("UPDATE users SET energy = $1, last_energy_update = $2 WHERE user_id = $3",
-                        {"energy": new_energy, "update_time": update_time, "uid": user_id})
-
-async def recalculate_energy(user_id: int) -> int:
-    """
-    Recalculates and updates the user's current energy based on elapsed time.
-    Returns the current energy after recalculation.
-    """
-    energy_data = await get_user_energy_data(user_id)
-    current_energy = energy_data['energy']
-    last_update = energy_data['last_energy_update']
-
-    max_user_energy = MAX_ENERGY # Using global constant for now
-
-    # If last_update is None (e.g., new user), initialize energy to max
-    if last_update is None:
-        await update_user_energy_db(user_id, max_user_energy, datetime.now(timezone.utc))
-        return max_user_energy
-
-    now_utc = datetime.now(timezone.utc)
-    time_elapsed_minutes = (now_utc - last_update).total_seconds() / 60
-
-    recovered_energy = int(time_elapsed_minutes * ENERGY_RECOVERY_RATE_PER_MINUTE)
-    
-    new_energy = min(max_user_energy, current_energy + recovered_energy)
-
-    # Only update if energy has actually changed or if max energy was reached and time passed
-    if new_energy != current_energy:
-        await update_user_energy_db(user_id, new_energy, now_utc)
-    elif new_energy == max_user_energy and recovered_energy > 0:
-        # If energy is already full, but time has passed, update last_energy_update
-        # to prevent large accumulated time_elapsed_minutes on next check.
-        await execute_query("UPDATE users SET last_energy_update = $1 WHERE user_id = $2",
-                            {"last_update": now_utc, "uid": user_id})
-
-    return new_energy
-
 # --- Pet & Battle Functions ---
 
 async def check_and_level_up_pet(bot_instance, user_id, pet_id):
     """Checks if a pet has enough XP to level up and updates its stats."""
-    pet_record = await fetch_one("SELECT id, name, level, xp, xp_needed, stats FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
+    pet_record = await fetch_one("SELECT id, name, level, xp, xp_needed, atk, def, hp FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
 
     if pet_record:
         pet = dict(pet_record) # Create a mutable copy
+        pet_stats = stats_from_row(pet)
 
         level_up_count = 0
         while pet['xp'] >= pet['xp_needed']:
@@ -111,43 +61,32 @@ async def check_and_level_up_pet(bot_instance, user_id, pet_id):
             pet['xp'] -= pet['xp_needed']
             pet['xp_needed'] = int(pet['xp_needed'] * 1.5) # XP needed increases
 
-            # Ensure pet['stats'] is a dict
-            if isinstance(pet['stats'], str):
-                pet_stats = json.loads(pet['stats'])
-            else:
-                pet_stats = pet['stats']
-
             # Increase stats on level up
             pet_stats['atk'] += random.randint(1, 3)
             pet_stats['def'] += random.randint(1, 3)
             pet_stats['hp'] += random.randint(3, 7) # Max HP increases
-
-            pet['stats'] = json.dumps(pet_stats) # Store back as JSON string
-
-            await execute_query(
-                "UPDATE pets SET level = $1, xp = $2, xp_needed = $3, stats = $4 WHERE id = $5",
-                {"level": pet['level'], "xp": pet['xp'], "xp_needed": pet['xp_needed'],
-                 "stats": pet['stats'], "id": pet_id}
-            )
             level_up_count += 1
 
         if level_up_count > 0:
-            updated_pet = await fetch_one("SELECT name, level, stats FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
+            # All level-ups are written at once
+            updated_pet = await fetch_one(
+                "UPDATE pets SET level = $1, xp = $2, xp_needed = $3, atk = $4, def = $5, hp = $6 "
+                "WHERE id = $7 AND user_id = $8 RETURNING name, level, atk, def, hp",
+                {"level": pet['level'], "xp": pet['xp'], "xp_needed": pet['xp_needed'],
+                 "atk": pet_stats['atk'], "def": pet_stats['def'], "hp": pet_stats['hp'], "id": pet_id, "user_id": user_id}
+            )
             if updated_pet:
-                # Update highest_pet_level in users table
-                user = await fetch_one("SELECT highest_pet_level FROM users WHERE user_id = $1", {"uid": user_id})
-                if user and updated_pet['level'] > user.get('highest_pet_level', 0):
-                    await execute_query("UPDATE users SET highest_pet_level = $1 WHERE user_id = $2",
-                                        {"highest_pet_level": updated_pet['level'], "uid": user_id})
+                # Update highest_pet_level in users table; the comparison is done by the UPDATE itself
+                raised = await execute_query("UPDATE users SET highest_pet_level = $1 WHERE user_id = $2 AND COALESCE(highest_pet_level, 0) < $1",
+                                             {"highest_pet_level": updated_pet['level'], "uid": user_id})
+                if raised != "UPDATE 0":
+                    update_cached_user(user_id, highest_pet_level=updated_pet['level'])
+                await emit_quest_events([QuestEvent(user_id, REACH_PET_LEVEL, updated_pet['level'])], bot_instance)
 
-                # Fetch user's first name for a personalized message
-                user_chat_info = await bot_instance.get_chat(user_id)
-                user_name = user_chat_info.first_name if user_chat_info.first_name else user_chat_info.full_name
+                # Name comes from the display-name cache, no Bot API call
+                user_name = await get_display_name(user_id)
 
-                if isinstance(updated_pet['stats'], str):
-                    updated_pet_stats = json.loads(updated_pet['stats'])
-                else:
-                    updated_pet_stats = updated_pet['stats']
+                updated_pet_stats = stats_from_row(updated_pet)
 
                 await bot_instance.send_message(
                     user_id,
@@ -162,10 +101,9 @@ async def check_and_level_up_pet(bot_instance, user_id, pet_id):
 # If you implement persistent HP for pets, you'll need to store current_hp in the DB.
 async def get_pet_current_hp(pet_id: int, user_id: int):
     """Retrieves the current HP of a pet. (Currently assumes full HP for battle start)"""
-    pet = await fetch_one("SELECT stats FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
-    if pet and pet['stats']:
-        stats = json.loads(pet['stats']) if isinstance(pet['stats'], str) else pet['stats']
-        return stats.get('hp') # Assuming 'hp' in stats is max HP
+    pet = await fetch_one("SELECT hp FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": user_id})
+    if pet and pet['hp'] is not None:
+        return pet['hp'] # Max HP
     return 0
 
 async def update_pet_current_hp(pet_id: int, user_id: int, new_hp: int):
@@ -173,105 +111,62 @@ async def update_pet_current_hp(pet_id: int, user_id: int, new_hp: int):
     # This function would be used if you had a 'current_hp' column in 'pets' table
     pass
 
-async def simulate_battle(bot_instance: object, user_id: int, pet: dict, monster: dict, message_obj: Message):
-    """Simulates a turn-based battle between a pet and a monster."""
-    pet_name = pet['name']
-    monster_name = monster['name']
-    
-    # Get pet's stats (current HP will be full for now)
-    pet_stats = json.loads(pet['stats']) if isinstance(pet['stats'], str) else pet['stats']
-    pet_current_hp = pet_stats['hp'] # Use max HP for simplicity at start of battle
-    pet_atk = pet_stats['atk']
-    pet_def = pet_stats['def']
+EXPLORE_BATTLE_LOG_TURNS = 6 # Сколько последних ходов показывать в итоговом сообщении
 
-    monster_current_hp = monster['hp']
-    monster_atk = monster['atk']
-    monster_def = monster['def']
+def render_explore_battle(pet_name: str, pet_level: int, monster: dict, result: dict) -> str:
+    """Renders a battle resolved by simulate_battle_explore as a single message block."""
+    monster_name = monster['name']
+    battle_log = [f"⚡️ Началась битва! <b>{pet_name}</b> (Ур. {pet_level}) против <b>{monster_name}</b> (Ур. {monster['level']})!"]
+
+    turns = result['turns']
+    if len(turns) > EXPLORE_BATTLE_LOG_TURNS:
+        battle_log.append("…")
+        turns = turns[-EXPLORE_BATTLE_LOG_TURNS:]
+    for turn_info in turns:
+        if turn_info['attacker'] == "pet":
+            battle_log.append(f"Ход {turn_info['turn']}: <b>{pet_name}</b> атакует <b>{monster_name}</b>, нанося {turn_info['damage']} урона. У <b>{monster_name}</b> осталось {turn_info['target_hp']} HP.")
+        else:
+            battle_log.append(f"Ход {turn_info['turn']}: <b>{monster_name}</b> атакует <b>{pet_name}</b>, нанося {turn_info['damage']} урона. У <b>{pet_name}</b> осталось {turn_info['target_hp']} HP.")
 
-    battle_log = [f"⚡️ Началась битва! <b>{pet_name}</b> (Ур. {pet['level']}) против <b>{monster_name}</b> (Ур. {monster['level']})!"]
-    
-    # Store battle message to update it
-    battle_message = await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-
-    turn = 1
-    # Max 20 turns to prevent infinite loops (or until one combatant is defeated)
-    while pet_current_hp > 0 and monster_current_hp > 0 and turn < 20: 
-        # Pet attacks Monster
-        pet_damage = max(1, pet_atk - monster_def)
-        monster_current_hp -= pet_damage
-        battle_log.append(f"Ход {turn}: <b>{pet_name}</b> атакует <b>{monster_name}</b>, нанося {pet_damage} урона. У <b>{monster_name}</b> осталось {max(0, monster_current_hp)} HP.")
-
-        try:
-            await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e): # Ignore if text is identical
-                await message_obj.answer("\n".join(battle_log), parse_mode="HTML") # Send new message if edit fails
-        await asyncio.sleep(1) # Small delay for readability
-
-        if monster_current_hp <= 0:
+    if result['outcome'] == "win":
+        if result['turn_limit']:
+            # Pet survived the turn limit: treat as win for progress
+            battle_log.append(f"✅ Битва окончена! <b>{pet_name}</b> одолел <b>{monster_name}</b>!")
+        else:
             battle_log.append(f"✅ <b>{pet_name}</b> победил <b>{monster_name}</b>!")
-            try:
-                await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-            except TelegramBadRequest:
-                await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-            
-            # Update monsters_defeated_counts for the user
-            user = await fetch_one("SELECT monsters_defeated_counts FROM users WHERE user_id = $1", {"uid": user_id})
-            monsters_defeated_counts = json.loads(user.get('monsters_defeated_counts', '{}') or '{}')
-            # Assuming monster['name'] is unique enough for tracking defeated counts
-            monsters_defeated_counts[monster['name']] = monsters_defeated_counts.get(monster['name'], 0) + 1
-            await execute_query("UPDATE users SET monsters_defeated_counts = $1 WHERE user_id = $2",
-                                {"monsters_defeated_counts": json.dumps(monsters_defeated_counts), "uid": user_id})
-
-            return "win", monster['xp_reward'], monster['coin_reward'], [] # Dropped items list (empty for now)
-            
-        # Monster attacks Pet
-        monster_damage = max(1, monster_atk - pet_def)
-        pet_current_hp -= monster_damage
-        battle_log.append(f"Ход {turn}: <b>{monster_name}</b> атакует <b>{pet_name}</b>, нанося {monster_damage} урона. У <b>{pet_name}</b> осталось {max(0, pet_current_hp)} HP.")
-
-        try:
-            await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-        except TelegramBadRequest as e:
-            if "message is not modified" not in str(e):
-                await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-        await asyncio.sleep(1) # Small delay for readability
-
-        if pet_current_hp <= 0:
-            battle_log.append(f"❌ <b>{pet_name}</b> проиграл битву против <b>{monster_name}</b>.")
-            try:
-                await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-            except TelegramBadRequest:
-                await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-            return "loss", 0, 0, [] # No rewards for loss
-        
-        turn += 1
-        
-    # If battle ends due to turn limit
-    if pet_current_hp > 0:
-        battle_log.append(f"✅ Битва окончена! <b>{pet_name}</b> одолел <b>{monster_name}</b>!")
-        # If monster HP > 0 but pet HP > 0, it means turn limit was reached and pet survived.
-        # Decide if this is a win or a draw. For now, let's treat it as a win if pet survived.
-        try:
-            await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-        except TelegramBadRequest:
-            await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-        
-        # If pet survived (even if monster didn't explicitly die within turns) treat as win for progress
-        user = await fetch_one("SELECT monsters_defeated_counts FROM users WHERE user_id = $1", {"uid": user_id})
-        monsters_defeated_counts = json.loads(user.get('monsters_defeated_counts', '{}') or '{}')
-        monsters_defeated_counts[monster['name']] = monsters_defeated_counts.get(monster['name'], 0) + 1
-        await execute_query("UPDATE users SET monsters_defeated_counts = $1 WHERE user_id = $2",
-                            {"monsters_defeated_counts": json.dumps(monsters_defeated_counts), "uid": user_id})
-
-        return "win", monster['xp_reward'], monster['coin_reward'], []
-    else:
+    elif result['turn_limit']:
         battle_log.append(f"❌ Битва окончена! <b>{pet_name}</b> проиграл битву против <b>{monster_name}</b>.")
-        try:
-            await battle_message.edit_text("\n".join(battle_log), parse_mode="HTML")
-        except TelegramBadRequest:
-            await message_obj.answer("\n".join(battle_log), parse_mode="HTML")
-        return "loss", 0, 0, []
+    else:
+        battle_log.append(f"❌ <b>{pet_name}</b> проиграл битву против <b>{monster_name}</b>.")
+    return "\n".join(battle_log)
+
+
+async def answer_not_enough_energy(message: Message, user, zone_data, energy_cost: int):
+    total_seconds = seconds_until(user, EXPLORE_ENERGY, energy_cost)
+
+    # Format the wait into a human-readable string
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    
+    time_str_parts = []
+    if hours > 0:
+        time_str_parts.append(f"{hours}ч")
+    if minutes > 0:
+        time_str_parts.append(f"{minutes}м")
+    if seconds > 0 or not time_str_parts: # Show seconds if non-zero or if no hours/minutes
+        time_str_parts.append(f"{seconds}с")
+    
+    time_to_regen_str = " ".join(time_str_parts) if time_str_parts else "немедленно"
+
+    await message.answer(
+        f"🚫 {random.choice(EXPLORE_FAIL_MESSAGES)}\n"
+        f"Текущая энергия: {current_energy(user, EXPLORE_ENERGY)}/{MAX_ENERGY}\n"
+        f"Для исследования <b>{zone_data['name']}</b> нужно {energy_cost} энергии.\n"
+        f"⚡️ Энергия восстанавливается на {60 // ENERGY_SECONDS_PER_POINT} в минуту."
+        f"\nПопробуй снова через {time_to_regen_str}.", # Corrected display
+        parse_mode="HTML"
+    )
+    await asyncio.sleep(0.5)
 
 
 # --- Command Handlers ---
@@ -279,14 +174,15 @@ async def simulate_battle(bot_instance: object, user_id: int, pet: dict, monster
 @router.message(Command("explore"))
 async def explore_cmd(message: Message, command: CommandObject):
     uid = message.from_user.id
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
     if not user:
         await message.answer("Ты ещё не зарегистрирован. Напиши /start!")
         await asyncio.sleep(0.5)
         return
     
     if not command.args:
-        unlocked_zones_data = await fetch_all("SELECT z.name, z.description FROM user_zones uz JOIN zones z ON uz.zone = z.name WHERE uz.user_id = $1 AND uz.unlocked = TRUE", {"uid": uid})
+        unlocked_rows = await fetch_all("SELECT zone FROM user_zones WHERE user_id = $1 AND unlocked = TRUE", {"uid": uid})
+        unlocked_zones_data = [zone for zone in (get_zone(row['zone']) for row in unlocked_rows) if zone]
         
         if not unlocked_zones_data:
             await message.answer("У тебя пока нет разблокированных зон для исследования. Чтобы разблокировать первую зону, выполни квесты.") # Clarified
@@ -327,7 +223,7 @@ async def explore_cmd(message: Message, command: CommandObject):
     
     zone_name = args[1]
 
-    zone_data = await fetch_one("SELECT * FROM zones WHERE name = $1", {"zone_name": zone_name})
+    zone_data = get_zone(zone_name)
     if not zone_data:
         await message.answer(f"Локация '{zone_name}' не найдена. Проверь название и попробуй снова.")
         await asyncio.sleep(0.5)
@@ -340,66 +236,22 @@ async def explore_cmd(message: Message, command: CommandObject):
         await asyncio.sleep(0.5)
         return
 
-    pet_to_explore = await fetch_one("SELECT id, name, rarity, class, level, xp, stats, coin_rate FROM pets WHERE id = $1 AND user_id = $2",
+    pet_to_explore = await fetch_one("SELECT id, name, rarity, class, level, xp, coin_rate FROM pets WHERE id = $1 AND user_id = $2",
                                      {"id": pet_id, "user_id": uid})
     if not pet_to_explore:
         await message.answer("У тебя нет питомца с таким ID. Проверь свой список питомцев.")
         await asyncio.sleep(0.5)
         return
     
-    current_energy = await recalculate_energy(uid) # Always get the latest energy
+    # Energy is computed from the already loaded users row, nothing is written until it is spent
+    user_energy = current_energy(user, EXPLORE_ENERGY)
     
     # Calculate actual energy cost for this zone
     energy_cost_multiplier = 1 + (zone_data.get('energy_cost_buff', 0) / 100) # Use .get for robustness
     actual_energy_cost = int(EXPLORE_ENERGY_COST * energy_cost_multiplier)
 
-    if current_energy < actual_energy_cost:
-        user_energy_data = await get_user_energy_data(uid) # Fetch raw data for last_energy_update
-        last_update = user_energy_data['last_energy_update'] or datetime.now(timezone.utc) # Fallback
-
-        if ENERGY_RECOVERY_RATE_PER_MINUTE > 0:
-            seconds_for_one_point = 60 / ENERGY_RECOVERY_RATE_PER_MINUTE
-        else:
-            seconds_for_one_point = float('inf') # No regeneration
-
-        now_utc = datetime.now(timezone.utc)
-        seconds_since_last_update = (now_utc - last_update).total_seconds()
-        
-        seconds_into_current_cycle = seconds_since_last_update % seconds_for_one_point
-        
-        time_until_next_point = seconds_for_one_point - seconds_into_current_cycle
-        points_needed = actual_energy_cost - current_energy
-        
-        time_to_regen_display = timedelta(seconds=0)
-
-        if points_needed > 0:
-            total_wait_seconds = time_until_next_point + (points_needed - 1) * seconds_for_one_point
-            time_to_regen_display = timedelta(seconds=int(total_wait_seconds))
-
-        # Format timedelta into a human-readable string
-        total_seconds = int(time_to_regen_display.total_seconds())
-        hours, remainder = divmod(total_seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        
-        time_str_parts = []
-        if hours > 0:
-            time_str_parts.append(f"{hours}ч")
-        if minutes > 0:
-            time_str_parts.append(f"{minutes}м")
-        if seconds > 0 or not time_str_parts: # Show seconds if non-zero or if no hours/minutes
-            time_str_parts.append(f"{seconds}с")
-        
-        time_to_regen_str = " ".join(time_str_parts) if time_str_parts else "немедленно"
-
-        await message.answer(
-            f"🚫 {random.choice(EXPLORE_FAIL_MESSAGES)}\n"
-            f"Текущая энергия: {current_energy}/{MAX_ENERGY}\n"
-            f"Для исследования <b>{zone_data['name']}</b> нужно {actual_energy_cost} энергии.\n"
-            f"⚡️ Энергия восстанавливается на {ENERGY_RECOVERY_RATE_PER_MINUTE} в минуту."
-            f"\nПопробуй снова через {time_to_regen_str}.", # Corrected display
-            parse_mode="HTML"
-        )
-        await asyncio.sleep(0.5)
+    if user_energy < actual_energy_cost:
+        await answer_not_enough_energy(message, user, zone_data, actual_energy_cost)
         return
 
     # Check cooldown before proceeding
@@ -435,129 +287,207 @@ async def explore_cmd(message: Message, command: CommandObject):
         await asyncio.sleep(0.5)
         return
 
-    # Deduct energy and update exploration time
-    new_energy_after_explore = current_energy - actual_energy_cost
-    await update_user_energy_db(uid, new_energy_after_explore, datetime.now(timezone.utc)) # Use now(timezone.utc)
+    # Deduct energy atomically: a parallel /explore or /dungeon may have spent it since the check above
+    if await spend_energy(uid, EXPLORE_ENERGY, actual_energy_cost) is None:
+        await answer_not_enough_energy(message, await get_user(uid), zone_data, actual_energy_cost)
+        return
+    explore_time = datetime.now(timezone.utc)
     await execute_query("UPDATE users SET last_explore_time = $1, active_zone = $2 WHERE user_id = $3",
-                        {"time": datetime.now(timezone.utc), "active_zone": zone_name, "uid": uid}) # Use now(timezone.utc)
+                        {"time": explore_time, "active_zone": zone_name, "uid": uid}) # Use now(timezone.utc)
+    update_cached_user(uid, last_explore_time=explore_time, active_zone=zone_name)
 
-    # --- Start Simulation ---
+    # --- Start Exploration ---
     explore_message_text = (
         f"🌳 <b>{pet_to_explore['name']}</b> отправился исследовать <b>{zone_data['name']}</b>...\n"
         f"Это займет некоторое время. Пожалуйста, подожди."
     )
     explore_message = await message.answer(explore_message_text, parse_mode="HTML")
 
+    # Хендлер не ждёт: задание пишется в explorations, результат выдаст планировщик
     exploration_duration = random.randint(zone_data['explore_duration_min'], zone_data['explore_duration_max'])
-    await asyncio.sleep(exploration_duration)
+    due_at = datetime.now(timezone.utc) + timedelta(seconds=exploration_duration)
+    job = await fetch_one(
+        "INSERT INTO explorations (user_id, pet_id, zone, chat_id, message_id, due_at) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
+        {"uid": uid, "pet_id": pet_id, "zone": zone_name, "chat_id": message.chat.id,
+         "message_id": explore_message.message_id, "due_at": due_at}
+    )
+    explore_scheduler.schedule(job['id'], due_at)
 
-    # --- Determine Outcome ---
-    outcome_message = ""
-    xp_gain_final = 0
-    coins_found_final = 0
 
-    # Get zone buff
-    zone_buff = await get_zone_buff(uid) # get_zone_buff returns a dict
-    buff_multiplier_xp = 1.0
-    buff_multiplier_coin = 1.0
+# --- Exploration Resolution (runs in the scheduler task) ---
 
-    if zone_buff and zone_buff['type'] == 'xp_rate':
-        buff_multiplier_xp = 1.0 + (zone_buff['value'] / 100)
-    elif zone_buff and zone_buff['type'] == 'coin_rate':
-        buff_multiplier_coin = 1.0 + (zone_buff['value'] / 100)
+def roll_exploration_outcome(job: dict, zone_monsters: list) -> dict:
+    """Decides what happened on one exploration. Pure: no I/O, only random rolls."""
+    pet_name = job['pet_name']
+    outcome = {"xp": 0, "coins": 0, "monster_defeated": None, "battle_text": None}
 
-
-    if random.random() < zone_data['pve_chance']: # PvE encounter
-        monsters_in_zone = await fetch_all("SELECT * FROM monsters WHERE zone_name = $1 ORDER BY level ASC", {"zone_name": zone_name})
-        
-        if monsters_in_zone:
-            selected_monster = random.choice(monsters_in_zone) # Randomly pick a monster from DB
-            
-            try: # Try to edit the previous message
-                await explore_message.edit_text(f"🌳 <b>{pet_to_explore['name']}</b> в зоне <b>{zone_data['name']}</b> столкнулся с <b>{selected_monster['name']}</b>!", parse_mode="HTML")
-            except TelegramBadRequest as e:
-                if "message is not modified" not in str(e): # Ignore if text is identical
-                    await message.answer(f"🌳 <b>{pet_to_explore['name']}</b> в зоне <b>{zone_data['name']}</b> столкнулся с <b>{selected_monster['name']}</b>!", parse_mode="HTML") # Send new message if edit fails
-            await asyncio.sleep(1) # Small pause before battle starts
-
-            battle_result, xp_reward, coin_reward, dropped_items = await simulate_battle(
-                message.bot, uid, pet_to_explore, selected_monster, message
+    if random.random() < job['pve_chance']: # PvE encounter
+        if zone_monsters:
+            selected_monster = random.choice(zone_monsters)
+            pet_stats = stats_from_row(job)
+            result = simulate_battle_explore(pet_stats, selected_monster)
+            outcome["battle_text"] = (
+                f"🌳 <b>{pet_name}</b> в зоне <b>{job['zone']}</b> столкнулся с <b>{selected_monster['name']}</b>!\n\n"
+                + render_explore_battle(pet_name, job['pet_level'], selected_monster, result)
             )
-            
-            if battle_result == "win":
-                xp_gain_final = xp_reward
-                coins_found_final = coin_reward
-                outcome_message = f"<b>{pet_to_explore['name']}</b> победил {selected_monster['name']}!"
-                
+            if result['outcome'] == "win":
+                outcome["xp"] = selected_monster['xp_reward']
+                outcome["coins"] = selected_monster['coin_reward']
+                outcome["monster_defeated"] = selected_monster['name']
+                outcome["text"] = f"<b>{pet_name}</b> победил {selected_monster['name']}!"
             else:
-                outcome_message = f"<b>{pet_to_explore['name']}</b> проиграл битву с {selected_monster['name']}."
-                # Optionally add a penalty for loss (e.g., less energy, temporary debuff)
+                outcome["text"] = f"<b>{pet_name}</b> проиграл битву с {selected_monster['name']}."
         else:
-            outcome_message = f"<b>{pet_to_explore['name']}</b> не нашел монстров в <b>{zone_data['name']}</b>, но и ничего не нашел."
-    else: # Resource find / Normal exploration
-        coins_found_final = random.randint(EXPLORE_BASE_COIN_RANGE[0], EXPLORE_BASE_COIN_RANGE[1])
-        xp_gain_final = random.randint(EXPLORE_BASE_XP_RANGE[0], EXPLORE_BASE_XP_RANGE[1])
-
-        # Apply zone buff
-        coins_found_final = int(coins_found_final * buff_multiplier_coin)
-        xp_gain_final = int(xp_gain_final * buff_multiplier_xp)
-        
-        coins_found_final += pet_to_explore.get('coin_rate', 0) # Add pet's coin_rate, use .get for robustness
-
-        message_template = random.choice(EXPLORE_SUCCESS_MESSAGES)
-        outcome_message = message_template.format(
-            pet_name=pet_to_explore['name'],
-            zone_name_ru=zone_data['name'],
-            coins=coins_found_final,
-            xp=xp_gain_final
-        )
-
-    # --- Apply Final Rewards and Update User Stats ---
-    if xp_gain_final > 0:
-        await execute_query("UPDATE pets SET xp = xp + $1 WHERE id = $2 AND user_id = $3",
-                            {"xp_gain": xp_gain_final, "id": pet_id, "user_id": uid})
-        await check_and_level_up_pet(message.bot, uid, pet_id) # Check level up after XP gain
+            outcome["text"] = f"<b>{pet_name}</b> не нашел монстров в <b>{job['zone']}</b>, но и ничего не нашел."
+        return outcome
 
-    if coins_found_final > 0:
-        await execute_query("UPDATE users SET coins = coins + $1, total_coins_collected = total_coins_collected + $1 WHERE user_id = $2",
-                            {"coins": coins_found_final, "uid": uid}) # Update total_coins_collected
-
-    # Update explore_counts for the zone
-    user_data = await fetch_one("SELECT explore_counts FROM users WHERE user_id = $1", {"uid": uid})
-    explore_counts = json.loads(user_data.get('explore_counts', '{}') or '{}')
-    explore_counts[zone_name] = explore_counts.get(zone_name, 0) + 1
-    await execute_query("UPDATE users SET explore_counts = $1 WHERE user_id = $2",
-                        {"explore_counts": json.dumps(explore_counts), "uid": uid})
+    # Resource find / Normal exploration, zone buff applies here
+    buff_multiplier_xp = 1.0
+    buff_multiplier_coin = 1.0
+    if job['buff_type'] == 'xp_rate':
+        buff_multiplier_xp = 1.0 + (float(job['buff_value']) / 100)
+    elif job['buff_type'] == 'coin_rate':
+        buff_multiplier_coin = 1.0 + (float(job['buff_value']) / 100)
+
+    coins = int(random.randint(EXPLORE_BASE_COIN_RANGE[0], EXPLORE_BASE_COIN_RANGE[1]) * buff_multiplier_coin)
+    xp = int(random.randint(EXPLORE_BASE_XP_RANGE[0], EXPLORE_BASE_XP_RANGE[1]) * buff_multiplier_xp)
+    coins += job['coin_rate'] or 0 # Add pet's coin_rate
+
+    outcome["xp"] = xp
+    outcome["coins"] = coins
+    outcome["text"] = random.choice(EXPLORE_SUCCESS_MESSAGES).format(
+        pet_name=pet_name, zone_name_ru=job['zone'], coins=coins, xp=xp
+    )
+    return outcome
 
+def render_exploration_result(job: dict, outcome: dict, energy: int) -> str:
     final_summary_text = f"<b>Результаты исследования:</b>\n"
-    if xp_gain_final > 0:
-        final_summary_text += f"➕ {xp_gain_final} XP для <b>{pet_to_explore['name']}</b>\n"
-    if coins_found_final > 0:
-        final_summary_text += f"💰 {coins_found_final} монет\n"
-    if not (xp_gain_final > 0 or coins_found_final > 0):
+    if outcome['xp'] > 0:
+        final_summary_text += f"➕ {outcome['xp']} XP для <b>{job['pet_name']}</b>\n"
+    if outcome['coins'] > 0:
+        final_summary_text += f"💰 {outcome['coins']} монет\n"
+    if not (outcome['xp'] > 0 or outcome['coins'] > 0):
         final_summary_text += "Ничего особого не найдено, но приключение того стоило!\n"
 
-    # Fetch updated energy after all deductions/rewards
-    updated_current_energy = await recalculate_energy(uid) # Re-fetch to show precise current state
+    text = f"{outcome['text']}\n\n{final_summary_text}\n⚡️ Энергия: {energy}/{MAX_ENERGY}"
+    if outcome['battle_text']:
+        text = f"{outcome['battle_text']}\n\n{text}"
+    return text
 
-    try:
-        await explore_message.edit_text( # Attempt to edit the initial exploration message
-            f"{outcome_message}\n\n"
-            f"{final_summary_text}"
-            f"\n⚡️ Энергия: {updated_current_energy}/{MAX_ENERGY}",
-            parse_mode="HTML"
-        )
+async def deliver_exploration_result(bot, job: dict, outcome: dict, energy: int):
+    text = render_exploration_result(job, outcome, energy)
+    try: # Attempt to edit the initial exploration message
+        await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'], text=text, parse_mode="HTML")
     except TelegramBadRequest as e:
         if "message is not modified" not in str(e):
-            await message.answer( # Fallback to new message if edit fails (e.g., too old)
-                f"{outcome_message}\n\n"
-                f"{final_summary_text}"
-                f"\n⚡️ Энергия: {updated_current_energy}/{MAX_ENERGY}",
-                parse_mode="HTML"
-            )
-    await asyncio.sleep(0.5)
+            await bot.send_message(job['chat_id'], text, parse_mode="HTML") # Fallback to new message if edit fails
+    except Exception as e:
+        print(f"Не удалось отправить результат исследования {job['id']}: {e}")
+
+    if outcome['xp'] > 0:
+        await check_and_level_up_pet(bot, job['user_id'], job['pet_id']) # Check level up after XP gain
+
+async def resolve_explorations(bot, job_ids: list[int]):
+    """Resolves a batch of due explorations: one read, one transaction for all rewards, then messages."""
+    jobs = await fetch_all("""
+        SELECT e.id, e.user_id, e.pet_id, e.zone, e.chat_id, e.message_id,
+               p.name AS pet_name, p.level AS pet_level, p.atk, p.def, p.hp, p.coin_rate,
+               u.energy, u.last_energy_update
+        FROM explorations e
+        JOIN users u ON u.user_id = e.user_id
+        LEFT JOIN pets p ON p.id = e.pet_id AND p.user_id = e.user_id
+        WHERE e.id = ANY($1::int[]) AND e.resolved_at IS NULL
+    """, {"ids": job_ids})
+
+    # Zone settings and monsters come from the in-memory catalog; unknown zones are skipped as the old JOIN did
+    zone_jobs = []
+    for job in jobs:
+        zone = get_zone(job['zone'])
+        if zone is not None:
+            zone_jobs.append(dict(job, pve_chance=zone['pve_chance'], buff_type=zone['buff_type'], buff_value=zone['buff_value']))
+    jobs = zone_jobs
+    if not jobs:
+        return
 
-    await check_quest_progress(uid, message) # Moved this to the end of exploration process
+    outcomes = {}
+    for job in jobs:
+        if job['pet_name'] is None: # Питомец продан или слит, пока гулял
+            outcomes[job['id']] = {"xp": 0, "coins": 0, "monster_defeated": None, "battle_text": None,
+                                   "text": "🐾 Питомец не вернулся из исследования: его больше нет в твоей коллекции."}
+        else:
+            outcomes[job['id']] = roll_exploration_outcome(job, list(get_zone_monsters(job['zone'])))
+
+    # Сводим награды по питомцам и игрокам, чтобы в unnest не было повторяющихся ключей
+    async with transaction() as tx:
+        claimed = await tx.fetch_all(
+            "UPDATE explorations SET resolved_at = NOW() WHERE id = ANY($1::int[]) AND resolved_at IS NULL RETURNING id",
+            {"ids": [job['id'] for job in jobs]}
+        )
+        claimed_ids = {row['id'] for row in claimed}
+        jobs = [job for job in jobs if job['id'] in claimed_ids]
+
+        pet_xp = {}
+        user_rewards = {}
+        for job in jobs:
+            outcome = outcomes[job['id']]
+            if outcome['xp'] > 0:
+                pet_xp[job['pet_id']] = pet_xp.get(job['pet_id'], 0) + outcome['xp']
+            rewards = user_rewards.setdefault(job['user_id'], {"coins": 0, "explore": {}, "monsters": {}})
+            rewards["coins"] += outcome['coins']
+            if job['pet_name'] is not None:
+                rewards["explore"][job['zone']] = rewards["explore"].get(job['zone'], 0) + 1
+            if outcome['monster_defeated']:
+                rewards["monsters"][outcome['monster_defeated']] = rewards["monsters"].get(outcome['monster_defeated'], 0) + 1
+
+        if pet_xp:
+            await tx.execute_query(
+                "UPDATE pets SET xp = pets.xp + u.xp FROM unnest($1::int[], $2::int[]) AS u(id, xp) WHERE pets.id = u.id",
+                {"ids": list(pet_xp), "xp": list(pet_xp.values())}
+            )
+        if user_rewards:
+            await tx.execute_query("""
+                UPDATE users SET
+                    coins = users.coins + u.coins,
+                    total_coins_collected = users.total_coins_collected + u.coins,
+                    explore_counts = COALESCE(users.explore_counts, '{}'::jsonb) || (
+                        SELECT COALESCE(jsonb_object_agg(d.key, COALESCE((users.explore_counts ->> d.key)::int, 0) + d.value::int), '{}'::jsonb)
+                        FROM jsonb_each_text(u.explore_delta) AS d
+                    ),
+                    monsters_defeated_counts = COALESCE(users.monsters_defeated_counts, '{}'::jsonb) || (
+                        SELECT COALESCE(jsonb_object_agg(d.key, COALESCE((users.monsters_defeated_counts ->> d.key)::int, 0) + d.value::int), '{}'::jsonb)
+                        FROM jsonb_each_text(u.monsters_delta) AS d
+                    )
+                FROM unnest($1::bigint[], $2::int[], $3::jsonb[], $4::jsonb[]) AS u(user_id, coins, explore_delta, monsters_delta)
+                WHERE users.user_id = u.user_id
+            """, {
+                "user_ids": list(user_rewards),
+                "coins": [r["coins"] for r in user_rewards.values()],
+                "explore": [json.dumps(r["explore"]) for r in user_rewards.values()],
+                "monsters": [json.dumps(r["monsters"]) for r in user_rewards.values()],
+            })
+
+    # Транзакция закоммичена — снимки users этих игроков устарели, рассылаем результаты
+    invalidate_users(user_rewards)
+    now_utc = datetime.now(timezone.utc)
+    await asyncio.gather(*(
+        deliver_exploration_result(bot, job, outcomes[job['id']], current_energy(job, EXPLORE_ENERGY, now_utc))
+        for job in jobs
+    ))
+
+    # One quest update for the whole batch: only quests matching these zones and counters are touched
+    quest_events = []
+    for job in jobs:
+        outcome = outcomes[job['id']]
+        if job['pet_name'] is not None:
+            quest_events.append(QuestEvent(job['user_id'], EXPLORE_ZONE, zone=job['zone']))
+        if outcome['monster_defeated']:
+            quest_events.append(QuestEvent(job['user_id'], DEFEAT_MONSTERS_ZONE, zone=job['zone']))
+        quest_events.append(QuestEvent(job['user_id'], COLLECT_COINS, outcome['coins']))
+    await emit_quest_events(quest_events, bot)
+
+def start_explore_scheduler(bot):
+    """Запускает планировщик исследований. Вызывается один раз из main.py."""
+    return asyncio.create_task(explore_scheduler.scheduler_loop(lambda job_ids: resolve_explorations(bot, job_ids)))
 
 
 @router.callback_query(F.data.startswith("select_explore_zone_"))
@@ -565,7 +495,8 @@ async def select_explore_zone_callback(callback: CallbackQuery):
     uid = callback.from_user.id
     zone_name = callback.data.split("select_explore_zone_")[1]
 
-    user_pets_db = await fetch_all("SELECT id, name, level, rarity FROM pets WHERE user_id = $1 ORDER BY level DESC, rarity DESC", {"uid": uid})
+    # Only the strongest pets are listed; the full collection is browsable with /pets
+    user_pets_db, _, _ = await fetch_pet_page(uid, "level", limit=EXPLORE_PICKER_SIZE, columns="id, name, level, rarity")
     
     if not user_pets_db:
         await callback.message.answer("У тебя нет питомцев для исследования этой зоны.")
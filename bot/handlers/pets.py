@@ -1,35 +1,72 @@
-import json
 from math import ceil
 from aiogram import Router, F
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from db.db import fetch_all
+from bot.utils.pet_generator import PET_CLASSES
+from bot.utils.pet_query import PetFilter, RARITY_ORDER, PET_SORTS, fetch_pet_page, pet_cursor, count_pets, stats_from_row
 
 router = Router()
 
 PETS_PER_PAGE = 5
 
+SORT_TITLES = {"id": "ID", "level": "Уровень", "rarity": "Редкость"}
+SORT_ALIASES = {"id": "id", "level": "level", "уровень": "level", "rarity": "rarity", "редкость": "rarity"}
+
+def parse_pets_args(args: str):
+    """/pets [уровень|редкость] [редкость питомца] [класс] [команда] [аренда] -> (sort, PetFilter)"""
+    sort = "id"
+    pet_filter = PetFilter()
+    text = (args or "").strip().lower()
+    if not text:
+        return sort, pet_filter
+
+    # Редкости проверяем от длинных к коротким, чтобы «Очень Редкая» не совпала как «Редкая»
+    for rarity in sorted(RARITY_ORDER, key=len, reverse=True):
+        if rarity.lower() in text:
+            pet_filter.rarities = [rarity]
+            text = text.replace(rarity.lower(), " ")
+            break
+    for pet_class in PET_CLASSES:
+        if pet_class.lower() in text:
+            pet_filter.pet_class = pet_class
+            text = text.replace(pet_class.lower(), " ")
+            break
+    for word in text.split():
+        if word in SORT_ALIASES:
+            sort = SORT_ALIASES[word]
+        elif word in ("команда", "team"):
+            pet_filter.in_team = True
+        elif word in ("аренда", "rented"):
+            pet_filter.rented = True
+    return sort, pet_filter
+
 @router.message(Command("pets"))
-async def pets_cmd(message: Message):
-    await show_pets_paginated(message.from_user.id, message)
+async def pets_cmd(message: Message, command: CommandObject):
+    sort, pet_filter = parse_pets_args(command.args)
+    await show_pets_paginated(message.from_user.id, message, sort=sort, pet_filter=pet_filter)
 
-async def show_pets_paginated(uid: int, message: Message | CallbackQuery, page: int = 1):
-    pets = await fetch_all("SELECT * FROM pets WHERE user_id = $1", {"uid": uid})
+async def show_pets_paginated(uid: int, message: Message | CallbackQuery, page: int = 1,
+                              sort: str = "id", pet_filter: PetFilter = None,
+                              after: tuple = None, before: tuple = None):
+    pet_filter = pet_filter or PetFilter()
+    pets, has_prev, has_next = await fetch_pet_page(uid, sort, pet_filter, after=after, before=before, limit=PETS_PER_PAGE)
+    if not pets and (after is not None or before is not None):
+        # За курсором никого не осталось (питомцев продали, слили или обменяли) — показываем первую страницу
+        return await show_pets_paginated(uid, message, page=1, sort=sort, pet_filter=pet_filter)
     if not pets:
-        await message.answer("У тебя пока нет питомцев 😿\nКупи яйцо через /buy_egg и выведи кого-то!")
+        empty_text = "У тебя пока нет питомцев 😿\nКупи яйцо через /buy_egg и выведи кого-то!"
+        if pet_filter.encode():
+            empty_text = "Под этот фильтр не подходит ни один питомец. Напиши /pets без параметров, чтобы увидеть всех."
+        await message.answer(empty_text)
         return
 
-    total_pages = max(1, ceil(len(pets) / PETS_PER_PAGE))
+    total_pages = max(1, ceil(await count_pets(uid, pet_filter) / PETS_PER_PAGE))
     page = max(1, min(page, total_pages))
 
-    start = (page - 1) * PETS_PER_PAGE
-    end = start + PETS_PER_PAGE
-    page_pets = pets[start:end]
-
-    text = f"🐾 <b>Твои питомцы (стр. {page}/{total_pages}):</b>\n\n"
-    for pet in page_pets:
-        stats = json.loads(pet["stats"])
+    text = f"🐾 <b>Твои питомцы (стр. {page}/{total_pages}, сортировка: {SORT_TITLES[sort]}):</b>\n\n"
+    for pet in pets:
+        stats = stats_from_row(pet)
         text += (
             f"🔸 <b>ID {pet['id']}</b> — {pet['name']} ({pet['rarity']}, {pet['class']})\n"
             f"🏅 Уровень: {pet['level']} | XP: {pet['xp']}/{pet['xp_needed']}\n"
@@ -37,13 +74,21 @@ async def show_pets_paginated(uid: int, message: Message | CallbackQuery, page:
             f"💸 Приносит: {pet['coin_rate']} петкойнов/час\n\n"
         )
 
+    # callback_data: pets_pg:<сортировка>:<фильтр>:<n|p>:<курсор>:<номер страницы>
+    filter_code = pet_filter.encode()
     kb = InlineKeyboardBuilder()
-    if page > 1:
-        kb.button(text="⬅️ Назад", callback_data=f"pets_page:{page-1}")
+    if has_prev:
+        cursor = ",".join(map(str, pet_cursor(pets[0], sort)))
+        kb.button(text="⬅️ Назад", callback_data=f"pets_pg:{sort}:{filter_code}:p:{cursor}:{page-1}")
     kb.button(text=f"📄 Страница {page}/{total_pages}", callback_data="noop")
-    if page < total_pages:
-        kb.button(text="➡️ Вперёд", callback_data=f"pets_page:{page+1}")
+    if has_next:
+        cursor = ",".join(map(str, pet_cursor(pets[-1], sort)))
+        kb.button(text="➡️ Вперёд", callback_data=f"pets_pg:{sort}:{filter_code}:n:{cursor}:{page+1}")
     kb.adjust(3)
+    kb.row(*[
+        InlineKeyboardButton(text=("• " if key == sort else "") + title, callback_data=f"pets_pg:{key}:{filter_code}:f::1")
+        for key, title in SORT_TITLES.items()
+    ])
 
     if isinstance(message, CallbackQuery):
         await message.message.edit_text(text.strip(), reply_markup=kb.as_markup())
@@ -51,8 +96,16 @@ async def show_pets_paginated(uid: int, message: Message | CallbackQuery, page:
     else:
         await message.answer(text.strip(), reply_markup=kb.as_markup())
 
-@router.callback_query(F.data.startswith("pets_page:"))
+@router.callback_query(F.data.startswith("pets_pg:"))
 async def paginate_pets(call: CallbackQuery):
     uid = call.from_user.id
-    page = int(call.data.split(":")[1])
-    await show_pets_paginated(uid, call, page)
+    _, sort, filter_code, direction, cursor_raw, page = call.data.split(":")
+    if sort not in PET_SORTS:
+        await call.answer()
+        return
+    cursor = tuple(int(v) for v in cursor_raw.split(",")) if cursor_raw else None
+    await show_pets_paginated(
+        uid, call, int(page), sort=sort, pet_filter=PetFilter.decode(filter_code),
+        after=cursor if direction == "n" else None,
+        before=cursor if direction == "p" else None
+    )
@@ -1,7 +1,8 @@
 # sell.py
+import asyncio
 import json
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from math import ceil
 
 from aiogram import Router, F
@@ -9,7 +10,9 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKe
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from db.db import fetch_one, fetch_all, execute_query
+from db.db import fetch_one, fetch_all, execute_query, transaction
+from bot.utils.pet_query import PetFilter, fetch_pet_page, count_pets, invalidate_pet_counts
+from bot.utils.user_snapshot import invalidate_user
 
 # Assume RARITY_ORDER is imported or defined similarly to trade.py
 RARITY_ORDER = [
@@ -19,6 +22,8 @@ RARITY_ORDER = [
 
 router = Router()
 
+SELL_PAGE_SIZE = 10 # Питомцев на одной странице у скупщика
+
 # --- NPC Buyers Configuration ---
 # Each NPC has a name, description, preferred rarity, and a base price multiplier.
 # The actual price will depend on the pet's rarity and this multiplier.
@@ -58,8 +63,8 @@ BASE_RARITY_PRICES = {
 }
 
 # Helper function to check if a pet is in a user's active arena team
-async def is_pet_in_arena_team(user_id: int, pet_id: int) -> bool:
-    arena_team_data = await fetch_one("SELECT pet_ids FROM arena_team WHERE user_id = $1", {"user_id": user_id})
+async def is_pet_in_arena_team(user_id: int, pet_id: int, tx=None) -> bool:
+    arena_team_data = await (tx.fetch_one if tx else fetch_one)("SELECT pet_ids FROM arena_team WHERE user_id = $1", {"user_id": user_id})
     if arena_team_data and arena_team_data["pet_ids"]:
         active_pet_ids = json.loads(arena_team_data["pet_ids"])
         return pet_id in active_pet_ids
@@ -101,7 +106,10 @@ async def sell_cmd(message: Message):
 # Callback for choosing an NPC buyer
 @router.callback_query(F.data.startswith("npc_sell:"))
 async def choose_npc_sell(call: CallbackQuery):
-    npc_name = call.data.split(":")[1]
+    # npc_sell:<имя скупщика>[:<id последнего питомца прошлой страницы>]
+    parts = call.data.split(":")
+    npc_name = parts[1]
+    after_id = int(parts[2]) if len(parts) > 2 and parts[2] else None
     uid = call.from_user.id
 
     if npc_name not in NPC_BUYERS:
@@ -110,27 +118,20 @@ async def choose_npc_sell(call: CallbackQuery):
 
     npc_info = NPC_BUYERS[npc_name]
 
-    pets = await fetch_all("SELECT * FROM pets WHERE user_id = $1", {"uid": uid})
-    if not pets:
-        await call.message.edit_text(
-            f"👤 <b>{npc_name}:</b> У тебя нет питомцев для продажи, юный тренер! Возвращайся, когда обзаведёшься пушистыми друзьями!",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад на рынок", callback_data="back_to_sell_market")]
-            ]),
-            parse_mode="HTML"
-        )
-        await call.answer()
-        return
-
-    # Filter pets that this NPC accepts
-    accepted_pets = [
-        p for p in pets 
-        if p["rarity"] in npc_info["preferred_rarities"] or npc_info["accepts_all_rarities"]
-    ]
+    # Скупщик видит только подходящие ему редкости — фильтр и страница считаются в БД
+    pet_filter = PetFilter(rarities=[] if npc_info["accepts_all_rarities"] else list(npc_info["preferred_rarities"]))
+    accepted_pets, _, has_next = await fetch_pet_page(
+        uid, "id", pet_filter, after=(after_id,) if after_id else None, limit=SELL_PAGE_SIZE,
+        columns="id, name, rarity"
+    )
 
-    if not accepted_pets:
+    if not accepted_pets and after_id is None:
+        if not await count_pets(uid):
+            no_pets_text = f"👤 <b>{npc_name}:</b> У тебя нет питомцев для продажи, юный тренер! Возвращайся, когда обзаведёшься пушистыми друзьями!"
+        else:
+            no_pets_text = f"👤 <b>{npc_name}:</b> Увы, но мне не интересны твои питомцы... Приноси тех, что я люблю!"
         await call.message.edit_text(
-            f"👤 <b>{npc_name}:</b> Увы, но мне не интересны твои питомцы... Приноси тех, что я люблю!",
+            no_pets_text,
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🔙 Назад на рынок", callback_data="back_to_sell_market")]
             ]),
@@ -142,22 +143,25 @@ async def choose_npc_sell(call: CallbackQuery):
     text = f"👤 <b>{npc_name}:</b> Отлично! Покажи, что у тебя есть.\n\n"
     text += "Я готов(а) купить следующих питомцев:\n\n"
 
+    # Состав арена-команды читаем один раз, а не по запросу на каждого питомца
+    arena_team_data = await fetch_one("SELECT pet_ids FROM arena_team WHERE user_id = $1", {"user_id": uid})
+    team_pet_ids = set(json.loads(arena_team_data["pet_ids"])) if arena_team_data and arena_team_data["pet_ids"] else set()
+
     kb = InlineKeyboardBuilder()
     for pet in accepted_pets:
         base_price = BASE_RARITY_PRICES.get(pet["rarity"], 0)
         final_price = int(base_price * npc_info["price_multiplier"])
-        
-        # Check if pet is in arena team
-        is_in_arena = await is_pet_in_arena_team(uid, pet["id"])
-        
-        if is_in_arena:
+
+        if pet["id"] in team_pet_ids:
             button_text = f"🚫 ID {pet['id']} {pet['name']} ({pet['rarity']}) — В команде"
             kb.button(text=button_text, callback_data="noop") # Disable button
         else:
             button_text = f"💰 Продать ID {pet['id']} {pet['name']} ({pet['rarity']}) за {final_price} Петкойнов"
             kb.button(text=button_text, callback_data=f"confirm_sell:{pet['id']}:{npc_name}")
-            
+
     kb.adjust(1)
+    if has_next:
+        kb.row(InlineKeyboardButton(text="➡️ Ещё питомцы", callback_data=f"npc_sell:{npc_name}:{accepted_pets[-1]['id']}"))
     kb.row(InlineKeyboardButton(text="🔙 Назад на рынок", callback_data="back_to_sell_market"))
 
     await call.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
@@ -169,34 +173,40 @@ async def confirm_sell_pet(call: CallbackQuery):
     _, pet_id_str, npc_name = call.data.split(":")
     pet_id = int(pet_id_str)
 
-    pet = await fetch_one("SELECT * FROM pets WHERE id = $1 AND user_id = $2", {"id": pet_id, "user_id": uid})
-    if not pet:
-        await call.answer("❌ У тебя нет такого питомца.", show_alert=True)
-        await call.message.delete() # Clean up old message
-        return
-
-    if await is_pet_in_arena_team(uid, pet_id):
-        await call.answer("🚫 Этот питомец сейчас находится в твоей активной арена-команде. Сначала убери его оттуда!", show_alert=True)
-        # Re-display the NPC's pet list with updated status if possible, or just inform.
-        # For simplicity, we just answer the callback here.
-        return
-
     npc_info = NPC_BUYERS.get(npc_name)
     if not npc_info:
         await call.answer("🧐 Скупщик не найден.", show_alert=True)
         return
 
-    # Re-check if NPC accepts this pet (in case of race condition or old button press)
-    if not (pet["rarity"] in npc_info["preferred_rarities"] or npc_info["accepts_all_rarities"]):
-        await call.answer(f"🚫 {npc_name} больше не интересуется этим питомцем ({pet['rarity']}).", show_alert=True)
-        return
+    # Проверки и продажа в одной транзакции: питомец блокируется FOR UPDATE,
+    # так что повторное нажатие кнопки не начислит монеты дважды.
+    # Ответы отправляются после COMMIT: ожидание лимитера не должно держать блокировку и соединение
+    error = None
+    async with transaction() as tx:
+        pet = await tx.fetch_one("SELECT * FROM pets WHERE id = $1 AND user_id = $2 FOR UPDATE", {"id": pet_id, "user_id": uid})
+        if not pet:
+            error = "❌ У тебя нет такого питомца."
+        elif await is_pet_in_arena_team(uid, pet_id, tx=tx):
+            error = "🚫 Этот питомец сейчас находится в твоей активной арена-команде. Сначала убери его оттуда!"
+        # Re-check if NPC accepts this pet (in case of race condition or old button press)
+        elif not (pet["rarity"] in npc_info["preferred_rarities"] or npc_info["accepts_all_rarities"]):
+            error = f"🚫 {npc_name} больше не интересуется этим питомцем ({pet['rarity']})."
+        else:
+            base_price = BASE_RARITY_PRICES.get(pet["rarity"], 0)
+            final_price = int(base_price * npc_info["price_multiplier"])
 
-    base_price = BASE_RARITY_PRICES.get(pet["rarity"], 0)
-    final_price = int(base_price * npc_info["price_multiplier"])
+            # Perform the sale
+            await tx.execute_query("DELETE FROM pets WHERE id = $1", {"id": pet_id})
+            await tx.execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2", {"coins": final_price, "user_id": uid})
+
+    if error:
+        await call.answer(error, show_alert=True)
+        if not pet:
+            await call.message.delete() # Clean up old message
+        return
 
-    # Perform the sale
-    await execute_query("DELETE FROM pets WHERE id = $1", {"id": pet_id})
-    await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2", {"coins": final_price, "user_id": uid})
+    invalidate_pet_counts(uid)
+    invalidate_user(uid)
 
     await call.message.edit_text(
         f"🎉 Ты успешно продал(а) <b>{pet['name']}</b> ({pet['rarity']}) <b>{npc_name}</b> за <b>{final_price}</b> Петкойнов! 💰",
@@ -333,19 +343,16 @@ async def rent_confirm(call: CallbackQuery):
         await call.answer(f"🧐 {pet['name']} уже в аренде до {pet['rented_until'].strftime('%d.%m.%Y %H:%M')}.", show_alert=True)
         return
 
-    rented_until = datetime.now() + timedelta(days=days)
+    rented_until = datetime.now(timezone.utc) + timedelta(days=days)
     base_price = BASE_RARITY_PRICES.get(pet["rarity"], 0)
     total_profit = int(base_price * RENT_COST_PER_DAY_MULTIPLIER * days)
 
+    # Expected profit is paid out by the rent payout task once rented_until passes
     await execute_query(
-        "UPDATE pets SET rented_until = $1, last_rent_payout = $2 WHERE id = $3",
-        {"rented_until": rented_until, "last_rent_payout": datetime.now(), "id": pet_id}
-    )
-    # Store expected profit for later payout (e.g., in a background task)
-    await execute_query(
-        "UPDATE pets SET expected_rent_profit = $1 WHERE id = $2",
-        {"expected_rent_profit": total_profit, "id": pet_id}
+        "UPDATE pets SET rented_until = $1, last_rent_payout = $2, expected_rent_profit = $3 WHERE id = $4",
+        {"rented_until": rented_until, "last_rent_payout": datetime.now(timezone.utc), "expected_rent_profit": total_profit, "id": pet_id}
     )
+    invalidate_pet_counts(uid)
 
     await call.message.edit_text(
         f"🎉 <b>{pet['name']}</b> (ID {pet_id}) успешно сдан(а) в аренду на <b>{days}</b> дней!\n"
@@ -400,34 +407,87 @@ async def show_rented_pets_callback(call: CallbackQuery):
     await call.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
     await call.answer()
 
-# --- Background task for rent payouts (needs to be called periodically from your main bot loop) ---
-async def process_rent_payouts():
-    # Find pets whose rent period has ended
-    overdue_rentals = await fetch_all("SELECT * FROM pets WHERE rented_until IS NOT NULL AND rented_until < $1", {"now": datetime.now()})
-
-    for pet in overdue_rentals:
-        user_id = pet["user_id"]
-        profit = pet.get("expected_rent_profit", 0)
-
-        # Add coins to user
-        await execute_query("UPDATE users SET coins = coins + $1 WHERE user_id = $2", {"coins": profit, "user_id": user_id})
-        # Reset pet's rent status
-        await execute_query("UPDATE pets SET rented_until = NULL, expected_rent_profit = 0, last_rent_payout = NULL WHERE id = $1", {"id": pet["id"]})
+# --- Выплаты за аренду: фоновая задача, запускается из main.py ---
+RENT_CHECK_INTERVAL_SECONDS = 30
+RENT_SETTLE_BATCH_SIZE = 5000 # Питомцев за одну транзакцию; больше — следующей пачкой сразу же
+RENT_NOTIFY_CONCURRENCY = 20 # Одновременных отправок уведомлений; темп дальше держит лимитер исходящих
+RENT_NOTIFY_MAX_PETS = 10 # Питомцев, перечисляемых поимённо в одном уведомлении
+
+# Одна транзакция на пачку: истёкшие аренды блокируются (SKIP LOCKED — второй воркер возьмёт другие),
+# питомцы возвращаются, прибыль начисляется одним UPDATE на игрока. Сравнение с NOW() — на стороне БД,
+# rented_until хранится в TIMESTAMPTZ, поэтому часовой пояс процесса бота не важен.
+SETTLE_RENTALS_QUERY = """
+    WITH expired AS (
+        SELECT id, user_id, name, rarity, COALESCE(expected_rent_profit, 0) AS profit
+        FROM pets
+        WHERE rented_until IS NOT NULL AND rented_until <= NOW()
+        ORDER BY rented_until
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ), returned AS (
+        UPDATE pets p SET rented_until = NULL, expected_rent_profit = 0, last_rent_payout = NULL
+        FROM expired e
+        WHERE p.id = e.id
+    ), credited AS (
+        UPDATE users u SET coins = u.coins + t.profit
+        FROM (SELECT user_id, SUM(profit)::int AS profit FROM expired GROUP BY user_id) AS t
+        WHERE u.user_id = t.user_id
+    )
+    SELECT user_id, name, rarity, profit FROM expired
+"""
+
+async def settle_expired_rentals() -> list:
+    """Закрывает пачку истёкших аренд. Возвращает вернувшихся питомцев (user_id, name, rarity, profit)."""
+    rows = await fetch_all(SETTLE_RENTALS_QUERY, {"limit": RENT_SETTLE_BATCH_SIZE})
+    for user_id in {row["user_id"] for row in rows}:
+        invalidate_pet_counts(user_id) # Фильтр «в аренде» в /pets
+        invalidate_user(user_id)
+    return rows
+
+async def notify_rent_returns(bot, rows: list):
+    """Одно сообщение на игрока, сколько бы его питомцев ни вернулось разом."""
+    returned_by_user: dict[int, list] = {}
+    for row in rows:
+        returned_by_user.setdefault(row["user_id"], []).append(row)
+
+    semaphore = asyncio.Semaphore(RENT_NOTIFY_CONCURRENCY)
+
+    async def notify(user_id: int, pets: list):
+        total_profit = sum(pet["profit"] for pet in pets)
+        if len(pets) == 1:
+            text = (f"🎉 Твой питомец <b>{pets[0]['name']}</b> ({pets[0]['rarity']}) вернулся из аренды! "
+                    f"Ты получил(а) <b>{total_profit}</b> Петкойнов прибыли! 💰")
+        else:
+            names = ", ".join(f"<b>{pet['name']}</b>" for pet in pets[:RENT_NOTIFY_MAX_PETS])
+            if len(pets) > RENT_NOTIFY_MAX_PETS:
+                names += f" и ещё {len(pets) - RENT_NOTIFY_MAX_PETS}"
+            text = (f"🎉 Из аренды вернулись {len(pets)} питомцев: {names}!\n"
+                    f"Ты получил(а) <b>{total_profit}</b> Петкойнов прибыли! 💰")
+        async with semaphore:
+            try:
+                await bot.send_message(user_id, text, parse_mode="HTML")
+            except Exception as e:
+                print(f"Failed to send rent payout notification to {user_id}: {e}") # Заблокировал бота и т.п.
+
+    await asyncio.gather(*(notify(user_id, pets) for user_id, pets in returned_by_user.items()))
+
+async def process_rent_payouts(bot):
+    """Закрывает все истёкшие аренды пачками и рассылает уведомления."""
+    while True:
+        rows = await settle_expired_rentals()
+        if rows:
+            await notify_rent_returns(bot, rows)
+        if len(rows) < RENT_SETTLE_BATCH_SIZE:
+            return
 
-        # Notify user (if bot can reach them)
+async def rent_payout_loop(bot):
+    while True:
         try:
-            bot = router.bot # Access bot object from router
-            await bot.send_message(
-                user_id,
-                f"🎉 Твой питомец <b>{pet['name']}</b> ({pet['rarity']}) вернулся из аренды! "
-                f"Ты получил(а) <b>{profit}</b> Петкойнов прибыли! 💰",
-                parse_mode="HTML"
-            )
+            await process_rent_payouts(bot)
         except Exception as e:
-            print(f"Failed to send rent payout notification to {user_id}: {e}")
-            pass # User might have blocked the bot, etc.
+            print(f"Ошибка при выплатах за аренду: {e}")
+        await asyncio.sleep(RENT_CHECK_INTERVAL_SECONDS)
 
-    # Find pets whose rent is active but payout might be due (e.g., daily payouts)
-    # This example only pays out at the end of the term. If you want daily payouts,
-    # you'd need more complex logic here, e.g., checking last_rent_payout and calculating partial profits.
-    # For simplicity, current design pays expected_rent_profit at rental end.
\ No newline at end of file
+def start_rent_payouts(bot):
+    """Запускает фоновые выплаты за аренду. Вызывается один раз из main.py."""
+    return asyncio.create_task(rent_payout_loop(bot))
@@ -20,18 +20,19 @@ from db.db import (
 
 # Import show_pets_paginated from pets.py
 from bot.handlers.pets import show_pets_paginated
+from bot.utils.egg_inventory import count_eggs
+from bot.utils.catalog import get_zone, get_zones
+from bot.utils.user_snapshot import get_user, update_cached_user, invalidate_user
+from bot.utils.energy import MAX_ENERGY, EXPLORE_ENERGY, current_energy
 # Import zone and quest data definitions
-from bot.data.quests import QUESTS_DEFINITIONS, QUEST_PROGRESS_MAPPING # Make sure QUEST_PROGRESS_MAPPING is defined in bot/data/quests.py
+from bot.data.quests import QUESTS_DEFINITIONS
+from bot.utils.quest_engine import QuestEvent, COLLECT_COINS, COLLECT_EGGS, WIN_ARENA_BATTLES, emit_quest_events, initial_progress
 
 router = Router()
 
-MAX_ENERGY = 200 # Define max energy
-ENERGY_REGEN_RATE_MINUTES = 1 # Define how often energy regenerates (e.g., every 1 minute)
-ENERGY_REGEN_AMOUNT = 1 # How much energy regenerates per period
-
 # Helper function to assign initial quests (moved here from previous response for clarity)
 async def assign_new_quests(uid: int, message_obj: Message = None):
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
     if not user: return
 
     user_quests = await fetch_all("SELECT quest_id, completed, claimed FROM quests WHERE user_id = $1", {"uid": uid})
@@ -39,6 +40,7 @@ async def assign_new_quests(uid: int, message_obj: Message = None):
     user_completed_claimed_quest_ids = {q['quest_id'] for q in user_quests if q['completed'] and q['claimed']}
 
     newly_assigned = []
+    arena_wins = None # Loaded lazily, only if an arena quest is being assigned
     for quest_key, quest_def in QUESTS_DEFINITIONS.items():
         if quest_key in user_assigned_quest_ids:
             continue # Quest already assigned
@@ -52,8 +54,13 @@ async def assign_new_quests(uid: int, message_obj: Message = None):
         # Add other assignment conditions here if needed (e.g., min_user_level etc.)
 
         if can_assign:
+            if quest_def['type'] == WIN_ARENA_BATTLES and arena_wins is None:
+                arena_row = await fetch_one("SELECT wins FROM arena_team WHERE user_id = $1", {"uid": uid})
+                arena_wins = arena_row['wins'] if arena_row else 0
+            # Progress made before the quest was assigned counts; later progress comes from quest events
+            progress = initial_progress(user, quest_def, arena_wins or 0)
+
             # Insert the new quest into the user's quests table
-            # NOTE: Your insert_quest function in db.db.py needs to handle quest_id, goal, reward_egg_type
             await insert_quest(
                 uid,
                 quest_key, # Use quest_id as the primary identifier
@@ -62,7 +69,8 @@ async def assign_new_quests(uid: int, message_obj: Message = None):
                 quest_def.get('zone'), # Can be None
                 quest_def['goal'],
                 quest_def['reward_coins'],
-                quest_def['reward_egg_type'] # Pass the egg type
+                quest_def['reward_egg_type'], # Pass the egg type
+                progress=progress
             )
             newly_assigned.append(quest_def['name'])
             
@@ -70,6 +78,9 @@ async def assign_new_quests(uid: int, message_obj: Message = None):
                 try:
                     await message_obj.answer(f"✨ <b>Новый квест: «{quest_def['name']}»!</b>\n"
                                              f"<i>{quest_def['description']}</i>", parse_mode="HTML")
+                    if progress >= quest_def['goal']:
+                        await message_obj.answer(f"🏆 <b>Квест «{quest_def['name']}» уже выполнен!</b>\n"
+                                                 f"🎁 Награда доступна для получения! Используй команду /quests.", parse_mode="HTML")
                 except TelegramBadRequest as e:
                     print(f"Error sending new quest message: {e}")
 
@@ -78,17 +89,15 @@ async def assign_new_quests(uid: int, message_obj: Message = None):
 @router.message(Command("pstart"))
 async def cmd_start(message: Message):
     uid = message.from_user.id
-    user = await fetch_one(
-        "SELECT * FROM users WHERE user_id = $1", {"uid": uid}
-    )
+    user = await get_user(uid)
     if not user:
         # New user setup: Initialize all new columns with default values
         await execute_query(
-            "INSERT INTO users (user_id, coins, eggs, streak, active_zone, energy, last_energy_update, "
+            "INSERT INTO users (user_id, coins, streak, active_zone, energy, last_energy_update, "
             "hatched_count, merged_count, eggs_collected, explore_counts, monsters_defeated_counts, "
             "total_coins_collected, highest_pet_level)" # Removed last_quest_assigned here as it's not strictly needed at start
-            "VALUES ($1, 500, $2, 0, 'Лужайка', $3, $4, 0, 0, 0, '{}'::jsonb, '{}'::jsonb, 500, 0)",
-            {"uid": uid, "eggs": json.dumps([]), "energy": MAX_ENERGY, "last_energy_update": datetime.now(timezone.utc)},
+            "VALUES ($1, 500, 0, 'Лужайка', $2, $3, 0, 0, 0, '{}'::jsonb, '{}'::jsonb, 500, 0)",
+            {"uid": uid, "energy": MAX_ENERGY, "last_energy_update": datetime.now(timezone.utc)},
         )
         # Unlock first zone (Лужайка) - no cost
         await execute_query(
@@ -96,6 +105,7 @@ async def cmd_start(message: Message):
             "ON CONFLICT (user_id, zone) DO UPDATE SET unlocked = TRUE",
             {"user_id": uid, "zone": "Лужайка"},
         )
+        invalidate_user(uid) # The snapshot of this update still says "not registered"
         # Assign initial quests using the new function
         await assign_new_quests(uid, message) # Pass message to send notifications
         
@@ -111,55 +121,17 @@ async def cmd_start(message: Message):
 async def profile_cmd(message: Message):
     await show_profile(message.from_user.id, message)
 
-# Energy regeneration logic
-async def recalculate_energy(uid: int, user_data: dict) -> dict:
-    last_update = user_data.get("last_energy_update")
-    current_energy = user_data.get("energy", MAX_ENERGY) # Default to MAX_ENERGY if not set
-
-    if not last_update:
-        # If no last_update, set it to now and full energy
-        await execute_query(
-            "UPDATE users SET last_energy_update = $1, energy = $2 WHERE user_id = $3",
-            {"last_update": datetime.now(timezone.utc), "energy": MAX_ENERGY, "uid": uid}
-        )
-        user_data['last_energy_update'] = datetime.now(timezone.utc)
-        user_data['energy'] = MAX_ENERGY
-        return user_data
-
-    time_diff = datetime.now(timezone.utc) - last_update
-    minutes_passed = int(time_diff.total_seconds() / 60)
-
-    if minutes_passed > 0:
-        energy_to_add = minutes_passed * ENERGY_REGEN_AMOUNT
-        new_energy = min(MAX_ENERGY, current_energy + energy_to_add)
-        
-        if new_energy > current_energy: # Only update if energy actually increased
-            await execute_query(
-                "UPDATE users SET energy = $1, last_energy_update = $2 WHERE user_id = $3",
-                {"energy": new_energy, "last_update": datetime.now(timezone.utc), "uid": uid}
-            )
-            user_data['energy'] = new_energy
-            user_data['last_energy_update'] = datetime.now(timezone.utc)
-    return user_data
-
-
 async def show_profile(uid: int, message: Message):
-    user = await fetch_one(
-        "SELECT * FROM users WHERE user_id = $1", {"uid": uid}
-    )
+    user = await get_user(uid)
     if not user:
         return await message.answer(
             "Ты ещё не зарегистрирован. Напиши /pstart!", parse_mode="HTML"
         )
 
-    # Recalculate energy before displaying profile
-    user = await recalculate_energy(uid, user)
+    # Energy regenerates lazily: the current value is computed from the row, nothing is written
+    energy = current_energy(user, EXPLORE_ENERGY)
 
-    # Parse eggs JSON
-    try:
-        eggs = json.loads(user.get("eggs") or "[]")
-    except (json.JSONDecodeError, TypeError):
-        eggs = []
+    eggs_count = await count_eggs(uid)
 
     fav_pet_info_text = ""
     # Check if fav_pet_id exists and is not None (using .get() with default)
@@ -174,6 +146,7 @@ async def show_profile(uid: int, message: Message):
         else:
             # If favorite pet not found (e.g., deleted), clear the field in DB
             await execute_query("UPDATE users SET fav_pet_id = NULL, fav_pet_nickname = NULL WHERE user_id = $1", {"uid": uid})
+            update_cached_user(uid, fav_pet_id=None, fav_pet_nickname=None)
             fav_pet_info_text = "❤️ Любимчик: Нет (предыдущий был удален)\n"
     else:
         fav_pet_info_text = "❤️ Любимчик: Нет\n"
@@ -187,11 +160,7 @@ async def show_profile(uid: int, message: Message):
     kb.adjust(2)  # two columns
 
     # Determine display name
-    try:
-        chat = await message.bot.get_chat(uid)
-        display = chat.first_name or chat.full_name
-    except Exception:
-        display = message.from_user.first_name or f"Пользователь {uid}"
+    display = message.from_user.first_name or message.from_user.full_name
 
     zone_display = user.get("active_zone") or "—"
     text = (
@@ -200,9 +169,9 @@ async def show_profile(uid: int, message: Message):
         f"🌍 <b>Активная зона:</b> <i>{zone_display}</i>\n"
         f"{fav_pet_info_text}"
         f"💰 <b>Петкойны:</b> {user['coins']:,}\n"
-        f"⚡️ <b>Энергия исследований</b>: {user['energy']}/{MAX_ENERGY}\n" # Use MAX_ENERGY
+        f"⚡️ <b>Энергия исследований</b>: {energy}/{MAX_ENERGY}\n" # Use MAX_ENERGY
         f"🔥 <b>Ежедневный стрик:</b> {user['streak']} дней\n"
-        f"🥚 <b>Яиц в инвентаре:</b> {len(eggs)}\n"
+        f"🥚 <b>Яиц в инвентаре:</b> {eggs_count}\n"
         f"━━━━━━━━━━━━━━\n"
         f"🐣 <b>Вылуплено питомцев:</b> {user.get('hatched_count', 0)}\n"
         f"🤝 <b>Объединено питомцев:</b> {user.get('merged_count', 0)}\n" # New field
@@ -218,7 +187,7 @@ async def show_profile(uid: int, message: Message):
 @router.callback_query(F.data == "inventory_cb")
 async def inventory_cb(call: CallbackQuery):
     uid = call.from_user.id
-    user = await fetch_one("SELECT user_items FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
 
     if not user or not user.get('user_items'):
         items = {}
@@ -378,8 +347,17 @@ async def claim_quest_callback(call: CallbackQuery):
 
     # Use the specific claim_quest_reward function that handles different reward types
     success, msg = await claim_quest_reward(uid, quest_db_id)
+    if success:
+        invalidate_user(uid) # Reward coins and egg counters changed in the DB
     
     await call.answer(msg, show_alert=True)
+
+    if success:
+        # Coins and eggs from the reward count towards other quests too
+        events = [QuestEvent(uid, COLLECT_COINS, quest_record['reward_coins'] or 0)]
+        if quest_record['reward_egg_type']:
+            events.append(QuestEvent(uid, COLLECT_EGGS))
+        await emit_quest_events(events, call.bot)
     
     # After claiming a quest, check for new assignable quests
     await assign_new_quests(uid, call.message)
@@ -409,6 +387,7 @@ async def set_zone_callback(call: CallbackQuery):
         "UPDATE users SET active_zone = $1 WHERE user_id = $2",
         {"active_zone": zone_name, "uid": uid}, # Use zone_name
     )
+    update_cached_user(uid, active_zone=zone_name)
     await call.answer(f"🌍 Зона «{zone_name}» выбрана!") # Use zone_name
     await show_zones(uid, call)
 
@@ -418,8 +397,8 @@ async def buy_zone_callback(call: CallbackQuery):
     uid = call.from_user.id
     zone_name = call.data.split(":")[1] # Renamed variable for clarity
 
-    zone_data = await fetch_one("SELECT * FROM zones WHERE name = $1", {"name": zone_name})
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    zone_data = get_zone(zone_name)
+    user = await get_user(uid)
     
     if not zone_data or not user:
         return await call.answer("Ошибка загрузки зоны.", show_alert=True)
@@ -434,7 +413,7 @@ async def buy_zone_callback(call: CallbackQuery):
         return await call.answer("Недостаточно петкойнов 💸", show_alert=True)
     
     # --- Check full unlock_conditions from DB ---
-    conds = json.loads(zone_data.get('unlock_conditions', '{}') or '{}')
+    conds = zone_data['unlock_conditions']
     can_unlock_via_conditions = True
 
     if conds.get('hatched_count') and user.get('hatched_count', 0) < conds['hatched_count']:
@@ -494,11 +473,14 @@ async def buy_zone_callback(call: CallbackQuery):
         return await call.answer(error_msg, show_alert=True)
     # --- End of unlock conditions check ---
 
-    # Deduct coins and unlock
-    await execute_query(
-        "UPDATE users SET coins = coins - $1 WHERE user_id = $2",
+    # Deduct coins and unlock. The snapshot may be a few seconds old, so the balance is re-checked in the UPDATE
+    paid = await execute_query(
+        "UPDATE users SET coins = coins - $1 WHERE user_id = $2 AND coins >= $1",
         {"cost": cost, "uid": uid},
     )
+    invalidate_user(uid)
+    if paid == "UPDATE 0":
+        return await call.answer("Недостаточно петкойнов 💸", show_alert=True)
     await execute_query(
         "INSERT INTO user_zones (user_id, zone, unlocked) VALUES ($1, $2, TRUE) "
         "ON CONFLICT (user_id, zone) DO UPDATE SET unlocked = TRUE",
@@ -508,78 +490,9 @@ async def buy_zone_callback(call: CallbackQuery):
     await show_zones(uid, call)
 
 
-# Quest progress checker (UPDATED)
-async def check_quest_progress(uid: int, message_obj: Message = None): # Renamed `message` to `message_obj` to avoid confusion with internal 'message'
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
-    if not user:
-        return
-    
-    # Get current user progress stats
-    user_data_for_quests = {
-        "hatched_count": user.get('hatched_count', 0),
-        "merged_count": user.get('merged_count', 0),
-        "eggs_collected": user.get('eggs_collected', 0), # Assumes this is tracked separately
-        "explore_counts": json.loads(user.get('explore_counts', '{}') or '{}'),
-        "monsters_defeated_counts": json.loads(user.get('monsters_defeated_counts', '{}') or '{}'),
-        "total_coins_collected": user.get('total_coins_collected', 0), # New field
-        "highest_pet_level": user.get('highest_pet_level', 0), # New field
-    }
-    
-    # Fetch arena wins
-    user_arena_team = await fetch_one("SELECT wins FROM arena_team WHERE user_id = $1", {"uid": uid})
-    user_data_for_quests["arena_wins"] = user_arena_team.get('wins', 0) if user_arena_team else 0
-
-
-    # Fetch quests in progress (not completed and not claimed)
-    quests_in_progress = await fetch_all(
-        "SELECT * FROM quests WHERE user_id = $1 AND completed = FALSE AND claimed = FALSE", {"uid": uid}
-    )
-
-    for q_record in quests_in_progress:
-        quest_def = QUESTS_DEFINITIONS.get(q_record['quest_id'])
-        if not quest_def:
-            continue # Skip if definition not found
-
-        new_progress = q_record['progress'] # Start with current progress
-
-        # Determine new progress based on quest type
-        if quest_def['type'] in QUEST_PROGRESS_MAPPING:
-            mapper_key = QUEST_PROGRESS_MAPPING[quest_def['type']]
-            
-            if mapper_key == "explore_counts" or mapper_key == "monsters_defeated_counts":
-                zone_target = quest_def.get('zone_target')
-                if zone_target:
-                    new_progress = user_data_for_quests[mapper_key].get(zone_target, 0)
-            elif mapper_key == "eggs_collected":
-                # Ensure eggs_collected is tracked by DB update, not just len(user.get("eggs"))
-                new_progress = user_data_for_quests[mapper_key]
-            else:
-                new_progress = user_data_for_quests.get(mapper_key, 0) # Get directly from user_data_for_quests
-
-        # Update quest progress in DB
-        if new_progress >= quest_def['goal'] and not q_record['completed']:
-            await execute_query(
-                "UPDATE quests SET progress = $1, completed = TRUE WHERE id = $2",
-                {"progress": quest_def['goal'], "id": q_record['id']}
-            )
-            if message_obj:
-                try:
-                    await message_obj.answer(
-                        f"🏆 <b>@{message_obj.from_user.username or 'ты'} завершил квест «{quest_def['name']}»!</b>\n"
-                        f"🎁 Награда доступна для получения! Используй команду /quests."
-                    )
-                except TelegramBadRequest as e:
-                    print(f"Error sending quest completion message: {e}")
-        elif new_progress != q_record['progress']:
-            # Only update if progress has actually changed and quest isn't completed yet
-            await execute_query(
-                "UPDATE quests SET progress = $1 WHERE id = $2",
-                {"progress": new_progress, "id": q_record['id']}
-            )
-
 # Zone unlock checker (UPDATED)
 async def check_zone_unlocks(uid: int, message_obj: Message = None): # Renamed `message` to `message_obj`
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    user = await get_user(uid)
     if not user:
         return
     
@@ -602,14 +515,12 @@ async def check_zone_unlocks(uid: int, message_obj: Message = None): # Renamed `
     )
     completed_claimed_quest_ids = {q['quest_id'] for q in user_completed_claimed_quests}
 
-    all_zones_from_db = await fetch_all("SELECT * FROM zones") # Fetch all zone definitions
-
-    for zone_info in all_zones_from_db:
+    for zone_info in get_zones(): # Zone definitions come from the in-memory catalog
         zone_name = zone_info['name']
         if zone_name in unlocked_names_set:
             continue # Already unlocked
 
-        conds = json.loads(zone_info.get('unlock_conditions', '{}') or '{}') # Parse JSONB conditions
+        conds = zone_info['unlock_conditions'] # Already decoded by the catalog
         can_unlock = True
         
         # Check hatched_count condition
@@ -658,22 +569,19 @@ async def check_zone_unlocks(uid: int, message_obj: Message = None): # Renamed `
 
 # Get zone buff multiplier (unchanged, but now uses new zone columns)
 async def get_zone_buff(user_id: int):
-    # Убираем active_zone_buff из SELECT запроса, так как его нет в таблице users
-    user_record = await fetch_one("SELECT active_zone FROM users WHERE user_id = $1", {"uid": user_id})
+    # Строка users — из снимка текущего апдейта
+    user = await get_user(user_id)
 
-    if not user_record:
+    if not user:
         return None
 
-    # Преобразуем asyncpg.Record в изменяемый словарь (это было правильно)
-    user = dict(user_record)
-
     # Получаем данные текущей зоны пользователя
     active_zone_name = user.get('active_zone')
     if not active_zone_name:
         return None
 
-    # Эти данные берутся ИЗ ТАБЛИЦЫ ZONES, что правильно.
-    zone_data = await fetch_one("SELECT buff_type, buff_value FROM zones WHERE name = $1", {"zone_name": active_zone_name})
+    # Данные зоны — из справочника в памяти, без запроса к zones
+    zone_data = get_zone(active_zone_name)
 
     if zone_data:
         return {
@@ -684,8 +592,8 @@ async def get_zone_buff(user_id: int):
 
 # Unified function for zones
 async def show_zones(uid: int, source: Message | CallbackQuery):
-    zones_data = await fetch_all("SELECT * FROM zones")
-    user = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+    zones_data = get_zones()
+    user = await get_user(uid)
     user_zones = await fetch_all(
         "SELECT * FROM user_zones WHERE user_id = $1", {"uid": uid}
     )
@@ -2,17 +2,22 @@
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters import Command
-from db.db import fetch_one, execute_query
+from db.db import fetch_one, fetch_all, execute_query, transaction
+from bot.utils.display_names import get_display_name, get_display_names
+from bot.utils.pet_query import invalidate_pet_counts
+from bot.utils.user_snapshot import get_user
 import json
 import asyncio
 from aiogram.exceptions import TelegramBadRequest
 
 router = Router()
 
-# Global dictionary to store pending trade offers
-# Format: { proposer_uid: { 'target_uid': target_uid, 'proposer_pet_id': proposed_pet_id,
-#                           'proposer_pet_name': pet_name, 'proposer_pet_rarity': rarity_string } }
-pending_trades = {}
+# Предложения обмена хранятся в таблице trade_offers: переживают рестарт и видны всем воркерам.
+# Одно активное предложение на игрока — новое заменяет предыдущее
+TRADE_OFFER_TTL_HOURS = 24
+TRADE_SWEEP_INTERVAL_SECONDS = 60
+TRADE_SWEEP_BATCH_SIZE = 1000
+INCOMING_OFFERS_SHOWN = 10 # Входящих предложений в подсказке /trade
 
 # Define rarity order for R2R system based on provided RARITY_CHANCES
 # This ensures consistency with your game's rarity hierarchy.
@@ -30,13 +35,91 @@ RARITY_ORDER = [r[0] for r in [
 ]]
 
 # Helper function to check if a pet is in a user's active arena team
-async def is_pet_in_arena_team(user_id: int, pet_id: int) -> bool:
-    arena_team_data = await fetch_one("SELECT pet_ids FROM arena_team WHERE user_id = $1", {"user_id": user_id})
+async def is_pet_in_arena_team(user_id: int, pet_id: int, tx=None) -> bool:
+    arena_team_data = await (tx.fetch_one if tx else fetch_one)("SELECT pet_ids FROM arena_team WHERE user_id = $1", {"user_id": user_id})
     if arena_team_data and arena_team_data["pet_ids"]:
         active_pet_ids = json.loads(arena_team_data["pet_ids"])
         return pet_id in active_pet_ids
     return False
 
+async def save_trade_offer(proposer_uid: int, target_uid: int, pet):
+    await execute_query(
+        """
+        INSERT INTO trade_offers (proposer_id, target_id, pet_id, pet_name, rarity, expires_at)
+        VALUES ($1, $2, $3, $4, $5, NOW() + make_interval(hours => $6))
+        ON CONFLICT (proposer_id) DO UPDATE SET
+            target_id = EXCLUDED.target_id, pet_id = EXCLUDED.pet_id, pet_name = EXCLUDED.pet_name,
+            rarity = EXCLUDED.rarity, created_at = NOW(), expires_at = EXCLUDED.expires_at
+        """,
+        {"proposer_id": proposer_uid, "target_id": target_uid, "pet_id": pet["id"],
+         "pet_name": pet["name"], "rarity": pet["rarity"], "ttl_hours": TRADE_OFFER_TTL_HOURS}
+    )
+
+async def fetch_incoming_offers(target_uid: int) -> list:
+    return await fetch_all(
+        "SELECT proposer_id, pet_id, pet_name, rarity FROM trade_offers "
+        "WHERE target_id = $1 AND expires_at > NOW() ORDER BY created_at LIMIT $2",
+        {"target_id": target_uid, "limit": INCOMING_OFFERS_SHOWN}
+    )
+
+async def execute_trade(proposer_uid: int, acceptor_uid: int, acceptor_pet_id: int):
+    """Обмен целиком в одной транзакции. Возвращает (ошибка или None, предложение, питомец принимающего).
+    Предложение, оба питомца и обе арена-команды блокируются, поэтому два одновременных accept
+    не обменяют одного питомца дважды, а владельцы не сменятся наполовину."""
+    async with transaction() as tx:
+        offer = await tx.fetch_one(
+            "SELECT * FROM trade_offers WHERE proposer_id = $1 AND target_id = $2 AND expires_at > NOW() FOR UPDATE",
+            {"proposer_id": proposer_uid, "target_id": acceptor_uid}
+        )
+        if not offer:
+            return "Нет активного предложения обмена от этого пользователя.", None, None
+
+        # Команды блокируются раньше питомцев и в одном порядке: /team не добавит питомца посреди обмена
+        await tx.fetch_all(
+            "SELECT user_id FROM arena_team WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+            {"uids": [proposer_uid, acceptor_uid]}
+        )
+        pets = await tx.fetch_all(
+            "SELECT id, user_id, name, rarity FROM pets WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE",
+            {"ids": [offer["pet_id"], acceptor_pet_id]}
+        )
+        pets_by_id = {pet["id"]: pet for pet in pets}
+        proposer_pet = pets_by_id.get(offer["pet_id"])
+        acceptor_pet = pets_by_id.get(acceptor_pet_id)
+
+        if not acceptor_pet or acceptor_pet["user_id"] != acceptor_uid or acceptor_pet_id == offer["pet_id"]:
+            return "У тебя нет питомца с таким ID.", offer, None
+        if await is_pet_in_arena_team(acceptor_uid, acceptor_pet_id, tx):
+            return "Ты не можешь обменять питомца, который находится в твоей активной арена-команде.", offer, acceptor_pet
+        if (not proposer_pet or proposer_pet["user_id"] != proposer_uid
+                or await is_pet_in_arena_team(proposer_uid, offer["pet_id"], tx)):
+            # Предложение устарело: питомца уже нет у предложившего или он в его команде
+            await tx.execute_query("DELETE FROM trade_offers WHERE proposer_id = $1", {"proposer_id": proposer_uid})
+            return "Питомец из этого предложения больше недоступен для обмена. Предложение отменено.", offer, acceptor_pet
+        # R2R Logic: Only allow trading pets of the same rarity
+        if proposer_pet["rarity"] != acceptor_pet["rarity"]:
+            return (
+                f"Обмен невозможен. Питомцы должны быть <b>одной редкости</b>.\n"
+                f"Твой питомец: <b>{acceptor_pet['name']}</b> ({acceptor_pet['rarity']})\n"
+                f"Питомец оппонента: <b>{proposer_pet['name']}</b> ({proposer_pet['rarity']})"
+            ), offer, acceptor_pet
+
+        # Оба владельца меняются одним UPDATE
+        await tx.execute_query(
+            "UPDATE pets SET user_id = CASE WHEN id = $1 THEN $4::bigint ELSE $3::bigint END WHERE id IN ($1, $2)",
+            {"proposer_pet_id": offer["pet_id"], "acceptor_pet_id": acceptor_pet_id,
+             "proposer_uid": proposer_uid, "acceptor_uid": acceptor_uid}
+        )
+        # Вместе с этим предложением уходят и другие, где фигурируют обменянные питомцы
+        await tx.execute_query(
+            "DELETE FROM trade_offers WHERE proposer_id = $1 OR pet_id = ANY($2::int[])",
+            {"proposer_id": proposer_uid, "pet_ids": [offer["pet_id"], acceptor_pet_id]}
+        )
+
+    invalidate_pet_counts(acceptor_uid)
+    invalidate_pet_counts(proposer_uid)
+    return None, offer, acceptor_pet
+
 @router.message(Command("trade"))
 async def trade_cmd(message: Message):
     """
@@ -47,13 +130,20 @@ async def trade_cmd(message: Message):
     args = message.text.strip().split()
 
     if len(args) < 2:
-        await message.answer(
+        text = (
             "🤝 <b>Система обмена R2R</b>\n\n"
             "Чтобы предложить обмен: <code>/trade &lt;ID твоего питомца&gt; &lt;ID пользователя&gt;</code>\n"
             "Чтобы принять обмен: <code>/trade accept &lt;ID предложившего&gt; &lt;ID твоего питомца&gt;</code>\n"
-            "Чтобы отклонить обмен: <code>/trade decline &lt;ID предложившего&gt;</code>",
-            parse_mode="HTML"
+            "Чтобы отклонить обмен: <code>/trade decline &lt;ID предложившего&gt;</code>"
         )
+        incoming = await fetch_incoming_offers(uid)
+        if incoming:
+            names = await get_display_names([offer["proposer_id"] for offer in incoming])
+            text += "\n\n📥 <b>Тебе предлагают:</b>\n" + "\n".join(
+                f"• <b>{offer['pet_name']}</b> ({offer['rarity']}) от {names[offer['proposer_id']]} (ID: {offer['proposer_id']})"
+                for offer in incoming
+            )
+        await message.answer(text, parse_mode="HTML")
         return
 
     command = args[1].lower()
@@ -70,64 +160,25 @@ async def trade_cmd(message: Message):
             await message.answer("ID пользователя и питомца должны быть числами.", parse_mode="HTML")
             return
 
-        # Check if there's a pending trade for this user from the proposer
-        if proposer_uid not in pending_trades or pending_trades[proposer_uid]['target_uid'] != uid:
-            await message.answer("Нет активного предложения обмена от этого пользователя.", parse_mode="HTML")
-            return
-        
-        proposer_trade_info = pending_trades[proposer_uid]
-        proposer_pet_id = proposer_trade_info['proposer_pet_id']
-        proposer_pet_rarity = proposer_trade_info['proposer_pet_rarity']
-
-        # Fetch acceptor's pet details
-        acceptor_pet = await fetch_one("SELECT * FROM pets WHERE id = $1 AND user_id = $2", {"id": acceptor_pet_id, "user_id": uid})
-        if not acceptor_pet:
-            await message.answer("У тебя нет питомца с таким ID.", parse_mode="HTML")
-            return
-
-        # Check if acceptor's pet is in arena team
-        if await is_pet_in_arena_team(uid, acceptor_pet_id):
-            await message.answer("Ты не можешь обменять питомца, который находится в твоей активной арена-команде.", parse_mode="HTML")
+        error, offer, acceptor_pet = await execute_trade(proposer_uid, uid, acceptor_pet_id)
+        if error:
+            await message.answer(error, parse_mode="HTML")
             return
 
-        acceptor_pet_rarity = acceptor_pet['rarity']
-
-        # R2R Logic: Only allow trading pets of the same rarity
-        if proposer_pet_rarity != acceptor_pet_rarity:
-            await message.answer(
-                f"Обмен невозможен. Питомцы должны быть <b>одной редкости</b>.\n"
-                f"Твой питомец: <b>{acceptor_pet['name']}</b> ({acceptor_pet_rarity})\n"
-                f"Питомец оппонента: <b>{proposer_trade_info['proposer_pet_name']}</b> ({proposer_pet_rarity})",
-                parse_mode="HTML"
-            )
-            return
-
-        # Perform the trade
-        # Update user_id for proposer's pet to acceptor's UID
-        await execute_query("UPDATE pets SET user_id = $1 WHERE id = $2", {"user_id": uid, "id": proposer_pet_id})
-        # Update user_id for acceptor's pet to proposer's UID
-        await execute_query("UPDATE pets SET user_id = $1 WHERE id = $2", {"user_id": proposer_uid, "id": acceptor_pet_id})
-
-        # Clean up pending trade
-        del pending_trades[proposer_uid]
-
         # Notify both users
-        proposer_chat = await message.bot.get_chat(proposer_uid)
-        proposer_name = proposer_chat.first_name if proposer_chat.first_name else proposer_chat.full_name
-
-        acceptor_chat = await message.bot.get_chat(uid)
-        acceptor_name = acceptor_chat.first_name if acceptor_chat.first_name else acceptor_chat.full_name
+        proposer_name = await get_display_name(proposer_uid)
+        acceptor_name = message.from_user.first_name or message.from_user.full_name
 
         await message.answer(
             f"✅ Обмен успешно завершен!\n"
-            f"Ты получил <b>{proposer_trade_info['proposer_pet_name']}</b> ({proposer_pet_rarity}) от <b>{proposer_name}</b>.",
+            f"Ты получил <b>{offer['pet_name']}</b> ({offer['rarity']}) от <b>{proposer_name}</b>.",
             parse_mode="HTML"
         )
         try:
             await message.bot.send_message(
                 proposer_uid,
                 f"✅ Обмен успешно завершен!\n"
-                f"Ты получил <b>{acceptor_pet['name']}</b> ({acceptor_pet_rarity}) от <b>{acceptor_name}</b>.",
+                f"Ты получил <b>{acceptor_pet['name']}</b> ({acceptor_pet['rarity']}) от <b>{acceptor_name}</b>.",
                 parse_mode="HTML"
             )
         except TelegramBadRequest:
@@ -145,22 +196,20 @@ async def trade_cmd(message: Message):
             await message.answer("ID предложившего должен быть числом.", parse_mode="HTML")
             return
 
-        if proposer_uid not in pending_trades or pending_trades[proposer_uid]['target_uid'] != uid:
+        # Remove the pending trade
+        declined = await fetch_one(
+            "DELETE FROM trade_offers WHERE proposer_id = $1 AND target_id = $2 AND expires_at > NOW() RETURNING pet_name, rarity",
+            {"proposer_id": proposer_uid, "target_id": uid}
+        )
+        if not declined:
             await message.answer("Нет активного предложения обмена от этого пользователя.", parse_mode="HTML")
             return
-        
-        proposer_trade_info = pending_trades[proposer_uid]
-        proposer_pet_name = proposer_trade_info['proposer_pet_name']
-        proposer_pet_rarity = proposer_trade_info['proposer_pet_rarity']
-
-        # Remove the pending trade
-        del pending_trades[proposer_uid]
 
-        proposer_chat = await message.bot.get_chat(proposer_uid)
-        proposer_name = proposer_chat.first_name if proposer_chat.first_name else proposer_chat.full_name
+        proposer_pet_name = declined['pet_name']
+        proposer_pet_rarity = declined['rarity']
 
-        acceptor_chat = await message.bot.get_chat(uid)
-        acceptor_name = acceptor_chat.first_name if acceptor_chat.first_name else acceptor_chat.full_name
+        proposer_name = await get_display_name(proposer_uid)
+        acceptor_name = message.from_user.first_name or message.from_user.full_name
 
         await message.answer(f"❌ Ты отклонил предложение обмена от <b>{proposer_name}</b>.", parse_mode="HTML")
         try:
@@ -197,36 +246,26 @@ async def trade_cmd(message: Message):
             await message.answer("Ты не можешь обменять питомца, который находится в твоей активной арена-команде.", parse_mode="HTML")
             return
 
-        target_user_exists = await fetch_one("SELECT user_id FROM users WHERE user_id = $1", {"uid": target_uid})
+        target_user_exists = await get_user(target_uid)
         if not target_user_exists:
             await message.answer("Пользователь с таким ID не найден.", parse_mode="HTML")
             return
 
-        # Store the pending trade
-        pending_trades[uid] = {
-            'target_uid': target_uid,
-            'proposer_pet_id': my_pet_id,
-            'proposer_pet_name': my_pet['name'],
-            'proposer_pet_rarity': my_pet['rarity']
-        }
+        # Store the pending trade (replaces the previous offer of this user, if any)
+        await save_trade_offer(uid, target_uid, my_pet)
 
         # Notify proposer
-        try:
-            target_chat = await message.bot.get_chat(target_uid)
-            target_name = target_chat.first_name if target_chat.first_name else target_chat.full_name
-        except Exception:
-            target_name = f"Пользователю с ID {target_uid}"
+        target_name = await get_display_name(target_uid)
         
         await message.answer(
             f"✅ Ты предложил обменять <b>{my_pet['name']}</b> ({my_pet['rarity']}) "
             f"{target_name}.\n"
-            f"Ожидай его ответа.",
+            f"Ожидай его ответа. Предложение действует {TRADE_OFFER_TTL_HOURS} ч.",
             parse_mode="HTML"
         )
 
         # Notify target
-        proposer_chat = await message.bot.get_chat(uid)
-        proposer_name = proposer_chat.first_name if proposer_chat.first_name else proposer_chat.full_name
+        proposer_name = message.from_user.first_name or message.from_user.full_name
 
         try:
             await message.bot.send_message(
@@ -242,4 +281,39 @@ async def trade_cmd(message: Message):
                 f"Не удалось уведомить пользователя <b>{target_name}</b> (ID: {target_uid}). "
                 f"Возможно, он заблокировал бота или не начинал диалог с ним.",
                 parse_mode="HTML"
-            )
\ No newline at end of file
+            )
+
+
+# --- Истечение предложений: фоновая задача, запускается из main.py ---
+# SKIP LOCKED — несколько воркеров не мешают друг другу и не ждут идущий обмен
+SWEEP_EXPIRED_OFFERS_QUERY = """
+    DELETE FROM trade_offers WHERE proposer_id IN (
+        SELECT proposer_id FROM trade_offers
+        WHERE expires_at <= NOW()
+        ORDER BY expires_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+async def sweep_expired_offers() -> int:
+    """Удаляет истёкшие предложения пачками. Возвращает, сколько удалено."""
+    total = 0
+    while True:
+        status = await execute_query(SWEEP_EXPIRED_OFFERS_QUERY, {"limit": TRADE_SWEEP_BATCH_SIZE})
+        deleted = int(status.split()[-1]) # "DELETE <n>"
+        total += deleted
+        if deleted < TRADE_SWEEP_BATCH_SIZE:
+            return total
+
+async def trade_sweeper_loop():
+    while True:
+        try:
+            await sweep_expired_offers()
+        except Exception as e:
+            print(f"Ошибка при удалении истёкших предложений обмена: {e}")
+        await asyncio.sleep(TRADE_SWEEP_INTERVAL_SECONDS)
+
+def start_trade_offer_sweeper():
+    """Запускает фоновое удаление истёкших предложений обмена. Вызывается один раз из main.py."""
+    return asyncio.create_task(trade_sweeper_loop())
@@ -0,0 +1,146 @@
+# bot/utils/arena_engine.py
+# Чистый движок боёв арены: без Telegram, без БД и без sleep.
+# run_battle только рисует готовый результат, а баланс можно крутить в симуляциях.
+import random
+from dataclasses import dataclass, field
+
+ARENA_CRIT_CHANCE = 0.15
+ARENA_MISS_CHANCE = 0.1
+
+# Бот-соперник: сила в пределах доли от силы игрока
+TARGET_BOT_POWER_RATIO_MIN = 0.8 # Бот будет иметь минимум 80% силы игрока
+TARGET_BOT_POWER_RATIO_MAX = 1.0 # Бот будет иметь максимум 100% силы игрока
+BOT_PET_NAMES = ["Кот", "Пёс", "Лиса", "Бобр", "Дракон", "Волк", "Медведь", "Пантера", "Орел", "Змея"]
+
+# Исходы одной атаки
+ATTACK_MISS = "miss"       # промах
+ATTACK_CRIT = "crit"       # критический удар, пробивает любую защиту
+ATTACK_HIT = "hit"         # атака больше защиты
+ATTACK_BLOCKED = "blocked" # защита отбила атаку
+
+
+@dataclass
+class ArenaRound:
+    index: int
+    attack1: str # Как прошла атака питомца первой команды
+    attack2: str # Как прошла атака питомца второй команды
+    winner: int  # 1, 2 или 0 (ничья в раунде)
+
+
+@dataclass
+class ArenaBattleResult:
+    rounds: list[ArenaRound] = field(default_factory=list)
+    wins1: int = 0
+    wins2: int = 0
+
+    @property
+    def outcome1(self) -> str:
+        if self.wins1 > self.wins2:
+            return "win"
+        if self.wins2 > self.wins1:
+            return "loss"
+        return "draw"
+
+    @property
+    def outcome2(self) -> str:
+        return {"win": "loss", "loss": "win", "draw": "draw"}[self.outcome1]
+
+
+def generate_bot_team(player_power: int, num_pets: int, rng=None) -> list[dict]:
+    """Собирает команду бота из num_pets питомцев с суммарной силой около player_power * [MIN, MAX]."""
+    rng = rng or random
+    target_bot_power = int(player_power * rng.uniform(TARGET_BOT_POWER_RATIO_MIN, TARGET_BOT_POWER_RATIO_MAX))
+    avg_pet_target_power = target_bot_power / num_pets
+
+    team = []
+    for _ in range(num_pets):
+        base_atk = max(1, int(avg_pet_target_power * rng.uniform(0.3, 0.4))) # Например, 30-40% от средней силы
+        base_def = max(1, int(avg_pet_target_power * rng.uniform(0.3, 0.4)))
+        base_hp = max(1, int(avg_pet_target_power * rng.uniform(0.4, 0.5))) # HP обычно больше
+        team.append({
+            "name": rng.choice(BOT_PET_NAMES),
+            "stats": {
+                "atk": max(5, int(base_atk * rng.uniform(0.9, 1.1))), # +/- 10% от базы
+                "def": max(5, int(base_def * rng.uniform(0.9, 1.1))),
+                "hp": max(15, int(base_hp * rng.uniform(0.9, 1.1)))
+            }
+        })
+    return team
+
+def resolve_attack(attacker_atk: int, defender_def: int, rng: random.Random) -> str:
+    # Порядок бросков как в исходном run_battle: сначала крит, потом промах
+    crit = rng.random() < ARENA_CRIT_CHANCE
+    miss = rng.random() < ARENA_MISS_CHANCE
+    if miss:
+        return ATTACK_MISS
+    if crit:
+        return ATTACK_CRIT
+    if attacker_atk > defender_def:
+        return ATTACK_HIT
+    return ATTACK_BLOCKED
+
+def simulate_arena_battle(team1: list, team2: list, rng: random.Random = None) -> ArenaBattleResult:
+    """Проводит бой слот против слота. Команды — списки питомцев со stats-словарём.
+    Передай random.Random(seed), чтобы бой был воспроизводимым."""
+    rng = rng or random.Random()
+    result = ArenaBattleResult()
+
+    for i in range(min(len(team1), len(team2))):
+        stats1 = team1[i]["stats"]
+        stats2 = team2[i]["stats"]
+
+        attack1 = resolve_attack(stats1["atk"], stats2["def"], rng)
+        attack2 = resolve_attack(stats2["atk"], stats1["def"], rng)
+        landed1 = attack1 in (ATTACK_CRIT, ATTACK_HIT)
+        landed2 = attack2 in (ATTACK_CRIT, ATTACK_HIT)
+
+        if landed1 and not landed2:
+            winner = 1
+            result.wins1 += 1
+        elif landed2 and not landed1:
+            winner = 2
+            result.wins2 += 1
+        else:
+            winner = 0
+        result.rounds.append(ArenaRound(index=i + 1, attack1=attack1, attack2=attack2, winner=winner))
+
+    return result
+
+
+def teams_to_arrays(teams: list[list]):
+    """Упаковывает команды в массивы (N, MAX_SLOTS) для пакетной симуляции.
+    Возвращает (atk, def, mask), mask отмечает реально занятые слоты."""
+    import numpy as np
+
+    slots = max((len(team) for team in teams), default=0)
+    atk = np.zeros((len(teams), slots), dtype=np.int32)
+    defense = np.zeros((len(teams), slots), dtype=np.int32)
+    mask = np.zeros((len(teams), slots), dtype=bool)
+    for row, team in enumerate(teams):
+        for slot, pet in enumerate(team):
+            atk[row, slot] = pet["stats"]["atk"]
+            defense[row, slot] = pet["stats"]["def"]
+            mask[row, slot] = True
+    return atk, defense, mask
+
+def simulate_arena_batch(atk1, def1, mask1, atk2, def2, mask2, seed: int = None):
+    """Пакетный вариант simulate_arena_battle на NumPy: N боёв за один проход.
+    Все массивы формы (N, SLOTS). Возвращает (wins1, wins2) — массивы формы (N,).
+    Правила те же, но поток случайных чисел другой, поэтому бой-в-бой с одиночной версией не совпадает."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    shape = np.shape(atk1)
+    rounds_mask = np.asarray(mask1) & np.asarray(mask2)
+
+    crit1 = rng.random(shape) < ARENA_CRIT_CHANCE
+    miss1 = rng.random(shape) < ARENA_MISS_CHANCE
+    crit2 = rng.random(shape) < ARENA_CRIT_CHANCE
+    miss2 = rng.random(shape) < ARENA_MISS_CHANCE
+
+    landed1 = ~miss1 & (crit1 | (np.asarray(atk1) > np.asarray(def2)))
+    landed2 = ~miss2 & (crit2 | (np.asarray(atk2) > np.asarray(def1)))
+
+    wins1 = (landed1 & ~landed2 & rounds_mask).sum(axis=1)
+    wins2 = (landed2 & ~landed1 & rounds_mask).sum(axis=1)
+    return wins1, wins2
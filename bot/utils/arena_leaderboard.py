@@ -0,0 +1,99 @@
+# bot/utils/arena_leaderboard.py
+# Таблица лидеров арены без сортировки всей arena_team на каждый /arena_info.
+# - топ-N читается по индексу idx_arena_team_leaderboard (wins DESC, draws DESC, losses ASC),
+#   готовый текстовый блок кэшируется на LEADERBOARD_CACHE_SECONDS;
+# - место игрока считается по arena_score_counts: сколько игроков с каждым счётом (wins, draws, losses).
+#   Различных счётов на порядки меньше, чем игроков, поэтому запрос не зависит от их числа.
+#   Таблицу инкрементально обновляет settle_battle_rewards в той же транзакции,
+#   а при старте бота она пересобирается целиком, чтобы исправить возможный дрейф.
+#   В ней только те, кто провёл хотя бы один бой.
+import time
+
+from db.db import fetch_one, fetch_all, transaction
+from bot.utils.display_names import get_user_names
+
+LEADERBOARD_SIZE = 10
+LEADERBOARD_CACHE_SECONDS = 5
+
+_top_block_cache = {"text": None, "expires_at": 0.0}
+
+# Фрагмент для CTE после UPDATE arena_team ... RETURNING: переносит игроков из старого счёта в новый.
+# Ожидает CTE arena_upd(wins, draws, losses, d_wins, d_draws, d_losses) с уже обновлёнными значениями.
+# ORDER BY даёт одинаковый порядок блокировок строк в параллельных транзакциях.
+SCORE_COUNTS_UPSERT = """
+    INSERT INTO arena_score_counts (wins, draws, losses, players)
+    SELECT wins, draws, losses, SUM(delta) FROM (
+        SELECT wins, draws, losses, 1 AS delta FROM arena_upd
+        UNION ALL
+        SELECT wins - d_wins, draws - d_draws, losses - d_losses, -1 FROM arena_upd
+        WHERE wins - d_wins + draws - d_draws + losses - d_losses > 0
+    ) moves
+    GROUP BY wins, draws, losses
+    ORDER BY wins, draws, losses
+    ON CONFLICT (wins, draws, losses) DO UPDATE SET players = arena_score_counts.players + EXCLUDED.players
+"""
+
+
+async def rebuild_score_counts():
+    """Полная пересборка arena_score_counts из arena_team. Вызывается при старте бота."""
+    try:
+        async with transaction() as tx:
+            # Параллельные бои подождут блокировку и применят свои дельты уже поверх пересобранной таблицы
+            await tx.execute_query("LOCK TABLE arena_score_counts IN EXCLUSIVE MODE")
+            await tx.execute_query("DELETE FROM arena_score_counts")
+            await tx.execute_query("""
+                INSERT INTO arena_score_counts (wins, draws, losses, players)
+                SELECT wins, draws, losses, COUNT(*) FROM arena_team
+                WHERE user_id != 0 AND wins + draws + losses > 0
+                GROUP BY wins, draws, losses
+            """)
+    except Exception as e:
+        print(f"Ошибка при пересборке таблицы лидеров арены: {e}")
+
+async def get_position(wins: int, draws: int, losses: int):
+    """Возвращает (место, всего игроков в рейтинге). Если игрок ещё не дрался — место None."""
+    row = await fetch_one(
+        """
+        SELECT COALESCE(SUM(players) FILTER (
+                   WHERE wins > $1 OR (wins = $1 AND draws > $2) OR (wins = $1 AND draws = $2 AND losses < $3)
+               ), 0) AS ahead,
+               COALESCE(SUM(players), 0) AS total
+        FROM arena_score_counts
+        """,
+        {"wins": wins, "draws": draws, "losses": losses}
+    )
+    if wins + draws + losses == 0:
+        return None, row["total"]
+    return row["ahead"] + 1, row["total"]
+
+async def get_top_block() -> str:
+    """Готовый текст топа. Кэшируется на несколько секунд — одинаковый для всех игроков."""
+    now = time.monotonic()
+    if _top_block_cache["text"] is not None and now < _top_block_cache["expires_at"]:
+        return _top_block_cache["text"]
+
+    top_users = await fetch_all(
+        """
+        SELECT a.user_id, u.username, u.display_name, a.wins, a.losses, a.draws FROM arena_team a
+        JOIN users u ON u.user_id = a.user_id
+        WHERE a.user_id != 0
+        ORDER BY a.wins DESC, a.draws DESC, a.losses ASC
+        LIMIT $1
+        """,
+        {"limit": LEADERBOARD_SIZE}
+    )
+
+    # Имена уже лежат в users — ни одного запроса к Bot API.
+    # Кого ещё не знаем — подставим запасное имя, фоновая задача подтянет настоящее.
+    unknown = await get_user_names([u["user_id"] for u in top_users if not u["display_name"]])
+
+    text = ""
+    for idx, u in enumerate(top_users):
+        uname = u["username"] or u["display_name"] or unknown[u["user_id"]][0]
+        text += f"{idx+1}. {uname} — 🏆 {u['wins']} | 💀 {u['losses']} | 🤝 {u['draws']}\n"
+    if not text:
+        text = "Пока никого нет..."
+
+    _top_block_cache["text"] = text
+    _top_block_cache["expires_at"] = now + LEADERBOARD_CACHE_SECONDS
+    return text
@@ -0,0 +1,200 @@
+# bot/utils/arena_matchmaking.py
+# Матчмейкинг арены: очередь хранится в таблице arena_queue (переживает рестарт бота
+# и общая для всех воркеров). Фоновая задача раз в MATCHMAKING_TICK_SECONDS в одной транзакции
+# блокирует строки очереди (FOR UPDATE SKIP LOCKED), раскладывает их по корзинам силы команды,
+# подбирает пары с ближайшей силой и удаляет забранных. Второй воркер в этот момент пропускает
+# заблокированные строки, поэтому одного игрока не заберут дважды, а игроки, вставшие в очередь
+# на разных воркерах, встречаются в общей таблице. Окно допустимой разницы расширяется по мере
+# ожидания, бои запускаются параллельно под семафором.
+import asyncio
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from db.db import fetch_one, fetch_all, execute_query, transaction
+
+MATCHMAKING_TICK_SECONDS = 2
+POWER_BUCKET_SIZE = 50          # Ширина корзины по силе команды
+BASE_POWER_WINDOW = 0.10        # Стартовое окно: ±10% от силы игрока
+WINDOW_GROWTH_PER_10_SEC = 0.10 # Каждые 10 секунд ожидания окно растёт ещё на 10%
+MAX_POWER_WINDOW = 0.60
+BOT_FALLBACK_SECONDS = 30       # Кто не нашёл соперника за это время — бьётся с ботом
+MAX_CONCURRENT_BATTLES = 20
+
+# Снимок очереди последнего тика: user_id -> {"user_id", "power", "joined_at"} и корзина -> {user_id: entry}
+queue_entries: dict[int, dict] = {}
+power_buckets: dict[int, dict[int, dict]] = {}
+
+battle_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATTLES)
+running_battles: set[asyncio.Task] = set()
+
+# Метрики
+recent_wait_times = deque(maxlen=200)
+matches_total = 0
+bot_matches_total = 0
+
+
+def get_bucket(power: int) -> int:
+    return max(0, int(power)) // POWER_BUCKET_SIZE
+
+def _add_to_memory(entry: dict):
+    queue_entries[entry["user_id"]] = entry
+    power_buckets.setdefault(get_bucket(entry["power"]), {})[entry["user_id"]] = entry
+
+def _remove_from_memory(user_id: int):
+    entry = queue_entries.pop(user_id, None)
+    if not entry:
+        return
+    bucket = power_buckets.get(get_bucket(entry["power"]))
+    if bucket is not None:
+        bucket.pop(user_id, None)
+        if not bucket:
+            power_buckets.pop(get_bucket(entry["power"]), None)
+
+async def is_queued(user_id: int) -> bool:
+    """Спрашивает БД: игрок мог встать в очередь через другой воркер."""
+    row = await fetch_one("SELECT EXISTS (SELECT 1 FROM arena_queue WHERE user_id = $1) AS queued", {"user_id": user_id})
+    return row["queued"]
+
+def _load_snapshot(rows):
+    queue_entries.clear()
+    power_buckets.clear()
+    for row in rows:
+        _add_to_memory(dict(row))
+
+async def enqueue(user_id: int, power: int) -> bool:
+    """Ставит игрока в очередь. Возвращает False, если он уже там."""
+    result = await execute_query(
+        "INSERT INTO arena_queue (user_id, power, joined_at) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO NOTHING",
+        {"user_id": user_id, "power": power, "joined_at": datetime.now(timezone.utc)}
+    )
+    return result != "INSERT 0 0"
+
+def get_power_window(entry: dict, now: datetime) -> float:
+    waited = (now - entry["joined_at"]).total_seconds()
+    ratio = min(MAX_POWER_WINDOW, BASE_POWER_WINDOW + WINDOW_GROWTH_PER_10_SEC * (waited // 10))
+    return max(POWER_BUCKET_SIZE / 2, entry["power"] * ratio)
+
+def find_opponent(entry: dict, now: datetime, taken: set[int]):
+    """Ближайший по силе игрок в пределах окна ожидающего. Смотрим только соседние корзины."""
+    window = get_power_window(entry, now)
+    low_bucket = get_bucket(entry["power"] - window)
+    high_bucket = get_bucket(entry["power"] + window)
+
+    best, best_diff = None, None
+    for bucket_index in range(low_bucket, high_bucket + 1):
+        for candidate in power_buckets.get(bucket_index, {}).values():
+            if candidate["user_id"] == entry["user_id"] or candidate["user_id"] in taken:
+                continue
+            diff = abs(candidate["power"] - entry["power"])
+            if diff > window:
+                continue
+            if best_diff is None or diff < best_diff:
+                best, best_diff = candidate, diff
+    return best
+
+def build_pairs(now: datetime) -> list[tuple[dict, Optional[dict]]]:
+    """Подбирает пары, начиная с тех, кто ждёт дольше всех. Вторым элементом None — бой с ботом."""
+    pairs = []
+    taken = set()
+    for entry in sorted(queue_entries.values(), key=lambda e: e["joined_at"]):
+        if entry["user_id"] in taken:
+            continue
+        opponent = find_opponent(entry, now, taken)
+        if opponent:
+            taken.update((entry["user_id"], opponent["user_id"]))
+            pairs.append((entry, opponent))
+        elif (now - entry["joined_at"]).total_seconds() >= BOT_FALLBACK_SECONDS:
+            taken.add(entry["user_id"])
+            pairs.append((entry, None))
+    return pairs
+
+async def claim_pairs(pairs: list[tuple[dict, Optional[dict]]], tx=None) -> list[tuple[dict, Optional[dict]]]:
+    """Удаляет игроков из arena_queue одним запросом и возвращает пары, которые можно запускать.
+    Кого уже нет в БД (забрал другой воркер) — убираем из памяти. Если в паре удалось забрать
+    только одного, его строка возвращается в arena_queue с прежним joined_at — он не теряет ни место, ни бой.
+    Внутри транзакции тика строки заблокированы, и это лишь страховка."""
+    user_ids = [e["user_id"] for pair in pairs for e in pair if e]
+    if not user_ids:
+        return []
+    rows = await (tx.fetch_all if tx else fetch_all)(
+        "DELETE FROM arena_queue WHERE user_id = ANY($1::bigint[]) RETURNING user_id",
+        {"user_ids": user_ids}
+    )
+    claimed = {row["user_id"] for row in rows}
+
+    ready, orphans = [], []
+    for pair in pairs:
+        if all(e is None or e["user_id"] in claimed for e in pair):
+            ready.append(pair)
+        else:
+            orphans.extend(e for e in pair if e and e["user_id"] in claimed)
+
+    # В памяти остаются только вернувшиеся в очередь
+    ready_ids = {e["user_id"] for pair in ready for e in pair if e}
+    for user_id in user_ids:
+        if user_id not in claimed or user_id in ready_ids:
+            _remove_from_memory(user_id)
+    if orphans:
+        await (tx.execute_query if tx else execute_query)(
+            "INSERT INTO arena_queue (user_id, power, joined_at) "
+            "SELECT * FROM unnest($1::bigint[], $2::int[], $3::timestamptz[]) ON CONFLICT (user_id) DO NOTHING",
+            {"user_ids": [e["user_id"] for e in orphans], "powers": [e["power"] for e in orphans],
+             "joined_at": [e["joined_at"] for e in orphans]}
+        )
+    return ready
+
+async def _run_match(battle_runner, bot, entry1: dict, entry2: Optional[dict]):
+    async with battle_semaphore:
+        try:
+            await battle_runner(bot, entry1["user_id"], entry2["user_id"] if entry2 else None)
+        except Exception as e:
+            print(f"Ошибка в бою арены {entry1['user_id']} vs {entry2['user_id'] if entry2 else 'бот'}: {e}")
+
+async def matchmaking_tick(bot, battle_runner):
+    global matches_total, bot_matches_total
+    now = datetime.now(timezone.utc)
+    async with transaction() as tx:
+        # Очередь перечитывается каждый тик: в ней и игроки других воркеров
+        rows = await tx.fetch_all(
+            "SELECT user_id, power, joined_at FROM arena_queue ORDER BY joined_at FOR UPDATE SKIP LOCKED"
+        )
+        _load_snapshot(rows)
+        if not rows:
+            return
+        pairs = await claim_pairs(build_pairs(now), tx)
+    # Бои стартуют после COMMIT: блокировки очереди не держатся на время боя
+    for entry1, entry2 in pairs:
+        for entry in (entry1, entry2):
+            if entry:
+                recent_wait_times.append((now - entry["joined_at"]).total_seconds())
+        matches_total += 1
+        if entry2 is None:
+            bot_matches_total += 1
+        task = asyncio.create_task(_run_match(battle_runner, bot, entry1, entry2))
+        running_battles.add(task)
+        task.add_done_callback(running_battles.discard)
+
+async def matchmaking_loop(bot, battle_runner):
+    """battle_runner(bot, uid1, uid2_or_None) — корутина, проводящая бой."""
+    while True:
+        started = time.monotonic()
+        try:
+            await matchmaking_tick(bot, battle_runner)
+        except Exception as e:
+            print(f"Ошибка матчмейкинга арены: {e}")
+        await asyncio.sleep(max(0, MATCHMAKING_TICK_SECONDS - (time.monotonic() - started)))
+
+def get_queue_metrics() -> dict:
+    now = datetime.now(timezone.utc)
+    waits = [(now - e["joined_at"]).total_seconds() for e in queue_entries.values()]
+    return {
+        "depth": len(queue_entries),
+        "buckets": len(power_buckets),
+        "oldest_wait": max(waits) if waits else 0,
+        "avg_recent_wait": sum(recent_wait_times) / len(recent_wait_times) if recent_wait_times else 0,
+        "matches_total": matches_total,
+        "bot_matches_total": bot_matches_total,
+        "running_battles": len(running_battles),
+    }
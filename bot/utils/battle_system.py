@@ -2,6 +2,20 @@
 import random
 import json
 
+# --- КОНСТАНТЫ ДЛЯ БАЛАНСА ДАНЖЕЙ ---
+BASE_MONSTER_HP_PER_DIFFICULTY = 10 # Базовое HP за единицу сложности
+BASE_MONSTER_ATK_PER_DIFFICULTY = 3 # Базовая Атака за единицу сложности
+BASE_MONSTER_DEF_PER_DIFFICULTY = 2 # Базовая Защита за единицу сложности
+BASE_MONSTER_XP_PER_DIFFICULTY = 5 # Базовый XP за единицу сложности
+BASE_MONSTER_COINS_PER_DIFFICULTY = 7 # Базовые Монеты за единицу сложности
+
+BOSS_MULTIPLIER_HP = 2.0 # Босс имеет в X раз больше HP
+BOSS_MULTIPLIER_ATK = 1.5 # Босс имеет в X раз больше ATK
+BOSS_MULTIPLIER_DEF = 1.5 # Босс имеет в X раз больше DEF
+BOSS_MULTIPLIER_REWARD = 2.0 # Босс дает в X раз больше наград
+
+EXPLORE_MAX_TURNS = 20 # Лимит ходов в бою на исследовании
+
 def calculate_damage(attacker_atk: int, defender_def: int) -> int:
     damage = max(1, attacker_atk * attacker_atk / (attacker_atk + defender_def))
     return int(damage)
@@ -96,4 +110,53 @@ def simulate_battle_dungeon(pets_data: list, monster_info: dict) -> dict:
             "coins_gained": 0,
             "updated_pets_data": current_pets_state,
             "battle_log": battle_log
-        }
\ No newline at end of file
+        }
+
+
+def scale_dungeon_monster(monster_base_info: dict, difficulty_level: int, is_boss: bool = False) -> dict:
+    """Масштабирует базового монстра из MONSTERS под сложность данжа (и усиливает, если это босс)."""
+    scaled_monster_info = {
+        "name_ru": monster_base_info['name_ru'],
+        "hp": int(monster_base_info['base_hp'] + (difficulty_level * BASE_MONSTER_HP_PER_DIFFICULTY)),
+        "atk": int(monster_base_info['base_atk'] + (difficulty_level * BASE_MONSTER_ATK_PER_DIFFICULTY)),
+        "def": int(monster_base_info['base_def'] + (difficulty_level * BASE_MONSTER_DEF_PER_DIFFICULTY)),
+        "xp_reward": int(monster_base_info['base_hp'] * 0.5 + (difficulty_level * BASE_MONSTER_XP_PER_DIFFICULTY)), # XP зависит от HP и сложности
+        "coin_reward": int(monster_base_info['base_hp'] * 0.3 + (difficulty_level * BASE_MONSTER_COINS_PER_DIFFICULTY)), # Монеты зависят от HP и сложности
+        "abilities": monster_base_info.get('abilities', [])
+    }
+
+    if is_boss:
+        scaled_monster_info['hp'] = int(scaled_monster_info['hp'] * BOSS_MULTIPLIER_HP)
+        scaled_monster_info['atk'] = int(scaled_monster_info['atk'] * BOSS_MULTIPLIER_ATK)
+        scaled_monster_info['def'] = int(scaled_monster_info['def'] * BOSS_MULTIPLIER_DEF)
+        scaled_monster_info['xp_reward'] = int(scaled_monster_info['xp_reward'] * BOSS_MULTIPLIER_REWARD)
+        scaled_monster_info['coin_reward'] = int(scaled_monster_info['coin_reward'] * BOSS_MULTIPLIER_REWARD)
+    return scaled_monster_info
+
+
+def simulate_battle_explore(pet_stats: dict, monster: dict) -> dict:
+    """Бой одного питомца с монстром на исследовании, без отправки сообщений.
+    turns — список ходов {"turn", "attacker" ("pet"/"monster"), "damage", "target_hp"} для отрисовки.
+    turn_limit — бой закончился по лимиту ходов, а не смертью одного из бойцов."""
+    pet_current_hp = pet_stats['hp']
+    monster_current_hp = monster['hp']
+    turns = []
+
+    turn = 1
+    while pet_current_hp > 0 and monster_current_hp > 0 and turn < EXPLORE_MAX_TURNS:
+        pet_damage = max(1, pet_stats['atk'] - monster['def'])
+        monster_current_hp -= pet_damage
+        turns.append({"turn": turn, "attacker": "pet", "damage": pet_damage, "target_hp": max(0, monster_current_hp)})
+        if monster_current_hp <= 0:
+            return {"outcome": "win", "turns": turns, "turn_limit": False}
+
+        monster_damage = max(1, monster['atk'] - pet_stats['def'])
+        pet_current_hp -= monster_damage
+        turns.append({"turn": turn, "attacker": "monster", "damage": monster_damage, "target_hp": max(0, pet_current_hp)})
+        if pet_current_hp <= 0:
+            return {"outcome": "loss", "turns": turns, "turn_limit": False}
+
+        turn += 1
+
+    # По лимиту ходов: выжил питомец — считаем победой
+    return {"outcome": "win" if pet_current_hp > 0 else "loss", "turns": turns, "turn_limit": True}
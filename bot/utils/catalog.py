@@ -0,0 +1,116 @@
+# bot/utils/catalog.py
+# Справочники зон и монстров в памяти процесса.
+# Строки zones и monsters меняются только при деплое (init_models.py), а читались на каждый
+# /explore, /zones и проверку открытия зон. Теперь они загружаются один раз при старте
+# в неизменяемые индексы: зоны по имени и в порядке id, монстры по имени и по зоне (по уровню).
+# init_models.py после пересева шлёт NOTIFY в CATALOG_CHANNEL — все воркеры перечитывают справочник.
+# Перезагрузка собирает новый снимок целиком и подменяет его одной операцией,
+# поэтому читатели никогда не видят наполовину обновлённые данные.
+import asyncio
+import json
+from types import MappingProxyType
+from typing import Optional
+
+from db.db import fetch_all, listen
+
+CATALOG_CHANNEL = "catalog_changed"
+LISTENER_RETRY_SECONDS = 5
+LISTENER_HEALTHCHECK_SECONDS = 30
+
+# Снимок справочника. Записи — MappingProxyType: читаются как строки из БД (zone['cost'], zone.get(...)),
+# но изменить их нельзя. JSONB-поля уже декодированы.
+_catalog = {
+    "zones": (),
+    "zones_by_name": MappingProxyType({}),
+    "monsters_by_name": MappingProxyType({}),
+    "monsters_by_zone": MappingProxyType({}),
+}
+_reload_tasks: set[asyncio.Task] = set()
+
+
+def _decode_json(value, default):
+    if value is None:
+        return default
+    return json.loads(value) if isinstance(value, str) else value
+
+async def load_catalog():
+    """Перечитывает зоны и монстров и подменяет снимок."""
+    zone_rows = await fetch_all("SELECT * FROM zones ORDER BY id")
+    monster_rows = await fetch_all("SELECT * FROM monsters ORDER BY level, id")
+
+    zones = []
+    for row in zone_rows:
+        zone = dict(row)
+        zone["unlock_conditions"] = MappingProxyType(_decode_json(zone.get("unlock_conditions"), {}))
+        zone["monster_pool"] = tuple(_decode_json(zone.get("monster_pool"), []))
+        zones.append(MappingProxyType(zone))
+
+    monsters_by_zone: dict[str, list] = {}
+    monsters = []
+    for row in monster_rows:
+        monster = dict(row)
+        monster["possible_item"] = tuple(monster.get("possible_item") or ())
+        monster = MappingProxyType(monster)
+        monsters.append(monster)
+        monsters_by_zone.setdefault(monster["zone_name"], []).append(monster)
+
+    _catalog.update({
+        "zones": tuple(zones),
+        "zones_by_name": MappingProxyType({zone["name"]: zone for zone in zones}),
+        "monsters_by_name": MappingProxyType({monster["name"]: monster for monster in monsters}),
+        "monsters_by_zone": MappingProxyType({name: tuple(items) for name, items in monsters_by_zone.items()}),
+    })
+    print(f"Справочник загружен: {len(zones)} зон, {len(monsters)} монстров")
+
+
+def get_zones() -> tuple:
+    """Все зоны в порядке id."""
+    return _catalog["zones"]
+
+def get_zone(name: str) -> Optional[MappingProxyType]:
+    return _catalog["zones_by_name"].get(name)
+
+def get_monster(name: str) -> Optional[MappingProxyType]:
+    return _catalog["monsters_by_name"].get(name)
+
+def get_zone_monsters(zone_name: str) -> tuple:
+    """Монстры зоны по возрастанию уровня."""
+    return _catalog["monsters_by_zone"].get(zone_name, ())
+
+
+async def _reload_catalog():
+    try:
+        await load_catalog()
+    except Exception as e:
+        print(f"Ошибка при перезагрузке справочника, остаётся прежний: {e}")
+
+def _on_catalog_changed(connection, pid, channel, payload):
+    task = asyncio.create_task(_reload_catalog())
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+async def catalog_listener_loop():
+    """Держит LISTEN-соединение. После переподключения справочник перечитывается:
+    NOTIFY, пришедший пока соединения не было, потерян."""
+    reconnect = False
+    while True:
+        connection = None
+        try:
+            connection = await listen(CATALOG_CHANNEL, _on_catalog_changed)
+            if reconnect:
+                await _reload_catalog()
+            while not connection.is_closed():
+                await asyncio.sleep(LISTENER_HEALTHCHECK_SECONDS)
+                await connection.execute("SELECT 1") # Обрыв соединения заметим здесь
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка в подписке на изменения справочника: {e}")
+        finally:
+            if connection is not None and not connection.is_closed():
+                connection.terminate()
+        reconnect = True
+        await asyncio.sleep(LISTENER_RETRY_SECONDS)
+
+def start_catalog_listener():
+    return asyncio.create_task(catalog_listener_loop())
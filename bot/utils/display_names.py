@@ -0,0 +1,153 @@
+# bot/utils/display_names.py
+# Имена игроков без bot.get_chat на каждый вывод.
+# - DisplayNameMiddleware снимает имя и username с каждого входящего апдейта;
+# - в памяти — LRU с TTL, в БД — users.display_name / users.username;
+# - изменения пишутся в БД пачкой фоновой задачей, она же раз в REFRESH_INTERVAL_SECONDS
+#   дёргает get_chat для небольшой пачки устаревших или неизвестных имён.
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+
+from aiogram import BaseMiddleware
+
+from db.db import fetch_all, execute_query
+
+DISPLAY_NAME_TTL_SECONDS = 600
+DISPLAY_NAME_CACHE_SIZE = 5000
+REFRESH_INTERVAL_SECONDS = 10
+REFRESH_BATCH_SIZE = 20 # get_chat за один проход фоновой задачи
+STALE_AFTER = timedelta(days=7) # Имя из БД старше этого обновляем через get_chat
+
+# uid -> (display_name, username, время попадания в кэш)
+_cache: "OrderedDict[int, tuple[str, Optional[str], float]]" = OrderedDict()
+_dirty: dict[int, tuple[str, Optional[str]]] = {} # Ждут записи в БД
+_stale: set[int] = set() # Ждут обновления через get_chat
+
+
+def fallback_name(uid: int) -> str:
+    return f"Игрок {uid}"
+
+def name_from_user(user) -> str:
+    return user.first_name or user.full_name or fallback_name(user.id)
+
+def _cache_get(uid: int) -> Optional[tuple[str, Optional[str]]]:
+    entry = _cache.get(uid)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[2] > DISPLAY_NAME_TTL_SECONDS:
+        del _cache[uid]
+        return None
+    _cache.move_to_end(uid)
+    return entry[0], entry[1]
+
+def _cache_put(uid: int, display_name: str, username: Optional[str]):
+    _cache[uid] = (display_name, username, time.monotonic())
+    _cache.move_to_end(uid)
+    while len(_cache) > DISPLAY_NAME_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def remember_user(user):
+    """Запоминает имя пользователя из апдейта. В БД пишем только если оно поменялось."""
+    names = (name_from_user(user), user.username)
+    if _cache_get(user.id) != names:
+        _dirty[user.id] = names
+    _cache_put(user.id, *names)
+    _stale.discard(user.id)
+
+
+async def get_user_names(uids: list[int]) -> dict[int, tuple[str, Optional[str]]]:
+    """uid -> (display_name, username). Промахи кэша добираются из БД одним запросом.
+    Неизвестные имена заменяются на «Игрок <id>» и уходят в очередь фонового обновления."""
+    result = {}
+    misses = []
+    for uid in dict.fromkeys(uids):
+        cached = _cache_get(uid)
+        if cached:
+            result[uid] = cached
+        else:
+            misses.append(uid)
+
+    if misses:
+        rows = await fetch_all(
+            "SELECT user_id, display_name, username, display_name_updated_at < NOW() - $2::interval AS is_stale "
+            "FROM users WHERE user_id = ANY($1::bigint[])",
+            {"uids": misses, "stale_after": STALE_AFTER}
+        )
+        for row in rows:
+            if row["display_name"]:
+                result[row["user_id"]] = (row["display_name"], row["username"])
+                _cache_put(row["user_id"], row["display_name"], row["username"])
+                if row["is_stale"]:
+                    _stale.add(row["user_id"])
+        for uid in misses:
+            if uid not in result:
+                result[uid] = (fallback_name(uid), None)
+                _stale.add(uid)
+    return result
+
+async def get_display_names(uids: list[int]) -> dict[int, str]:
+    return {uid: names[0] for uid, names in (await get_user_names(uids)).items()}
+
+async def get_display_name(uid: int) -> str:
+    return (await get_user_names([uid]))[uid][0]
+
+
+async def flush_dirty():
+    if not _dirty:
+        return
+    batch = dict(_dirty)
+    _dirty.clear()
+    try:
+        await execute_query(
+            """
+            UPDATE users u SET display_name = v.display_name, username = v.username, display_name_updated_at = NOW()
+            FROM unnest($1::bigint[], $2::text[], $3::text[]) AS v(user_id, display_name, username)
+            WHERE u.user_id = v.user_id
+            """,
+            {
+                "uids": list(batch),
+                "display_names": [names[0] for names in batch.values()],
+                "usernames": [names[1] for names in batch.values()],
+            }
+        )
+    except Exception as e:
+        print(f"Ошибка при сохранении имён игроков: {e}")
+        for uid, names in batch.items():
+            _dirty.setdefault(uid, names) # Попробуем в следующий раз
+
+async def refresh_stale(bot):
+    for _ in range(min(REFRESH_BATCH_SIZE, len(_stale))):
+        uid = _stale.pop()
+        try:
+            chat = await bot.get_chat(uid)
+        except Exception:
+            # Заблокировал бота или удалён — оставляем запасное имя до истечения TTL
+            _cache_put(uid, fallback_name(uid), None)
+            continue
+        names = (chat.first_name or chat.full_name or fallback_name(uid), chat.username)
+        _dirty[uid] = names
+        _cache_put(uid, *names)
+
+async def refresh_loop(bot):
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL_SECONDS)
+        try:
+            await refresh_stale(bot)
+            await flush_dirty()
+        except Exception as e:
+            print(f"Ошибка в обновлении имён игроков: {e}")
+
+def start_display_name_refresher(bot):
+    return asyncio.create_task(refresh_loop(bot))
+
+
+class DisplayNameMiddleware(BaseMiddleware):
+    """Outer-middleware на апдейты: запоминает имя автора, ничего не запрашивая у Telegram."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            remember_user(user)
+        return await handler(event, data)
@@ -0,0 +1,50 @@
+# bot/utils/egg_inventory.py
+# Инвентарь яиц: по строке на яйцо в user_eggs вместо JSON-массива users.eggs.
+# Добавление — один INSERT, вылупление — один DELETE ... RETURNING самых старых яиц,
+# поэтому ни один хендлер больше не читает и не переписывает инвентарь целиком,
+# а параллельные команды не теряют и не задваивают яйца.
+from db.db import fetch_one, execute_query
+from bot.utils.user_snapshot import invalidate_user
+
+
+async def add_eggs(uid: int, egg_types: list[str], source: str = None, tx=None):
+    """Кладёт яйца в инвентарь и увеличивает users.eggs_collected.
+    Если передан tx (db.transaction()), запрос идёт в рамках этой транзакции."""
+    if not egg_types:
+        return
+    await (tx.execute_query if tx else execute_query)(
+        """
+        WITH added AS (
+            INSERT INTO user_eggs (user_id, egg_type, source) SELECT $1, unnest($2::text[]), $3
+        )
+        UPDATE users SET eggs_collected = eggs_collected + cardinality($2::text[]) WHERE user_id = $1
+        """,
+        {"uid": uid, "egg_types": list(egg_types), "source": source}
+    )
+    invalidate_user(uid) # eggs_collected изменился
+
+async def take_eggs(tx, uid: int, limit: int, egg_type: str = None) -> list[str]:
+    """Списывает до limit самых старых яиц (только типа egg_type, если он задан) и возвращает их типы.
+    Вызывается внутри транзакции: если дальше что-то пойдёт не так, яйца вернутся в инвентарь.
+    SKIP LOCKED — параллельный /hatch возьмёт другие яйца, а не те же самые."""
+    args = {"uid": uid, "limit": limit}
+    type_condition = ""
+    if egg_type:
+        args["egg_type"] = egg_type
+        type_condition = "AND egg_type = $3"
+    rows = await tx.fetch_all(
+        f"""
+        DELETE FROM user_eggs WHERE id IN (
+            SELECT id FROM user_eggs WHERE user_id = $1 {type_condition}
+            ORDER BY id LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, egg_type
+        """,
+        args
+    )
+    return [row["egg_type"] for row in sorted(rows, key=lambda row: row["id"])]
+
+async def count_eggs(uid: int) -> int:
+    row = await fetch_one("SELECT COUNT(*) AS total FROM user_eggs WHERE user_id = $1", {"uid": uid})
+    return row["total"]
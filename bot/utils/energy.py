@@ -0,0 +1,100 @@
+# bot/utils/energy.py
+# Энергия исследований и арены без фоновых пересчётов и записи при чтении.
+# В users для каждого пула хранится пара (значение, якорь): значение на момент якоря.
+# Текущая энергия = min(максимум, значение + целых периодов восстановления с якоря) —
+# считается на лету из уже загруженной строки, поэтому профиль или /arena_info ничего не пишут.
+# Запись — только при трате: один UPDATE проверяет, хватает ли энергии, и списывает её.
+# Якорь сдвигается ровно на восстановленные периоды, начатый период не теряется;
+# если пул был полон — якорь ставится в NOW(), копить сверх максимума нельзя.
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from db.db import fetch_one, execute_query
+from bot.utils.user_snapshot import get_user, update_cached_user, invalidate_user
+
+MAX_ENERGY = 200 # Энергия исследований и данжей
+ENERGY_SECONDS_PER_POINT = 60 # 1 единица в минуту
+ARENA_MAX_ENERGY = 6
+ARENA_ENERGY_SECONDS_PER_POINT = 30 * 60 # 1 единица за 30 минут
+
+
+@dataclass(frozen=True)
+class EnergyPool:
+    value_column: str  # Колонка users со значением на момент якоря
+    anchor_column: str # Колонка users с якорем (TIMESTAMPTZ)
+    max_value: int
+    seconds_per_point: int
+
+EXPLORE_ENERGY = EnergyPool("energy", "last_energy_update", MAX_ENERGY, ENERGY_SECONDS_PER_POINT)
+ARENA_ENERGY = EnergyPool("arena_energy", "last_arena_energy_recharge", ARENA_MAX_ENERGY, ARENA_ENERGY_SECONDS_PER_POINT)
+
+
+def _as_utc(anchor) -> Optional[datetime]:
+    if isinstance(anchor, str):
+        anchor = datetime.fromisoformat(anchor)
+    if anchor is not None and anchor.tzinfo is None:
+        anchor = anchor.replace(tzinfo=timezone.utc)
+    return anchor
+
+def current_energy(user, pool: EnergyPool, now: datetime = None) -> int:
+    """Энергия сейчас по строке users (или любой строке с колонками пула). Без запросов к БД.
+    Нет якоря — пул считается полным, как и у новых игроков."""
+    anchor = _as_utc(user.get(pool.anchor_column))
+    value = user.get(pool.value_column)
+    if anchor is None or value is None:
+        return pool.max_value
+    now = now or datetime.now(timezone.utc)
+    points = int((now - anchor).total_seconds() // pool.seconds_per_point)
+    return min(pool.max_value, value + points)
+
+def seconds_until(user, pool: EnergyPool, amount: int, now: datetime = None) -> int:
+    """Сколько секунд ждать, пока энергии станет не меньше amount."""
+    now = now or datetime.now(timezone.utc)
+    current = current_energy(user, pool, now)
+    if current >= amount:
+        return 0
+    anchor = _as_utc(user.get(pool.anchor_column)) or now
+    into_period = (now - anchor).total_seconds() % pool.seconds_per_point
+    return int((amount - current) * pool.seconds_per_point - into_period)
+
+async def get_energy(uid: int, pool: EnergyPool) -> int:
+    """Текущая энергия игрока. Строка users — из снимка текущего апдейта."""
+    user = await get_user(uid)
+    return current_energy(user, pool) if user else 0
+
+
+def _spend_query(pool: EnergyPool) -> str:
+    # $1 — user_id, $2 — сколько тратим, $3 — максимум, $4 — секунд на единицу.
+    # Выражения ссылаются только на колонки самой строки: при конкурентном UPDATE Postgres
+    # перепроверит условие на свежей версии строки, и две траты не уйдут в минус
+    value, anchor = pool.value_column, pool.anchor_column
+    points = f"FLOOR(EXTRACT(EPOCH FROM NOW() - {anchor}) / $4::int)::int"
+    current = f"(CASE WHEN {anchor} IS NULL OR {value} IS NULL THEN $3::int ELSE LEAST($3::int, {value} + {points}) END)"
+    return f"""
+        UPDATE users SET
+            {value} = {current} - $2::int,
+            {anchor} = CASE WHEN {current} >= $3::int THEN NOW()
+                            ELSE {anchor} + make_interval(secs => {points} * $4::int) END
+        WHERE user_id = $1 AND {current} >= $2::int
+        RETURNING {value} AS value, {anchor} AS anchor
+    """
+
+async def spend_energy(uid: int, pool: EnergyPool, amount: int) -> Optional[int]:
+    """Атомарно списывает amount, если столько есть. Возвращает остаток или None, если не хватило."""
+    row = await fetch_one(_spend_query(pool), {
+        "uid": uid, "amount": amount, "max_value": pool.max_value, "seconds_per_point": pool.seconds_per_point,
+    })
+    if not row:
+        invalidate_user(uid) # Снимок обещал достаточно энергии — значит, устарел
+        return None
+    update_cached_user(uid, **{pool.value_column: row["value"], pool.anchor_column: row["anchor"]})
+    return row["value"]
+
+async def restore_energy(uid: int, pool: EnergyPool, amount: int):
+    """Возвращает потраченную энергию (действие не состоялось). Не больше максимума."""
+    await execute_query(
+        f"UPDATE users SET {pool.value_column} = LEAST($2::int, COALESCE({pool.value_column}, $2::int) + $3::int) WHERE user_id = $1",
+        {"uid": uid, "max_value": pool.max_value, "amount": amount}
+    )
+    invalidate_user(uid)
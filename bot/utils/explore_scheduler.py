@@ -0,0 +1,63 @@
+# bot/utils/explore_scheduler.py
+# Планировщик исследований: задания лежат в таблице explorations с due_at,
+# в памяти — только куча (due_at, id). Одна фоновая задача спит до ближайшего due_at,
+# забирает все созревшие задания пачкой и отдаёт их resolver'у.
+# После рестарта незавершённые задания (resolved_at IS NULL) подгружаются из БД,
+# поэтому награды за исследования при деплое не теряются.
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+
+from db.db import fetch_all
+
+EXPLORE_BATCH_SIZE = 100
+RETRY_DELAY = timedelta(seconds=30) # Если пачка упала — пробуем её снова через это время
+
+due_heap: list[tuple[datetime, int]] = []
+wakeup = asyncio.Event()
+
+
+def schedule(job_id: int, due_at: datetime):
+    """Добавляет задание в кучу. Будим планировщик, только если оно стало ближайшим."""
+    heapq.heappush(due_heap, (due_at, job_id))
+    if due_heap[0][1] == job_id:
+        wakeup.set()
+
+async def load_pending():
+    due_heap.clear()
+    rows = await fetch_all("SELECT id, due_at FROM explorations WHERE resolved_at IS NULL")
+    for row in rows:
+        due_heap.append((row["due_at"], row["id"]))
+    heapq.heapify(due_heap)
+
+def pop_due(now: datetime) -> list[int]:
+    job_ids = []
+    while due_heap and due_heap[0][0] <= now and len(job_ids) < EXPLORE_BATCH_SIZE:
+        job_ids.append(heapq.heappop(due_heap)[1])
+    return job_ids
+
+async def scheduler_loop(resolve_batch):
+    """resolve_batch(job_ids) — корутина, которая выдаёт результаты и помечает задания resolved."""
+    await load_pending()
+    while True:
+        wakeup.clear()
+        if not due_heap:
+            await wakeup.wait()
+            continue
+
+        delay = (due_heap[0][0] - datetime.now(timezone.utc)).total_seconds()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        now = datetime.now(timezone.utc)
+        job_ids = pop_due(now)
+        try:
+            await resolve_batch(job_ids)
+        except Exception as e:
+            print(f"Ошибка при обработке исследований {job_ids}: {e}")
+            for job_id in job_ids:
+                heapq.heappush(due_heap, (now + RETRY_DELAY, job_id))
@@ -0,0 +1,165 @@
+# bot/utils/pet_query.py
+# Общий сервис выборки питомцев игрока: keyset-пагинация, сортировка и фильтры на стороне БД.
+# Страница читается по индексу за постоянное время, сколько бы питомцев ни было у игрока:
+# вместо OFFSET курсор — значения ключа сортировки последнего (или первого) питомца страницы.
+# Общее число питомцев под фильтром (для «стр. N/M») кэшируется на PET_COUNT_CACHE_SECONDS.
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from bot.utils.pet_generator import PET_CLASSES
+from db.db import fetch_one, fetch_all
+
+PET_COUNT_CACHE_SECONDS = 60
+PET_COUNT_CACHE_SIZE = 10000 # Выше этого числа просроченные записи вычищаются
+
+# Порядок редкостей, в том же порядке считается pets.rarity_rank в models.sql
+RARITY_ORDER = [
+    "Обычная", "Необычная", "Редкая", "Очень Редкая", "Эпическая",
+    "Легендарная", "Мифическая", "Древняя", "Божественная", "Абсолютная",
+]
+
+# Сортировка: ключ -> (колонки ключа, направление). Все колонки ключа в одном направлении,
+# поэтому сравнение кортежей (a, b, id) < ($1, $2, $3) идёт по индексу.
+PET_SORTS = {
+    "id": (("id",), "ASC"),
+    "level": (("level", "id"), "DESC"),
+    "rarity": (("rarity_rank", "level", "id"), "DESC"),
+}
+
+PET_LIST_COLUMNS = "id, name, rarity, class, level, xp, xp_needed, atk, def, hp, coin_rate, current_hp, rented_until"
+
+_count_cache: dict[tuple, tuple[int, float]] = {}
+
+
+def stats_from_row(row) -> dict:
+    """Статы питомца из колонок atk/def/hp в привычном словаре {"atk", "def", "hp"}."""
+    return {"atk": row["atk"], "def": row["def"], "hp": row["hp"]}
+
+
+@dataclass
+class PetFilter:
+    rarities: list[str] = field(default_factory=list) # Пусто — любая редкость
+    pet_class: Optional[str] = None
+    rented: Optional[bool] = None  # True — только в аренде, False — только не в аренде
+    in_team: Optional[bool] = None # True — только в арена-команде, False — только вне её
+
+    def cache_key(self) -> tuple:
+        return tuple(self.rarities), self.pet_class, self.rented, self.in_team
+
+    def encode(self) -> str:
+        """Компактная запись для callback_data (лимит Telegram — 64 байта)."""
+        code = ""
+        if len(self.rarities) == 1:
+            code += f"r{RARITY_ORDER.index(self.rarities[0])}"
+        if self.pet_class:
+            code += f"c{PET_CLASSES.index(self.pet_class)}"
+        if self.rented is not None:
+            code += f"a{int(self.rented)}"
+        if self.in_team is not None:
+            code += f"t{int(self.in_team)}"
+        return code
+
+    @classmethod
+    def decode(cls, code: str) -> "PetFilter":
+        pet_filter = cls()
+        for i in range(0, len(code) - 1, 2):
+            kind, value = code[i], int(code[i + 1])
+            if kind == "r":
+                pet_filter.rarities = [RARITY_ORDER[value]]
+            elif kind == "c":
+                pet_filter.pet_class = PET_CLASSES[value]
+            elif kind == "a":
+                pet_filter.rented = bool(value)
+            elif kind == "t":
+                pet_filter.in_team = bool(value)
+        return pet_filter
+
+
+def _build_where(uid: int, pet_filter: Optional[PetFilter]):
+    """Возвращает (условия WHERE, аргументы). Аргументы — словарь в порядке $1, $2, ..."""
+    args = {"uid": uid}
+    conditions = ["user_id = $1"]
+    if pet_filter is None:
+        return conditions, args
+
+    if pet_filter.rarities:
+        args["rarities"] = pet_filter.rarities
+        conditions.append(f"rarity = ANY(${len(args)}::text[])")
+    if pet_filter.pet_class:
+        args["pet_class"] = pet_filter.pet_class
+        conditions.append(f"class = ${len(args)}")
+    if pet_filter.rented is not None:
+        conditions.append("rented_until IS NOT NULL" if pet_filter.rented else "rented_until IS NULL")
+    if pet_filter.in_team is not None:
+        team_ids = "SELECT jsonb_array_elements_text(pet_ids)::int FROM arena_team WHERE user_id = $1"
+        conditions.append(f"id {'IN' if pet_filter.in_team else 'NOT IN'} ({team_ids})")
+    return conditions, args
+
+async def fetch_pet_page(uid: int, sort: str = "id", pet_filter: PetFilter = None,
+                         after: tuple = None, before: tuple = None, limit: int = 5,
+                         columns: str = PET_LIST_COLUMNS):
+    """Одна страница питомцев.
+    after — курсор последнего питомца предыдущей страницы (листаем вперёд),
+    before — курсор первого питомца следующей страницы (листаем назад).
+    Возвращает (pets, has_prev, has_next). Курсор питомца — pet_cursor(pet, sort)."""
+    key_columns, direction = PET_SORTS[sort]
+    conditions, args = _build_where(uid, pet_filter)
+
+    cursor = after or before
+    going_back = before is not None and after is None
+    if cursor:
+        # Назад — обратное сравнение и обратный порядок, потом переворачиваем страницу
+        forward_op = ">" if direction == "ASC" else "<"
+        backward_op = "<" if direction == "ASC" else ">"
+        placeholders = []
+        for i, value in enumerate(cursor):
+            args[f"cursor_{i}"] = value
+            placeholders.append(f"${len(args)}")
+        conditions.append(
+            f"({', '.join(key_columns)}) {backward_op if going_back else forward_op} ({', '.join(placeholders)})"
+        )
+
+    order = direction if not going_back else ("DESC" if direction == "ASC" else "ASC")
+    args["limit"] = limit + 1 # Лишняя строка — признак того, что дальше есть ещё
+    selected = [c.strip() for c in columns.split(",")]
+    select_list = ", ".join(selected + [c for c in key_columns if c not in selected]) # Курсору нужны колонки ключа
+    rows = await fetch_all(
+        f"SELECT {select_list} FROM pets WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {', '.join(f'{c} {order}' for c in key_columns)} LIMIT ${len(args)}",
+        args
+    )
+
+    has_more = len(rows) > limit
+    pets = [dict(row) for row in rows[:limit]]
+    if going_back:
+        pets.reverse()
+        return pets, has_more, True
+    return pets, cursor is not None, has_more
+
+def pet_cursor(pet: dict, sort: str = "id") -> tuple:
+    key_columns, _ = PET_SORTS[sort]
+    return tuple(pet[c] for c in key_columns)
+
+async def count_pets(uid: int, pet_filter: PetFilter = None) -> int:
+    """Число питомцев под фильтром. Кэшируется: для «стр. N/M» точность до минуты не важна,
+    а кнопки «вперёд/назад» строятся по has_prev / has_next из самой страницы."""
+    key = (uid, pet_filter.cache_key() if pet_filter else None)
+    cached = _count_cache.get(key)
+    now = time.monotonic()
+    if cached and cached[1] > now:
+        return cached[0]
+
+    if len(_count_cache) > PET_COUNT_CACHE_SIZE:
+        for stale_key in [k for k, (_, expires_at) in _count_cache.items() if expires_at <= now]:
+            del _count_cache[stale_key]
+
+    conditions, args = _build_where(uid, pet_filter)
+    row = await fetch_one(f"SELECT COUNT(*) AS total FROM pets WHERE {' AND '.join(conditions)}", args)
+    _count_cache[key] = (row["total"], now + PET_COUNT_CACHE_SECONDS)
+    return row["total"]
+
+def invalidate_pet_counts(uid: int):
+    """Сбрасывает кэш количества после появления или пропажи питомцев у игрока."""
+    for key in [k for k in _count_cache if k[0] == uid]:
+        del _count_cache[key]
@@ -0,0 +1,108 @@
+# bot/utils/quest_engine.py
+# Прогресс квестов по событиям вместо полного пересчёта.
+# Хендлер после действия игрока отправляет типизированное событие («вылупил 1», «исследовал Ферму»,
+# «собрал 120 монет»). QUESTS_BY_EVENT заранее раскладывает QUESTS_DEFINITIONS по (тип, зона),
+# поэтому событие сразу знает, какие квесты оно двигает, и обновляет только их строки в quests
+# одним UPDATE на всю пачку событий. События, под которые нет квестов, не стоят ни одного запроса.
+# Прогресс, накопленный до выдачи квеста, учитывается при выдаче (initial_progress).
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+from bot.data.quests import QUESTS_DEFINITIONS, QUEST_PROGRESS_MAPPING
+from db.db import fetch_all
+
+# Типы событий — это типы квестов из QUESTS_DEFINITIONS
+HATCH_PETS = "hatch_pets"
+COLLECT_EGGS = "collect_eggs"
+MERGE_PETS = "merge_pets"
+EXPLORE_ZONE = "explore_zone"
+DEFEAT_MONSTERS_ZONE = "defeat_monsters_zone"
+COLLECT_COINS = "collect_coins"
+REACH_PET_LEVEL = "reach_pet_level"
+WIN_ARENA_BATTLES = "win_arena_battles"
+
+# Счётчики, которые растут не на прирост, а до максимума (уровень лучшего питомца)
+MAX_VALUE_EVENTS = {REACH_PET_LEVEL}
+
+# (тип события, зона или None) -> quest_id квестов, которые оно двигает
+QUESTS_BY_EVENT: dict[tuple[str, Optional[str]], list[str]] = {}
+for _quest_id, _quest_def in QUESTS_DEFINITIONS.items():
+    QUESTS_BY_EVENT.setdefault((_quest_def["type"], _quest_def.get("zone_target")), []).append(_quest_id)
+
+
+@dataclass
+class QuestEvent:
+    user_id: int
+    type: str
+    amount: int = 1 # Прирост; для MAX_VALUE_EVENTS — новое значение
+    zone: Optional[str] = None # Для explore_zone / defeat_monsters_zone
+
+
+def initial_progress(user, quest_def: dict, arena_wins: int = 0) -> int:
+    """Прогресс квеста на момент выдачи — из уже загруженной строки users."""
+    field = QUEST_PROGRESS_MAPPING.get(quest_def["type"])
+    if not field:
+        return 0
+    if field == "arena_wins":
+        return arena_wins
+    if field in ("explore_counts", "monsters_defeated_counts"):
+        counts = user.get(field) or {}
+        if isinstance(counts, str):
+            counts = json.loads(counts)
+        return counts.get(quest_def.get("zone_target"), 0)
+    return user.get(field) or 0
+
+async def emit_quest_events(events: list[QuestEvent], bot=None) -> list[tuple[int, str]]:
+    """Применяет пачку событий. Возвращает (user_id, quest_id) квестов, которые только что завершились.
+    Если передан bot, игрок получает сообщение о каждом завершённом квесте."""
+    # Сводим события к одной строке на (игрок, квест): unnest не должен обновлять строку дважды
+    deltas: dict[tuple[int, str], list[int]] = {} # -> [прирост, максимум]
+    for event in events:
+        if event.amount <= 0:
+            continue
+        for quest_id in QUESTS_BY_EVENT.get((event.type, event.zone), ()):
+            delta = deltas.setdefault((event.user_id, quest_id), [0, 0])
+            if event.type in MAX_VALUE_EVENTS:
+                delta[1] = max(delta[1], event.amount)
+            else:
+                delta[0] += event.amount
+    if not deltas:
+        return []
+
+    try:
+        rows = await fetch_all(
+            """
+            UPDATE quests q SET
+                progress = LEAST(q.goal, GREATEST(q.progress + e.amount, e.max_value)),
+                completed = GREATEST(q.progress + e.amount, e.max_value) >= q.goal
+            FROM unnest($1::bigint[], $2::text[], $3::int[], $4::int[]) AS e(user_id, quest_id, amount, max_value)
+            WHERE q.user_id = e.user_id AND q.quest_id = e.quest_id AND q.completed = FALSE AND q.claimed = FALSE
+            RETURNING q.user_id, q.quest_id, q.completed
+            """,
+            {
+                "user_ids": [key[0] for key in deltas],
+                "quest_ids": [key[1] for key in deltas],
+                "amounts": [delta[0] for delta in deltas.values()],
+                "max_values": [delta[1] for delta in deltas.values()],
+            }
+        )
+    except Exception as e:
+        print(f"Ошибка при обновлении прогресса квестов: {e}")
+        return []
+
+    completed = [(row["user_id"], row["quest_id"]) for row in rows if row["completed"]]
+    if bot:
+        for user_id, quest_id in completed:
+            await notify_quest_completed(bot, user_id, quest_id)
+    return completed
+
+async def notify_quest_completed(bot, user_id: int, quest_id: str):
+    try:
+        await bot.send_message(
+            user_id,
+            f"🏆 <b>Квест «{QUESTS_DEFINITIONS[quest_id]['name']}» выполнен!</b>\n"
+            f"🎁 Награда доступна для получения! Используй команду /quests."
+        )
+    except Exception as e:
+        print(f"Не удалось сообщить {user_id} о завершении квеста {quest_id}: {e}")
@@ -0,0 +1,40 @@
+# bot/utils/replay_streamer.py
+# Проигрывание заранее посчитанного лога (данж и т.п.) правками одного сообщения.
+# Результат к этому моменту уже записан в БД, поэтому реплей — чисто косметика:
+# если он оборвётся, игрок ничего не потеряет.
+# Лимиты Telegram и схлопывание правок обеспечивает общий слой bot/utils/telegram_outbound.py.
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+
+running_replays: set[asyncio.Task] = set()
+
+
+async def show_frame(bot, chat_id: int, message_id: int, text: str) -> int:
+    """Редактирует сообщение кадром реплея. Если сообщение пропало — шлёт новое и возвращает его id."""
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode="HTML")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            sent = await bot.send_message(chat_id, text, parse_mode="HTML") # Fallback
+            return sent.message_id
+    return message_id
+
+async def play_replay(bot, chat_id: int, message_id: int, frames: list[tuple[str, float]], delay: float = 0):
+    """frames — список (текст, пауза после кадра в секундах), delay — пауза перед первым кадром."""
+    try:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for text, pause in frames:
+            message_id = await show_frame(bot, chat_id, message_id, text)
+            if pause > 0:
+                await asyncio.sleep(pause)
+    except Exception as e:
+        print(f"Ошибка при проигрывании реплея в чат {chat_id}: {e}")
+
+def start_replay(bot, chat_id: int, message_id: int, frames: list[tuple[str, float]], delay: float = 0):
+    """Запускает реплей фоном, хендлер не ждёт его окончания."""
+    task = asyncio.create_task(play_replay(bot, chat_id, message_id, frames, delay))
+    running_replays.add(task)
+    task.add_done_callback(running_replays.discard)
+    return task
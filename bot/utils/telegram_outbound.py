@@ -0,0 +1,150 @@
+# bot/utils/telegram_outbound.py
+# Единая точка для исходящих сообщений: middleware на сессии бота, через которую проходят
+# все send_message / edit_text / answer из любых хендлеров.
+# - глобальный и поштучный (на чат) token bucket под лимиты Telegram;
+# - при 429 (TelegramRetryAfter) ждём retry_after и повторяем, чат ставится на паузу;
+# - несколько ожидающих правок одного сообщения схлопываются: уходит только последний текст.
+import asyncio
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, EditMessageCaption, EditMessageReplyMarkup, EditMessageText, ForwardMessage,
+    SendAnimation, SendDice, SendDocument, SendMediaGroup, SendMessage, SendPhoto, SendSticker,
+)
+from aiogram.methods.base import Response, TelegramMethod, TelegramType
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, ~20 в минуту в группу
+GLOBAL_RATE_PER_SECOND = 30
+PRIVATE_CHAT_RATE_PER_SECOND = 1
+GROUP_CHAT_RATE_PER_SECOND = 20 / 60
+CHAT_BURST = 3 # Сколько сообщений подряд можно отправить в чат без ожидания
+MAX_RETRIES = 3
+MAX_IDLE_CHAT_BUCKETS = 10000 # Выше этого числа пустые корзины простаивающих чатов выкидываются
+
+LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendSticker, SendAnimation, SendDocument, SendDice, SendMediaGroup,
+    CopyMessage, ForwardMessage, EditMessageText, EditMessageCaption, EditMessageReplyMarkup,
+)
+COALESCED_METHODS = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+
+class TokenBucket:
+    """Корзина с резервированием: reserve() сразу забирает токен (можно уйти в минус)
+    и возвращает, сколько секунд нужно подождать. Так ожидающие обслуживаются по очереди."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        """После 429: ничего не отправлять ближайшие seconds секунд."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundRateLimiter(BaseRequestMiddleware):
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE_PER_SECOND, GLOBAL_RATE_PER_SECOND)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        # (chat_id, message_id, тип правки) -> {"method": последняя правка, "future": общий результат}
+        self.pending_edits: dict[tuple, dict] = {}
+        # Метрики
+        self.sent_total = 0
+        self.coalesced_total = 0
+        self.retry_after_total = 0
+
+    def get_chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > MAX_IDLE_CHAT_BUCKETS:
+                for idle_chat_id in [cid for cid, b in self.chat_buckets.items() if b.is_idle()]:
+                    del self.chat_buckets[idle_chat_id]
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            rate = PRIVATE_CHAT_RATE_PER_SECOND if is_private else GROUP_CHAT_RATE_PER_SECOND
+            bucket = TokenBucket(rate, CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def wait_turn(self, chat_id):
+        delay = self.global_bucket.reserve()
+        if chat_id is not None:
+            delay = max(delay, self.get_chat_bucket(chat_id).reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send_with_retry(self, make_request, bot, method, chat_id):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                result = await make_request(bot, method)
+                self.sent_total += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.retry_after_total += 1
+                if attempt == MAX_RETRIES:
+                    raise
+                if chat_id is not None:
+                    self.get_chat_bucket(chat_id).pause(e.retry_after)
+                print(f"Telegram flood control для чата {chat_id}: ждём {e.retry_after} сек")
+                await asyncio.sleep(e.retry_after)
+                await self.wait_turn(chat_id)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not isinstance(method, LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        message_id = getattr(method, "message_id", None)
+
+        if not isinstance(method, COALESCED_METHODS) or chat_id is None or message_id is None:
+            await self.wait_turn(chat_id)
+            return await self.send_with_retry(make_request, bot, method, chat_id)
+
+        key = (chat_id, message_id, type(method))
+        pending = self.pending_edits.get(key)
+        if pending is not None:
+            # Правка этого сообщения уже ждёт своей очереди — подменяем текст на свежий
+            pending["method"] = method
+            self.coalesced_total += 1
+            return await asyncio.shield(pending["future"])
+
+        pending = {"method": method, "future": asyncio.get_running_loop().create_future()}
+        self.pending_edits[key] = pending
+        try:
+            try:
+                await self.wait_turn(chat_id)
+            finally:
+                self.pending_edits.pop(key, None)
+            result = await self.send_with_retry(make_request, bot, pending["method"], chat_id)
+        except Exception as e:
+            pending["future"].set_exception(e)
+            pending["future"].exception() # Помечаем как полученное, если никто больше не ждёт
+            raise
+        except BaseException:
+            # Запрос-владелец отменён (CancelledError) — присоединившиеся к нему правки не должны ждать вечно
+            pending["future"].cancel()
+            raise
+        pending["future"].set_result(result)
+        return result
@@ -0,0 +1,92 @@
+# bot/utils/user_snapshot.py
+# Строка users без повторных SELECT * в каждом хендлере.
+# - UserSnapshotMiddleware открывает на время апдейта область запроса: первая get_user(uid)
+#   читает строку, остальные вызовы в этом же апдейте берут её из области;
+# - между апдейтами строка живёт в LRU с коротким TTL, общем для всех хендлеров процесса;
+# - после записи в users хендлер вызывает invalidate_user (прирост вида coins = coins + $1)
+#   или update_cached_user (известные новые значения) — следующий get_user увидит свежие данные.
+# Другие процессы (вебхук-воркеры) кэш не сбрасывают, поэтому TTL короткий, а проверки,
+# от которых зависят деньги, по-прежнему делаются условием в самом UPDATE.
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+from aiogram import BaseMiddleware
+
+from db.db import fetch_one
+
+USER_SNAPSHOT_TTL_SECONDS = 5
+USER_SNAPSHOT_CACHE_SIZE = 5000
+
+# uid -> (строка users как dict, время загрузки)
+_cache: "OrderedDict[int, tuple[dict, float]]" = OrderedDict()
+# Область текущего апдейта: uid -> строка или None (игрок не зарегистрирован)
+_request_scope: ContextVar[Optional[dict]] = ContextVar("user_snapshot_scope", default=None)
+
+
+def _cache_get(uid: int) -> Optional[dict]:
+    entry = _cache.get(uid)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[1] > USER_SNAPSHOT_TTL_SECONDS:
+        del _cache[uid]
+        return None
+    _cache.move_to_end(uid)
+    return entry[0]
+
+def _cache_put(uid: int, user: dict):
+    _cache[uid] = (user, time.monotonic())
+    _cache.move_to_end(uid)
+    while len(_cache) > USER_SNAPSHOT_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def get_user(uid: int) -> Optional[dict]:
+    """Строка users игрока или None, если он не зарегистрирован.
+    Возвращается копия: хендлер может её менять, кэш от этого не пострадает."""
+    scope = _request_scope.get()
+    if scope is not None and uid in scope:
+        user = scope[uid]
+        return dict(user) if user is not None else None
+
+    user = _cache_get(uid)
+    if user is None:
+        row = await fetch_one("SELECT * FROM users WHERE user_id = $1", {"uid": uid})
+        user = dict(row) if row else None
+        if user is not None:
+            _cache_put(uid, user) # Отсутствие не кэшируем: /pstart должен сработать сразу
+    if scope is not None:
+        scope[uid] = user
+    return dict(user) if user is not None else None
+
+def update_cached_user(uid: int, **fields):
+    """Write-through: после UPDATE с известными значениями правит снимок вместо повторного чтения."""
+    entry = _cache.get(uid)
+    if entry is not None:
+        entry[0].update(fields)
+    scope = _request_scope.get()
+    if scope is not None and scope.get(uid) is not None:
+        scope[uid].update(fields) # Часто это тот же dict, что и в кэше — повторный update безвреден
+
+def invalidate_user(uid: int):
+    """Сбрасывает снимок после записи в users, результат которой заранее неизвестен."""
+    _cache.pop(uid, None)
+    scope = _request_scope.get()
+    if scope is not None:
+        scope.pop(uid, None)
+
+def invalidate_users(uids: Iterable[int]):
+    for uid in uids:
+        invalidate_user(uid)
+
+
+class UserSnapshotMiddleware(BaseMiddleware):
+    """Outer-middleware на апдейты: одна область снимков users на апдейт."""
+
+    async def __call__(self, handler, event, data):
+        token = _request_scope.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            _request_scope.reset(token)
@@ -0,0 +1,113 @@
+# bot/utils/webhook_server.py
+# Режим webhook: aiohttp-сервер за локальным reverse proxy вместо long polling.
+# - апдейты обрабатываются фоновыми задачами, одновременно не больше MAX_CONCURRENT_UPDATES;
+#   когда лимит занят, новый запрос ждёт слота (Telegram просто подождёт ответа);
+# - /healthz — процесс жив, /readyz — готов принимать апдейты (БД доступна и не идёт остановка);
+# - по SIGTERM/SIGINT: readyz отдаёт 503, сервер перестаёт слушать порт,
+#   уже начатые апдейты дорабатываются до SHUTDOWN_DRAIN_SECONDS.
+# Несколько воркеров могут слушать разные порты за одним публичным адресом.
+import asyncio
+import signal
+
+from aiohttp import web
+from aiogram.methods import TelegramMethod
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+    MAX_CONCURRENT_UPDATES, SHUTDOWN_DRAIN_SECONDS
+)
+from db.db import fetch_one
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, dp, bot):
+        self.dp = dp
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+        self.in_flight: set[asyncio.Task] = set()
+        self.draining = False
+        self.stop_event = asyncio.Event()
+
+    async def process_update(self, update: dict):
+        try:
+            result = await self.dp.feed_webhook_update(self.bot, update)
+            if isinstance(result, TelegramMethod):
+                await self.bot(result)
+        except Exception as e:
+            print(f"Ошибка при обработке апдейта {update.get('update_id')}: {e}")
+        finally:
+            self.semaphore.release()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if self.draining:
+            return web.Response(status=503) # Telegram повторит доставку, её примет другой воркер
+        update = await request.json()
+
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.process_update(update))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+        return web.Response()
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "in_flight": len(self.in_flight)})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        if self.draining:
+            return web.json_response({"status": "draining"}, status=503)
+        try:
+            await fetch_one("SELECT 1")
+        except Exception as e:
+            return web.json_response({"status": "db unavailable", "error": str(e)}, status=503)
+        return web.json_response({"status": "ready", "in_flight": len(self.in_flight)})
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+        return app
+
+    async def drain(self):
+        """Ждёт уже начатые апдейты, но не дольше SHUTDOWN_DRAIN_SECONDS."""
+        if not self.in_flight:
+            return
+        print(f"Дожидаемся {len(self.in_flight)} апдейтов перед остановкой...")
+        done, pending = await asyncio.wait(set(self.in_flight), timeout=SHUTDOWN_DRAIN_SECONDS)
+        if pending:
+            print(f"Не успели обработать {len(pending)} апдейтов, отменяем")
+            for task in pending:
+                task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop_event.set)
+
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+        await site.start()
+
+        # Вебхук ставит каждый воркер — вызов идемпотентный. При остановке не снимаем,
+        # чтобы остальные воркеры продолжали получать апдейты.
+        await self.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=min(MAX_CONCURRENT_UPDATES, 100), # Больше 100 Telegram не принимает
+            drop_pending_updates=False
+        )
+        print(f"Webhook-сервер слушает {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.draining = True
+            await site.stop()
+            await self.drain()
+            await runner.cleanup()
+            await self.bot.session.close()
@@ -5,3 +5,18 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_URL = os.getenv("DATABASE_URL")
+
+# FSM-хранилище: postgres (по умолчанию), redis или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_TTL_SECONDS = int(os.getenv("FSM_TTL_SECONDS", 6 * 60 * 60))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Режим приёма апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1") # Слушаем локально, снаружи — reverse proxy
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 50))
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv("SHUTDOWN_DRAIN_SECONDS", 25))
@@ -1,5 +1,4 @@
-from datetime import datetime, timezone
-import json
+from contextlib import asynccontextmanager
 import asyncpg
 from config import DB_URL
 
@@ -26,20 +25,59 @@ async def fetch_all(query: str, args: dict = None):
 async def execute_query(query: str, args: dict = None):
     async with pool.acquire() as connection:
         return await connection.execute(query, *args.values() if args else ())
+
+class Transaction:
+    """Единица работы: одно соединение из пула на всю команду и один COMMIT в конце.
+    Методы повторяют fetch_one / fetch_all / execute_query, поэтому код хендлеров почти не меняется."""
+
+    def __init__(self, connection: asyncpg.Connection):
+        self.connection = connection
+
+    async def fetch_one(self, query: str, args: dict = None):
+        return await self.connection.fetchrow(query, *args.values() if args else ())
+
+    async def fetch_all(self, query: str, args: dict = None):
+        return await self.connection.fetch(query, *args.values() if args else ())
+
+    async def execute_query(self, query: str, args: dict = None):
+        return await self.connection.execute(query, *args.values() if args else ())
+
+    async def executemany(self, query: str, args_list: list[dict]):
+        return await self.connection.executemany(query, [tuple(args.values()) for args in args_list])
+
+@asynccontextmanager
+async def transaction():
+    """async with transaction() as tx: ... — все запросы внутри идут через одно соединение,
+    поэтому SELECT ... FOR UPDATE действительно держит блокировку до конца блока.
+    При исключении транзакция откатывается."""
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            yield Transaction(connection)
+
+async def listen(channel: str, callback):
+    """Подписка на LISTEN/NOTIFY. Отдельное соединение, не из пула: пул отдаёт соединения
+    другим запросам, и подписка бы потерялась. Возвращает соединение — его закрытие снимает подписку."""
+    connection = await asyncpg.connect(dsn=DB_URL)
+    await connection.add_listener(channel, callback)
+    return connection
+
+async def notify(channel: str, payload: str = ""):
+    await execute_query("SELECT pg_notify($1, $2)", {"channel": channel, "payload": payload})
     
 async def get_user_quests(uid: int):
     return await fetch_all("SELECT * FROM quests WHERE user_id = $1", {"uid": uid})
 
-async def insert_quest(user_id: int, quest_id: str, name: str, description: str, zone: str, goal: int, reward_coins: int, reward_egg_type: str = None):
+async def insert_quest(user_id: int, quest_id: str, name: str, description: str, zone: str, goal: int, reward_coins: int, reward_egg_type: str = None, progress: int = 0):
+    # progress — то, что игрок уже накопил к моменту выдачи; если этого хватает, квест сразу завершён
     await execute_query(
         "INSERT INTO quests (user_id, quest_id, name, description, progress, goal, reward_coins, reward_egg_type, completed, claimed, zone) "
-        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, FALSE, FALSE, $9)",
+        "VALUES ($1, $2, $3, $4, LEAST($5::int, $6::int), $6::int, $7, $8, $5::int >= $6::int, FALSE, $9)",
         {
             "user_id": user_id,
             "quest_id": quest_id,
             "name": name,
             "description": description,
-            "progress": 0, # Начинаем с 0
+            "progress": progress,
             "goal": goal,
             "reward_coins": reward_coins,
             "reward_egg_type": reward_egg_type,
@@ -61,31 +99,32 @@ async def complete_quest(uid: int, quest_id: str): # Изменено quest_name
 
 # ИСПРАВЛЕННАЯ ФУНКЦИЯ claim_quest_reward
 async def claim_quest_reward(uid: int, quest_db_id: int): # Изменено user_id на uid для консистентности, и quest_id на quest_db_id для ясности
-    quest_record = await fetch_one("SELECT * FROM quests WHERE id = $1 AND user_id = $2", {"id": quest_db_id, "user_id": uid})
+    async with transaction() as tx:
+        # FOR UPDATE внутри транзакции: двойное нажатие «Забрать» не выдаст награду дважды
+        quest_record = await tx.fetch_one("SELECT * FROM quests WHERE id = $1 AND user_id = $2 FOR UPDATE", {"id": quest_db_id, "user_id": uid})
 
-    if not quest_record or not quest_record['completed'] or quest_record.get('claimed', False):
-        return False, "Квест не завершен или награда уже забрана."
+        if not quest_record or not quest_record['completed'] or quest_record.get('claimed', False):
+            return False, "Квест не завершен или награда уже забрана."
 
-    # Мы больше не используем QUESTS_DEFINITIONS.get(quest_record['quest_id']) здесь
-    # Все данные о награде берутся из самой записи квеста в БД
-    reward_coins = quest_record.get('reward_coins', 0)
-    reward_egg_type = quest_record.get('reward_egg_type') # Теперь это тип яйца
+        # Все данные о награде берутся из самой записи квеста в БД
+        reward_coins = quest_record.get('reward_coins', 0) or 0
+        reward_egg_type = quest_record.get('reward_egg_type') # Теперь это тип яйца
 
-    # Обновляем монеты пользователя и total_coins_collected (если это не делается в другом месте)
-    if reward_coins > 0:
-        await execute_query("UPDATE users SET coins = coins + $1, total_coins_collected = total_coins_collected + $1 WHERE user_id = $2",
-                            {"coins": reward_coins, "uid": uid})
+        if reward_egg_type:
+            await tx.execute_query(
+                "UPDATE users SET coins = coins + $1, total_coins_collected = total_coins_collected + $1, "
+                "eggs_collected = eggs_collected + 1 WHERE user_id = $2",
+                {"coins": reward_coins, "uid": uid}
+            )
+            await tx.execute_query(
+                "INSERT INTO user_eggs (user_id, egg_type, source) VALUES ($1, $2, $3)",
+                {"uid": uid, "egg_type": reward_egg_type, "source": f"Квест «{quest_record['name']}»"}
+            )
+        elif reward_coins > 0:
+            await tx.execute_query("UPDATE users SET coins = coins + $1, total_coins_collected = total_coins_collected + $1 WHERE user_id = $2",
+                                   {"coins": reward_coins, "uid": uid})
 
-    # Добавляем яйцо в инвентарь пользователя (eggs JSONB)
-    if reward_egg_type:
-        user_data = await fetch_one("SELECT eggs FROM users WHERE user_id = $1", {"uid": uid})
-        eggs_list = json.loads(user_data.get('eggs', '[]') or '[]')
-        eggs_list.append({"type": reward_egg_type, "timestamp": datetime.now(timezone.utc).isoformat()}) # Используем datetime.now(timezone.utc)
-        await execute_query("UPDATE users SET eggs = $1 WHERE user_id = $2", {"eggs": json.dumps(eggs_list), "uid": uid})
-        # Если у вас есть счетчик eggs_collected, увеличьте его здесь:
-        await execute_query("UPDATE users SET eggs_collected = eggs_collected + 1 WHERE user_id = $1", {"uid": uid})
-
-    await execute_query("UPDATE quests SET claimed = TRUE WHERE id = $1", {"id": quest_db_id})
+        await tx.execute_query("UPDATE quests SET claimed = TRUE WHERE id = $1", {"id": quest_db_id})
 
     msg = f"🎉 Награда за квест «{quest_record['name']}» получена!" # Используем имя из записи квеста
     if reward_coins > 0:
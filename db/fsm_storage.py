@@ -0,0 +1,88 @@
+# db/fsm_storage.py
+# FSM-хранилище для Dispatcher вместо MemoryStorage: состояние (данж, выбранные питомцы и т.п.)
+# переживает рестарт и общее для нескольких воркеров на одном токене.
+# - PostgresStorage — таблица fsm_states, данные компактным JSON, у каждой записи свой срок жизни;
+# - Redis — штатный RedisStorage из aiogram (нужен пакет redis), TTL через state_ttl / data_ttl;
+# - memory — старое поведение, для локальной разработки.
+import json
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from config import FSM_STORAGE, FSM_TTL_SECONDS, REDIS_URL
+from db.db import fetch_one, execute_query
+
+PURGE_INTERVAL_SECONDS = 600 # Не чаще этого чистим просроченные записи
+
+
+def make_key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+def dump_data(data: Dict[str, Any]) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(self, ttl_seconds: int = FSM_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.last_purge = 0.0
+
+    async def purge_expired(self):
+        """Удаляет просроченные записи, но не чаще раза в PURGE_INTERVAL_SECONDS."""
+        now = time.monotonic()
+        if now - self.last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self.last_purge = now
+        await execute_query("DELETE FROM fsm_states WHERE expires_at <= NOW()")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_name = state.state if isinstance(state, State) else state
+        await execute_query(
+            "INSERT INTO fsm_states (key, state, expires_at) VALUES ($1, $2, NOW() + make_interval(secs => $3)) "
+            "ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at, "
+            # Просроченная, но ещё не удалённая запись не должна воскресить старые данные
+            "data = CASE WHEN fsm_states.expires_at <= NOW() THEN '{}'::jsonb ELSE fsm_states.data END",
+            {"key": make_key(key), "state": state_name, "ttl": self.ttl_seconds}
+        )
+        await self.purge_expired()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await fetch_one(
+            "SELECT state FROM fsm_states WHERE key = $1 AND expires_at > NOW()",
+            {"key": make_key(key)}
+        )
+        return row["state"] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await execute_query(
+            "INSERT INTO fsm_states (key, data, expires_at) VALUES ($1, $2::jsonb, NOW() + make_interval(secs => $3)) "
+            "ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at, "
+            "state = CASE WHEN fsm_states.expires_at <= NOW() THEN NULL ELSE fsm_states.state END",
+            {"key": make_key(key), "data": dump_data(data), "ttl": self.ttl_seconds}
+        )
+        await self.purge_expired()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await fetch_one(
+            "SELECT data FROM fsm_states WHERE key = $1 AND expires_at > NOW()",
+            {"key": make_key(key)}
+        )
+        if not row or row["data"] is None:
+            return {}
+        return json.loads(row["data"]) if isinstance(row["data"], str) else dict(row["data"])
+
+    async def close(self) -> None:
+        pass # Пулом соединений управляет db.db
+
+
+def build_fsm_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """Выбирает хранилище по FSM_STORAGE: postgres (по умолчанию), redis или memory."""
+    if kind == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage # Требует пакет redis
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL_SECONDS, data_ttl=FSM_TTL_SECONDS)
+    if kind == "memory":
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+    return PostgresStorage()
@@ -16,7 +16,9 @@ CREATE TABLE IF NOT EXISTS pets (
     level INT,
     xp INT,
     xp_needed INT,
-    stats JSONB,
+    atk INT,
+    "def" INT,
+    hp INT,
     coin_rate INT,
     last_collected TIMESTAMPTZ
 );
@@ -96,10 +98,173 @@ ADD COLUMN IF NOT EXISTS highest_pet_level INTEGER DEFAULT 0, -- Максима
 ADD COLUMN IF NOT EXISTS active_zone TEXT DEFAULT 'Лужайка', -- Активная зона пользователя
 ADD COLUMN IF NOT EXISTS user_items JSONB DEFAULT '{}'::jsonb; -- ПРОСТОЙ ИНВЕНТАРЬ: {"ItemName": count}
 
+-- Обновления для таблицы arena_team
+ALTER TABLE arena_team
+ADD COLUMN IF NOT EXISTS draws INT DEFAULT 0, -- Ничьи на арене
+ADD COLUMN IF NOT EXISTS team_name TEXT DEFAULT 'Без названия'; -- Название арена-команды
+
+-- Таблица лидеров арены: топ читается по индексу, без сортировки всей таблицы
+CREATE INDEX IF NOT EXISTS idx_arena_team_leaderboard ON arena_team (wins DESC, draws DESC, losses ASC) INCLUDE (user_id);
+
+-- Сколько игроков с каждым счётом арены. По ней считается место игрока в рейтинге
+CREATE TABLE IF NOT EXISTS arena_score_counts (
+    wins INT NOT NULL,
+    draws INT NOT NULL,
+    losses INT NOT NULL,
+    players INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (wins, draws, losses)
+);
+
+-- Очередь арены: переживает рестарт бота, матчмейкинг читает её при старте
+CREATE TABLE IF NOT EXISTS arena_queue (
+    user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    power INT NOT NULL, -- Сила команды на момент входа в очередь
+    joined_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_arena_queue_power ON arena_queue (power);
+
+-- Задания исследований: результат выдаёт планировщик по due_at
+CREATE TABLE IF NOT EXISTS explorations (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+    pet_id INT, -- Без FK: если питомца продали, задание всё равно закрывается
+    zone TEXT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT, -- Сообщение «отправился исследовать», которое редактируется результатом
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    due_at TIMESTAMPTZ NOT NULL,
+    resolved_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_explorations_pending ON explorations (due_at) WHERE resolved_at IS NULL;
+
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS last_explore_time TIMESTAMPTZ, -- Кулдаун /explore
+ADD COLUMN IF NOT EXISTS last_energy_update TIMESTAMPTZ; -- Якорь энергии: energy — значение на этот момент
+
+-- Энергия арены хранится так же, парой (значение, якорь). Текущее значение считается при чтении
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS arena_energy INTEGER DEFAULT 6,
+ADD COLUMN IF NOT EXISTS last_arena_energy_recharge TIMESTAMPTZ;
+
+-- Журнал походов в данжи: итог пишется одной транзакцией вместе с наградами
+CREATE TABLE IF NOT EXISTS dungeon_runs (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+    dungeon_key TEXT NOT NULL,
+    pet_ids JSONB NOT NULL,
+    completed BOOLEAN NOT NULL,
+    total_xp INT DEFAULT 0,
+    total_coins INT DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Выборка питомцев страницами: ранг редкости для сортировки и индексы под keyset-пагинацию
+ALTER TABLE pets
+ADD COLUMN IF NOT EXISTS rented_until TIMESTAMPTZ, -- До какого момента питомец в аренде
+ADD COLUMN IF NOT EXISTS last_rent_payout TIMESTAMPTZ, -- Последняя выплата аренды
+ADD COLUMN IF NOT EXISTS rarity_rank SMALLINT GENERATED ALWAYS AS (
+    CASE rarity
+        WHEN 'Обычная' THEN 0
+        WHEN 'Необычная' THEN 1
+        WHEN 'Редкая' THEN 2
+        WHEN 'Очень Редкая' THEN 3
+        WHEN 'Эпическая' THEN 4
+        WHEN 'Легендарная' THEN 5
+        WHEN 'Мифическая' THEN 6
+        WHEN 'Древняя' THEN 7
+        WHEN 'Божественная' THEN 8
+        WHEN 'Абсолютная' THEN 9
+        ELSE -1
+    END
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_pets_user_id_id ON pets (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_pets_user_level ON pets (user_id, level DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_pets_user_rarity ON pets (user_id, rarity_rank DESC, level DESC, id DESC);
+
+-- Аренда: ожидаемая прибыль выплачивается фоновой задачей по истечении rented_until.
+-- Частичный индекс — только питомцы в аренде, задача находит истёкшие без обхода всей таблицы
+ALTER TABLE pets
+ADD COLUMN IF NOT EXISTS expected_rent_profit INT DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_pets_rented_until ON pets (rented_until) WHERE rented_until IS NOT NULL;
+
+-- Имена игроков: снимаются с входящих апдейтов, чтобы не звать get_chat на каждый вывод
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS display_name TEXT,
+ADD COLUMN IF NOT EXISTS username TEXT,
+ADD COLUMN IF NOT EXISTS display_name_updated_at TIMESTAMPTZ;
+
+-- Состояния FSM (aiogram) — общие для всех воркеров бота
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY, -- bot_id:chat_id:user_id:thread_id:destiny
+    state TEXT,
+    data JSONB,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at);
+
 -- Обновления для таблицы pets
 ALTER TABLE pets
 ADD COLUMN IF NOT EXISTS current_hp INTEGER; -- Текущее здоровье питомца для битв
 
+-- Статы питомца в отдельных колонках вместо stats JSONB.
+-- Перенос идемпотентный: to_jsonb(p) не ломает запрос, когда колонки stats уже нет
+ALTER TABLE pets
+ADD COLUMN IF NOT EXISTS atk INT,
+ADD COLUMN IF NOT EXISTS "def" INT,
+ADD COLUMN IF NOT EXISTS hp INT;
+
+UPDATE pets p SET
+    atk = (to_jsonb(p) #>> '{stats,atk}')::int,
+    "def" = (to_jsonb(p) #>> '{stats,def}')::int,
+    hp = (to_jsonb(p) #>> '{stats,hp}')::int
+WHERE p.atk IS NULL AND to_jsonb(p) ? 'stats';
+
+-- Сила питомца для команд арены и подбора соперников считается самой БД
+ALTER TABLE pets
+ADD COLUMN IF NOT EXISTS power INT GENERATED ALWAYS AS (atk + "def" + hp) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_pets_user_power ON pets (user_id, power DESC);
+
+DROP VIEW IF EXISTS pets_with_stats;
+
+ALTER TABLE pets
+DROP COLUMN IF EXISTS stats;
+
+-- Для старых запросов и ручной аналитики: pets со stats в прежнем JSONB-виде
+CREATE VIEW pets_with_stats AS
+SELECT p.*, jsonb_build_object('atk', p.atk, 'def', p."def", 'hp', p.hp) AS stats
+FROM pets p;
+
+-- Инвентарь яиц: строка на яйцо вместо JSON-массива users.eggs
+CREATE TABLE IF NOT EXISTS user_eggs (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    egg_type TEXT NOT NULL,
+    source TEXT, -- Магазин, ежедневная награда, подземелье, квест
+    obtained_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_eggs_user ON user_eggs (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_user_eggs_user_type ON user_eggs (user_id, egg_type, id);
+
+-- Перенос яиц из users.eggs в порядке массива. Массив очищается тем же запросом,
+-- поэтому повторный запуск ничего не задвоит. Самообъединение отдаёт в RETURNING старое значение
+WITH moved AS (
+    UPDATE users u SET eggs = '[]'::jsonb
+    FROM users old
+    WHERE old.user_id = u.user_id AND old.eggs IS NOT NULL AND old.eggs != '[]'::jsonb
+    RETURNING u.user_id, old.eggs
+)
+INSERT INTO user_eggs (user_id, egg_type, source)
+SELECT m.user_id, COALESCE(e.egg ->> 'type', 'базовое'), e.egg ->> 'source'
+FROM moved m, jsonb_array_elements(m.eggs) WITH ORDINALITY AS e(egg, pos)
+ORDER BY m.user_id, e.pos;
+
 -- Обновления для таблицы quests
 ALTER TABLE quests
 ADD COLUMN IF NOT EXISTS quest_id TEXT, -- Ссылка на ключ в QUESTS_DEFINITIONS (например, 'first_egg_collection')
@@ -107,6 +272,40 @@ ADD COLUMN IF NOT EXISTS claimed BOOLEAN DEFAULT FALSE, -- Статус: наг
 DROP COLUMN IF EXISTS reward_egg, -- Удаляем старый BOOLEAN столбец
 ADD COLUMN IF NOT EXISTS reward_egg_type TEXT DEFAULT NULL; -- Новый TEXT столбец для типа яйца (например, 'обычное', 'крутое')
 
+-- Прогресс квестов по событиям: обновляются только открытые квесты игрока с нужным quest_id
+CREATE INDEX IF NOT EXISTS idx_quests_user_open ON quests (user_id, quest_id) WHERE completed = FALSE AND claimed = FALSE;
+
+-- Питомец дня: одна строка (slot = 1) с победителем и сроком.
+-- Новый выбирается условным upsert только после ends_at, поэтому рестарт или второй воркер
+-- не перевыбирают питомца и не платят награду повторно
+CREATE TABLE IF NOT EXISTS top_pet (
+    slot SMALLINT PRIMARY KEY DEFAULT 1 CHECK (slot = 1),
+    pet_id INT NOT NULL,
+    user_id BIGINT NOT NULL,
+    pet_name TEXT NOT NULL,
+    rarity TEXT,
+    level INT,
+    nickname TEXT NOT NULL,
+    selected_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    ends_at TIMESTAMPTZ NOT NULL
+);
+
+-- Предложения обмена R2R: раньше жили в памяти процесса и терялись при рестарте.
+-- Одно активное предложение на игрока (новое заменяет старое), истёкшие удаляет фоновая задача.
+-- Проданный или слитый питомец уносит с собой и предложение (ON DELETE CASCADE)
+CREATE TABLE IF NOT EXISTS trade_offers (
+    proposer_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    target_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    pet_id INT NOT NULL REFERENCES pets(id) ON DELETE CASCADE,
+    pet_name TEXT NOT NULL,
+    rarity TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_trade_offers_target ON trade_offers (target_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_trade_offers_expires_at ON trade_offers (expires_at);
+
 -- Обновления для таблицы zones
 ALTER TABLE zones
 ADD COLUMN IF NOT EXISTS explore_duration_min INTEGER DEFAULT 15,
@@ -1,6 +1,7 @@
 import asyncio
 import json
-from db.db import init_db, execute_query
+from db.db import init_db, execute_query, notify
+from bot.utils.catalog import CATALOG_CHANNEL
 
 async def apply_schema():
     await init_db()
@@ -45,6 +46,8 @@ async def main():
     await apply_schema()
     await init_db()
     await create_zones()
+    # Запущенные боты перечитают зоны и монстров без рестарта
+    await notify(CATALOG_CHANNEL)
 
 if __name__ == "__main__":
     asyncio.run(main())
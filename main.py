@@ -1,20 +1,37 @@
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from config import BOT_TOKEN, DB_URL
+from config import BOT_TOKEN, DB_URL, BOT_MODE
 from db.db import init_db
+from db.fsm_storage import build_fsm_storage
+from bot.utils.telegram_outbound import OutboundRateLimiter
+from bot.utils.webhook_server import WebhookServer
+from bot.utils.display_names import DisplayNameMiddleware, start_display_name_refresher
+from bot.utils.user_snapshot import UserSnapshotMiddleware
+from bot.utils.catalog import load_catalog, start_catalog_listener
 from bot.handlers import start, eggs, pets, economy, dev, merge, arena, trade, sell, explore, dungeon, bonus
 
 async def main():
     await init_db()
+    # Зоны и монстры — в памяти; init_models.py сообщит через NOTIFY, если справочник поменяется
+    await load_catalog()
+    # Фоновые задачи: ссылки держим сами (цикл событий хранит задачи слабо), при остановке — отменяем
+    background_tasks = [start_catalog_listener()]
 
     bot = Bot(
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    dp = Dispatcher(storage=MemoryStorage())
+    # Все исходящие запросы всех хендлеров идут через лимитер: token bucket, retry-after, схлопывание правок
+    bot.session.middleware(OutboundRateLimiter())
+    # FSM в Postgres/Redis: состояние переживает рестарт и общее для всех воркеров
+    dp = Dispatcher(storage=build_fsm_storage())
+
+    # Имена игроков снимаются с апдейтов — хендлерам не нужен bot.get_chat
+    dp.update.outer_middleware(DisplayNameMiddleware())
+    # Строка users читается не больше одного раза за апдейт (bot.utils.user_snapshot.get_user)
+    dp.update.outer_middleware(UserSnapshotMiddleware())
 
     dp.include_routers(
         start.router,
@@ -31,7 +48,30 @@ async def main():
         bonus.router
     )
 
-    await dp.start_polling(bot)
+    # Запись имён в БД пачкой и обновление устаревших
+    background_tasks.append(start_display_name_refresher(bot))
+    # Фоновый матчмейкинг арены: очередь в БД, бои идут параллельно
+    background_tasks.append(arena.start_arena_matchmaking(bot))
+    # Планировщик исследований: задания в БД, результаты выдаются по due_at
+    background_tasks.append(explore.start_explore_scheduler(bot))
+    # Выплаты за истёкшие аренды: пачками по индексу rented_until, уведомления с ограниченной параллельностью
+    background_tasks.append(sell.start_rent_payouts(bot))
+    # Питомец дня: выбор и награда раз в сутки, победитель хранится в таблице top_pet
+    background_tasks.append(bonus.start_top_pet_job(bot))
+    # Предложения обмена в БД: истёкшие удаляются фоновой задачей
+    background_tasks.append(trade.start_trade_offer_sweeper())
+
+    try:
+        if BOT_MODE == "webhook":
+            # Апдейты приходят через reverse proxy, обработка параллельная с лимитом
+            await WebhookServer(dp, bot).run()
+        else:
+            await bot.delete_webhook(drop_pending_updates=False) # Иначе getUpdates вернёт конфликт
+            await dp.start_polling(bot)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file